@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+"""
+Benchmark how long a scale event takes and where the time goes.
+
+DockerAdmin and the `container` CLI are driven against stand-in Docker
+engines (fake_docker_engine.py) through a stub docker-compose
+(fake_docker_compose.py). Latencies of the engine, container create and
+start, Zabbix login and compose file parsing can be injected.
+
+Example:
+    python benchmark/bench_scale.py --mode both --iterations 20 \\
+        --concurrency 4 --data-centers 3 --engine-latency 0.01
+"""
+import argparse
+import json
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_docker_engine import FakeDockerEngine
+
+_BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+_PACKAGE_DIR = os.path.join(os.path.dirname(_BENCH_DIR), 'concierge_scheduler')
+_SCHEDULER = os.path.join(_PACKAGE_DIR, 'concierge_scheduler.py')
+_SERVICE = 'app'
+_PHASES = ('interpreter_start', 'imports', 'zabbix_login', 'compose_startup',
+           'compose_parse', 'engine_calls', 'compose_overhead',
+           'scheduler_other', 'total')
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, int(round(percent / 100.0 * len(ordered) + 0.5)) - 1)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def timed_process(cmd, env=None):
+    start = time.time()
+    subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+    return time.time() - start
+
+
+class ScaleBenchmark:
+    """
+    Run scale up/down operations and collect per-phase timings
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.work_dir = tempfile.mkdtemp(prefix='concierge-bench-')
+        self.timings_file = os.path.join(self.work_dir, 'timings.jsonl')
+        self.engines = [
+            FakeDockerEngine(args.engine_latency, args.start_latency,
+                             args.login_latency,
+                             create_latency=args.create_latency).start()
+            for _ in range(args.data_centers)]
+        self.compose_bin = self._write_compose_stub()
+        os.environ.update({
+            'DOCKER_COMPOSE_BIN': self.compose_bin,
+            'DOCKER_COMPOSE_DIR': self.work_dir,
+            'BENCH_TIMINGS_FILE': self.timings_file,
+            'BENCH_PARSE_LATENCY': str(args.parse_latency),
+            'ZBX_API_HOST': self.engines[0].http_url,
+            'ZBX_TLS_VERIFY': 'false',
+        })
+
+    def _write_compose_stub(self):
+        # the launch time lets the stub report its interpreter start up
+        path = os.path.join(self.work_dir, 'docker-compose')
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nBENCH_COMPOSE_LAUNCHED=$(date +%s.%N) '
+                    'exec "{}" "{}" "$@"\n'.format(
+                sys.executable, os.path.join(_BENCH_DIR,
+                                             'fake_docker_compose.py')))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        return path
+
+    def _project(self, worker):
+        project = 'bench{}'.format(worker)
+        os.makedirs(os.path.join(self.work_dir, project), exist_ok=True)
+        with open(os.path.join(self.work_dir, project, 'compose.yml'), 'w') as f:
+            f.write('services:\n  {}:\n    image: busybox\n'.format(_SERVICE))
+        return project
+
+    def _compose_timings(self, project, start, end):
+        """
+        timings reported by the stub docker-compose for one operation. With
+        several data centers the slowest one is on the critical path. Warm
+        pool refills run detached from the operation, so are left out
+        """
+        if not os.path.isfile(self.timings_file):
+            return {}
+        with open(self.timings_file) as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        matching = [line for line in lines if line['project'] == project
+                    and start <= line['end'] <= end and not line['no_start']]
+        if not matching:
+            return {}
+        slowest = max(matching, key=lambda line: line['compose_startup'] +
+                      line['compose_total'])
+        return {
+            'compose_startup': slowest['compose_startup'],
+            'compose_parse': slowest['compose_parse'],
+            'engine_calls': slowest['engine_calls'],
+            'compose_overhead': slowest['compose_total'] -
+                                slowest['compose_parse'] -
+                                slowest['engine_calls'],
+            'compose_total': slowest['compose_total'],
+        }
+
+    def _api_operation(self, project, current_scale, command):
+        from concierge_docker import DockerAdmin
+        docker_admin = DockerAdmin(
+            object, [e.url for e in self.engines], project, _SERVICE,
+            current_scale, 1, warm_pool=self.args.warm_pool,
+            scale_down_to_pool=self.args.warm_pool > 0)
+        start = time.time()
+        docker_admin.run(command)
+        end = time.time()
+        docker_admin.wait_for_refill()
+        return start, end, {}
+
+    def _cli_operation(self, project, current_scale, command, op_id):
+        cmd = [sys.executable, _SCHEDULER, 'container']
+        for engine in self.engines:
+            cmd += ['-u', engine.url]
+        cmd += ['-p', project, 'scale', '-n', _SERVICE,
+                '-c', str(current_scale), '-s', '1',
+                '--warm-pool', str(self.args.warm_pool), command]
+        if self.args.warm_pool and command == 'down':
+            cmd.append('--to-pool')
+        env = dict(os.environ, ZBX_API_USER=op_id)
+        start = time.time()
+        subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        end = time.time()
+        return start, end, {'interpreter_start': self.interpreter_start,
+                            'imports': self.imports}
+
+    def _worker(self, mode, worker):
+        project = self._project(worker)
+        base = self.args.base_scale
+        if base:
+            from concierge_docker import DockerAdmin
+            docker_admin = DockerAdmin(
+                object, [e.url for e in self.engines], project, _SERVICE, 0,
+                base, warm_pool=self.args.warm_pool)
+            docker_admin.run('scale_up')
+            docker_admin.wait_for_refill()
+        samples = []
+        for iteration in range(self.args.iterations):
+            scale_up = iteration % 2 == 0
+            current_scale = base if scale_up else base + 1
+            command = 'up' if scale_up else 'down'
+            op_id = '{}-{}'.format(project, iteration)
+            if mode == 'api':
+                start, end, phases = self._api_operation(
+                    project, current_scale,
+                    'scale_up' if scale_up else 'scale_down')
+            else:
+                start, end, phases = self._cli_operation(
+                    project, current_scale, command, op_id)
+            phases['total'] = end - start
+            samples.append((op_id, start, end, phases))
+        return project, samples
+
+    def _measure_startup(self):
+        python = [sys.executable]
+        runs = max(3, min(self.args.iterations, 10))
+        interpreter = [timed_process(python + ['-c', 'pass'])
+                       for _ in range(runs)]
+        imports = [timed_process(python + [
+            '-c', 'import sys; sys.path.insert(0, {!r}); '
+                  'import concierge_scheduler'.format(_PACKAGE_DIR)])
+            for _ in range(runs)]
+        self.interpreter_start = percentile(interpreter, 50)
+        self.imports = max(0.0, percentile(imports, 50) -
+                           self.interpreter_start)
+
+    def run(self, mode):
+        if mode == 'cli':
+            self._measure_startup()
+        if os.path.isfile(self.timings_file):
+            os.remove(self.timings_file)
+        for engine in self.engines:
+            engine.zabbix_calls[:] = []
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            results = list(executor.map(
+                lambda worker: self._worker(mode, worker),
+                range(self.args.concurrency)))
+        elapsed = time.time() - started
+
+        zabbix_time = self.engines[0].zabbix_time_by_user()
+        phases = {phase: [] for phase in _PHASES}
+        for project, samples in results:
+            for op_id, start, end, sample in samples:
+                compose = self._compose_timings(project, start, end)
+                sample.update(compose)
+                if mode == 'cli':
+                    sample['zabbix_login'] = zabbix_time.get(op_id, 0.0)
+                known = sum(sample.get(phase, 0.0) for phase in (
+                    'interpreter_start', 'imports', 'zabbix_login'))
+                sample['scheduler_other'] = sample['total'] - known - \
+                    compose.get('compose_startup', 0.0) - \
+                    compose.get('compose_total', 0.0)
+                for phase in _PHASES:
+                    if phase in sample:
+                        phases[phase].append(sample[phase])
+        return elapsed, phases
+
+    def report(self, mode, elapsed, phases):
+        operations = len(phases['total'])
+        print('\n{} mode: {} scale operations, concurrency {}, {} data centers,'
+              ' {:.2f} ops/s'.format(mode, operations, self.args.concurrency,
+                                     self.args.data_centers,
+                                     operations / elapsed))
+        print('{:<18} {:>9} {:>9} {:>9} {:>9}'.format(
+            'phase (ms)', 'mean', 'p50', 'p99', 'max'))
+        for phase in _PHASES:
+            values = phases[phase]
+            if not values:
+                continue
+            print('{:<18} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+                phase, 1000 * sum(values) / len(values),
+                1000 * percentile(values, 50), 1000 * percentile(values, 99),
+                1000 * max(values)))
+
+    def close(self):
+        for engine in self.engines:
+            engine.stop()
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Measure scale latency of the concierge scheduler against'
+                    ' stand-in Docker engines')
+    parser.add_argument('--mode', choices=('api', 'cli', 'both'),
+                        default='both',
+                        help='drive DockerAdmin in process, the container CLI'
+                             ' in a new process, or both')
+    parser.add_argument('--iterations', type=int, default=10,
+                        help='scale operations per worker, alternating up'
+                             ' and down')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='number of projects scaled at the same time')
+    parser.add_argument('--data-centers', type=int, default=1,
+                        help='number of stand-in engines to fan out to')
+    parser.add_argument('--base-scale', type=int, default=1,
+                        help='containers running before measuring')
+    parser.add_argument('--warm-pool', type=int, default=0,
+                        help='size of the warm pool of stopped containers')
+    parser.add_argument('--engine-latency', type=float, default=0.005,
+                        help='seconds added to every engine API call')
+    parser.add_argument('--start-latency', type=float, default=0.0,
+                        help='extra seconds to start a container')
+    parser.add_argument('--create-latency', type=float, default=0.0,
+                        help='extra seconds to pull and create a container')
+    parser.add_argument('--login-latency', type=float, default=0.0,
+                        help='seconds added to every Zabbix API call')
+    parser.add_argument('--parse-latency', type=float, default=0.0,
+                        help='seconds added to compose file parsing')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    cmd_args = arg_parser()
+    sys.path.insert(0, _PACKAGE_DIR)
+    benchmark = ScaleBenchmark(cmd_args)
+    try:
+        modes = ('api', 'cli') if cmd_args.mode == 'both' else (cmd_args.mode,)
+        for bench_mode in modes:
+            benchmark.report(bench_mode, *benchmark.run(bench_mode))
+    finally:
+        benchmark.close()
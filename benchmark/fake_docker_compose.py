@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Stub docker-compose used by the scale benchmark. Understands the commands run
+by DockerAdmin and drives the stand-in engine over its HTTP API.
+
+Timings for each invocation are appended as a JSON line to the file named by
+BENCH_TIMINGS_FILE. The wrapper script sets BENCH_COMPOSE_LAUNCHED to the time
+it was run, so that starting the interpreter is reported as compose_startup.
+"""
+import json
+import os
+import sys
+import time
+import urllib.request
+from urllib.parse import quote
+
+BENCH_PARSE_LATENCY = float(os.getenv('BENCH_PARSE_LATENCY', '0'))
+BENCH_TIMINGS_FILE = os.getenv('BENCH_TIMINGS_FILE')
+
+_engine_time = 0.0
+_engine_calls = 0
+
+
+def engine_call(host, method, path, body=None):
+    global _engine_time, _engine_calls
+    start = time.time()
+    request = urllib.request.Request(
+        host + path, method=method,
+        data=None if body is None else json.dumps(body).encode(),
+        headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        payload = response.read()
+    _engine_time += time.time() - start
+    _engine_calls += 1
+    return json.loads(payload) if payload else None
+
+
+def service_containers(host, project, service=None, show_all=True):
+    labels = ['com.docker.compose.project={}'.format(project)]
+    if service:
+        labels.append('com.docker.compose.service={}'.format(service))
+    filters = quote(json.dumps({'label': labels}))
+    return engine_call(host, 'GET', '/containers/json?all={}&filters={}'.format(
+        int(show_all), filters))
+
+
+def scale(host, project, service, desired, start=True):
+    """
+    make a service have exactly the desired number of containers, like
+    `up --scale`, starting them unless --no-start was given
+    """
+    containers = service_containers(host, project, service)
+    while len(containers) > desired:
+        container = containers.pop()
+        if container['State'] == 'running':
+            engine_call(host, 'POST', '/containers/{}/stop'.format(
+                container['Id']))
+        engine_call(host, 'DELETE', '/containers/{}'.format(container['Id']))
+    number = max([int(c['Labels'].get('com.docker.compose.container-number', 0))
+                  for c in containers] + [0])
+    while len(containers) < desired:
+        number += 1
+        name = '{}_{}_{}'.format(project, service, number)
+        created = engine_call(
+            host, 'POST', '/containers/create?name={}'.format(name),
+            {'Labels': {'com.docker.compose.project': project,
+                        'com.docker.compose.service': service,
+                        'com.docker.compose.container-number': str(number)},
+             'HostConfig': {'Memory': 512 * 1024 ** 2, 'NanoCpus': 10 ** 9}})
+        containers.append({'Id': created['Id'], 'State': 'created'})
+    if start:
+        for container in containers:
+            if container['State'] != 'running':
+                engine_call(host, 'POST', '/containers/{}/start'.format(
+                    container['Id']))
+
+
+def launch_time(start):
+    """
+    :return: time the wrapper script was run, or start when it isn't known.
+        E.g. `date` without %N support
+    """
+    try:
+        return min(float(os.getenv('BENCH_COMPOSE_LAUNCHED', start)), start)
+    except ValueError:
+        return start
+
+
+def main(argv):
+    start = time.time()
+    launched = launch_time(start)
+    host, compose_file = None, None
+    args = []
+    while argv:
+        arg = argv.pop(0)
+        if arg.startswith('--host='):
+            host = arg.split('=', 1)[1].replace('tcp://', 'http://', 1)
+        elif arg == '--file':
+            compose_file = argv.pop(0)
+        else:
+            args.append(arg)
+
+    parse_start = time.time()
+    with open(compose_file) as f:
+        f.read()
+    time.sleep(BENCH_PARSE_LATENCY)
+    parse_time = time.time() - parse_start
+    project = os.path.basename(os.path.dirname(compose_file))
+
+    if args[0] == 'up':
+        service, desired = args[args.index('--scale') + 1].split('=')
+        scale(host, project, service, int(desired), '--no-start' not in args)
+    elif args[0] == 'ps':
+        service = args[2] if len(args) > 2 else None
+        for container in service_containers(host, project, service, False):
+            print(container['Id'])
+    else:
+        sys.stderr.write('unsupported command {}\n'.format(args))
+        return 1
+
+    if BENCH_TIMINGS_FILE:
+        with open(BENCH_TIMINGS_FILE, 'a') as f:
+            f.write(json.dumps({
+                'project': project, 'host': host, 'command': args[0],
+                'no_start': '--no-start' in args,
+                'compose_startup': start - launched,
+                'compose_parse': parse_time, 'engine_calls': _engine_time,
+                'engine_call_count': _engine_calls,
+                'compose_total': time.time() - start,
+                'end': time.time()}) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
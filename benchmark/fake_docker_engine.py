@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""
+Stand-in for the Docker Engine API and the Zabbix JSON-RPC API, used by the
+scale benchmark. Only the calls made by the scheduler and the stub
+docker-compose are implemented. Every request can be delayed to emulate a
+remote engine.
+"""
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+ZABBIX_API_VERSION = '6.0.0'
+
+
+class FakeDockerEngine:
+    """
+    Threaded HTTP server holding an in-memory set of containers
+    """
+
+    def __init__(self, engine_latency=0.0, start_latency=0.0,
+                 login_latency=0.0, port=0, create_latency=0.0):
+        """
+        :param engine_latency: seconds added to every Docker Engine API call
+        :param start_latency: extra seconds taken to start a container
+        :param create_latency: extra seconds taken to pull an image and create
+                               a container
+        :param login_latency: seconds added to every Zabbix API call
+        :param port: port to listen on. 0 picks a free port
+        """
+        self.engine_latency = engine_latency
+        self.start_latency = start_latency
+        self.create_latency = create_latency
+        self.login_latency = login_latency
+        self.containers = {}
+        self.zabbix_calls = []
+        self.lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port),
+                                           self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='fake-engine', daemon=True)
+
+    @property
+    def url(self):
+        return 'tcp://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    @property
+    def http_url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def zabbix_time_by_user(self):
+        """
+        total time spent serving Zabbix API calls, grouped by the user which
+        logged in over the same connection
+        :return: dict of user to seconds
+        """
+        users = {}
+        for client, method, params, duration in self.zabbix_calls:
+            if method == 'user.login':
+                users[client] = params.get('username', params.get('user'))
+        totals = {}
+        for client, method, params, duration in self.zabbix_calls:
+            user = users.get(client)
+            totals[user] = totals.get(user, 0.0) + duration
+        return totals
+
+    # container state
+    def list_containers(self, show_all=False, labels=()):
+        with self.lock:
+            containers = [dict(c) for c in self.containers.values()
+                          if show_all or c['State'] == 'running']
+        for label in labels:
+            key, _, value = label.partition('=')
+            containers = [c for c in containers
+                          if c['Labels'].get(key) == value]
+        return sorted(containers, key=lambda c: c['Created'])
+
+    def create_container(self, name, labels, host_config=None):
+        container_id = uuid.uuid4().hex * 2
+        with self.lock:
+            self.containers[container_id] = {
+                'Id': container_id, 'Names': ['/' + name], 'Labels': labels,
+                'State': 'created', 'Created': time.time(),
+                'HostConfig': dict(host_config or {})}
+        return container_id
+
+    def update_container(self, container_id, resources):
+        with self.lock:
+            if container_id not in self.containers:
+                return False
+            self.containers[container_id]['HostConfig'].update(resources)
+            return True
+
+    def set_state(self, container_id, state):
+        with self.lock:
+            if container_id not in self.containers:
+                return False
+            self.containers[container_id]['State'] = state
+            return True
+
+    @staticmethod
+    def stats(container):
+        """
+        a CPU usage sample which stays the same for each container
+        """
+        usage = int(container['Id'][:4], 16) if container['State'] == 'running' \
+            else 0
+        return {'cpu_stats': {'cpu_usage': {'total_usage': usage},
+                              'system_cpu_usage': 65536, 'online_cpus': 1},
+                'precpu_stats': {'cpu_usage': {'total_usage': 0},
+                                 'system_cpu_usage': 0}}
+
+    def remove_container(self, container_id):
+        with self.lock:
+            return self.containers.pop(container_id, None) is not None
+
+    def _handler_class(self):
+        engine = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body=None):
+                payload = b'' if body is None else json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b'{}')
+
+            def _route(self, method):
+                url = urlparse(self.path)
+                parts = [p for p in url.path.split('/') if p]
+                # the engine API may be prefixed with a version. E.g. /v1.41
+                if parts and parts[0].startswith('v1.'):
+                    parts = parts[1:]
+                return method, parts, parse_qs(url.query)
+
+            def do_GET(self):
+                time.sleep(engine.engine_latency)
+                method, parts, query = self._route('GET')
+                if parts == ['_ping']:
+                    return self._reply(200, 'OK')
+                if parts == ['containers', 'json']:
+                    filters = json.loads(query.get('filters', ['{}'])[0])
+                    show_all = query.get('all', ['0'])[0] in ('1', 'true')
+                    return self._reply(200, engine.list_containers(
+                        show_all, filters.get('label', ())))
+                if len(parts) == 3 and parts[0] == 'containers' \
+                        and parts[2] in ('json', 'stats'):
+                    with engine.lock:
+                        container = engine.containers.get(parts[1])
+                    if container is None:
+                        return self._reply(404, {'message': 'no such container'})
+                    if parts[2] == 'stats':
+                        return self._reply(200, engine.stats(container))
+                    container = dict(container, State={
+                        'Status': container['State'],
+                        'Running': container['State'] == 'running'})
+                    return self._reply(200, container)
+                self._reply(404, {'message': 'not implemented'})
+
+            def do_POST(self):
+                if self.path.endswith('api_jsonrpc.php'):
+                    return self._zabbix()
+                time.sleep(engine.engine_latency)
+                method, parts, query = self._route('POST')
+                if parts == ['containers', 'create']:
+                    time.sleep(engine.create_latency)
+                    body = self._body()
+                    container_id = engine.create_container(
+                        query.get('name', ['container'])[0],
+                        body.get('Labels', {}), body.get('HostConfig'))
+                    return self._reply(201, {'Id': container_id})
+                if len(parts) == 3 and parts[0] == 'containers':
+                    action = parts[2]
+                    if action == 'update':
+                        if engine.update_container(parts[1], self._body()):
+                            return self._reply(200, {'Warnings': []})
+                        return self._reply(404,
+                                           {'message': 'no such container'})
+                    if action == 'start':
+                        time.sleep(engine.start_latency)
+                    state = {'start': 'running', 'stop': 'exited',
+                             'kill': 'exited'}.get(action)
+                    if state and engine.set_state(parts[1], state):
+                        return self._reply(204)
+                    return self._reply(404, {'message': 'no such container'})
+                self._reply(404, {'message': 'not implemented'})
+
+            def do_DELETE(self):
+                time.sleep(engine.engine_latency)
+                method, parts, query = self._route('DELETE')
+                if len(parts) == 2 and parts[0] == 'containers' \
+                        and engine.remove_container(parts[1]):
+                    return self._reply(204)
+                self._reply(404, {'message': 'no such container'})
+
+            def _zabbix(self):
+                start = time.time()
+                time.sleep(engine.login_latency)
+                request = self._body()
+                results = {
+                    'apiinfo.version': ZABBIX_API_VERSION,
+                    'user.login': uuid.uuid4().hex,
+                }
+                self._reply(200, {'jsonrpc': '2.0', 'id': request.get('id'),
+                                  'result': results.get(request['method'], [])})
+                engine.zabbix_calls.append(
+                    (self.client_address, request['method'],
+                     request.get('params') or {}, time.time() - start))
+
+        return Handler
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Run a stand-in Docker Engine and Zabbix API')
+    parser.add_argument('--port', type=int, default=2375)
+    parser.add_argument('--engine-latency', type=float, default=0.0)
+    parser.add_argument('--start-latency', type=float, default=0.0)
+    parser.add_argument('--create-latency', type=float, default=0.0)
+    parser.add_argument('--login-latency', type=float, default=0.0)
+    args = parser.parse_args()
+    fake_engine = FakeDockerEngine(args.engine_latency, args.start_latency,
+                                   args.login_latency, args.port,
+                                   args.create_latency).start()
+    print('Listening on {}'.format(fake_engine.url))
+    try:
+        fake_engine._thread.join()
+    except KeyboardInterrupt:
+        fake_engine.stop()
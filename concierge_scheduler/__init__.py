@@ -5,5 +5,8 @@ __all__ = [
     'concierge_scheduler',
     'concierge_zabbix',
     'concierge_docker',
-    'concierge_cloud'
+    'concierge_cloud',
+    'concierge_profile',
+    'concierge_records',
+    'concierge_limiter'
 ]
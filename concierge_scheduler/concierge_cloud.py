@@ -1,8 +1,167 @@
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+import logging
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+UPLOAD_CONCURRENCY = 8
+UPLOAD_RETRIES = 3
+# objects fetched ahead of the file being written by a download, per download thread
+DOWNLOAD_AHEAD = 4
+# content defined chunking of snapshot files. Boundaries are found from the content itself, so an edit only changes
+# the chunks around it and the rest are shared with earlier snapshots
+SNAPSHOT_MIN_CHUNK = 16 * 1024
+SNAPSHOT_AVG_CHUNK = 64 * 1024
+SNAPSHOT_MAX_CHUNK = 256 * 1024
+_READ_SIZE = 1024 * 1024
+# chunk boundaries are found with a fingerprint of the last _CHUNK_WINDOW bytes, the sum of a random 48 bit value
+# for each byte shifted left by its distance from the end of the window. Bits 32 to 47 depend on every byte of the
+# window. The fingerprints of a block of bytes are computed together, each in a _LANE_WIDTH byte lane of one big
+# integer, so that the work is done by C loops over the whole block rather than a Python loop per byte
+_CHUNK_WINDOW = 32
+_LANE_WIDTH = 10
+_SEARCH_BLOCK = 16 * 1024
+_BYTE_VALUES = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:6], 'little') for i in range(256)]
+# byte n of the value of each byte
+_VALUE_BYTES = [bytes((value >> (8 * n)) & 0xFF for value in _BYTE_VALUES) for n in range(6)]
+
+
+# logging
+def get_logger(name):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+
+    stream = logging.StreamHandler()
+    fmt = logging.Formatter('%(asctime)s [%(threadName)s] '
+                            '[%(name)s] %(levelname)s: %(message)s')
+    stream.setFormatter(fmt)
+    logger.addHandler(stream)
+
+    return logger
+
+
+__LOG = get_logger(__name__)
+
+
+def _info(message, *args):
+    __LOG.log(logging.INFO, message.format(*args))
+
+
+def _warn(message, *args):
+    __LOG.log(logging.WARN, message.format(*args))
+
+
+def _fingerprints(data: bytes) -> bytes:
+    """
+    :return: _LANE_WIDTH little endian bytes for each byte of data, the fingerprint of the window ending with it
+    """
+    lanes = bytearray(_LANE_WIDTH * len(data))
+    for n, value_bytes in enumerate(_VALUE_BYTES):
+        lanes[n::_LANE_WIDTH] = data.translate(value_bytes)
+    fingerprints = int.from_bytes(lanes, 'little')
+    # add each lane, shifted left by the distance, to the lanes after it, doubling the bytes covered each time until
+    # they cover the window
+    width = 1
+    while width < _CHUNK_WINDOW:
+        fingerprints += fingerprints << (8 * _LANE_WIDTH * width + width)
+        width *= 2
+    return fingerprints.to_bytes(_LANE_WIDTH * (len(data) + _CHUNK_WINDOW), 'little')[:_LANE_WIDTH * len(data)]
+
+
+def _cut_point(data: bytes, min_size: int, max_size: int, mask: int) -> int:
+    """
+    Find the end of the next chunk, where bits 32 to 47 of the fingerprint have none of the bits of mask set, never
+    before min_size or after max_size. The data is searched a block at a time, as most chunks end well before
+    max_size
+    """
+    limit = min(len(data), max_size)
+    start = min_size
+    while start < limit:
+        end = min(start + _SEARCH_BLOCK, limit)
+        first = max(0, start - _CHUNK_WINDOW + 1)
+        fingerprints = _fingerprints(data[first:end])
+        size = end - first
+        # a byte of found is 0 where bytes 4 and 5 of the fingerprint have none of the bits of mask set
+        low = int.from_bytes(fingerprints[4::_LANE_WIDTH], 'little') & int.from_bytes(bytes([mask & 0xFF]) * size,
+                                                                                      'little')
+        high = int.from_bytes(fingerprints[5::_LANE_WIDTH], 'little') & int.from_bytes(bytes([mask >> 8]) * size,
+                                                                                       'little')
+        found = (low | high).to_bytes(size, 'little').find(0, start - first)
+        if found >= 0:
+            return first + found + 1
+        start = end
+    return limit
+
+
+def file_chunks(filename: str, min_size: int = SNAPSHOT_MIN_CHUNK, avg_size: int = SNAPSHOT_AVG_CHUNK,
+                max_size: int = SNAPSHOT_MAX_CHUNK):
+    """
+    Split a file into content defined chunks
+    :param filename: Path of local file
+    :param min_size: Smallest chunk, except for the last one of the file
+    :param avg_size: Typical distance between boundaries after min_size. A power of 2, at most 64KiB
+    :param max_size: Largest chunk
+    :return: generator of bytes
+    """
+    if avg_size > 1 << 16 or avg_size & (avg_size - 1):
+        raise ValueError('Average chunk size must be a power of 2 of at most 64KiB')
+    mask = avg_size - 1
+    with open(filename, 'rb') as f:
+        buffer = b''
+        while True:
+            data = f.read(_READ_SIZE)
+            buffer += data
+            while len(buffer) >= max_size or (buffer and not data):
+                cut = _cut_point(buffer, min_size, max_size, mask)
+                yield buffer[:cut]
+                buffer = buffer[cut:]
+            if not data:
+                return
+
+
+class FileArrivals:
+    """
+    Track files arriving from a download running in another thread, so that each can be used as soon as it is
+    written
+    """
+
+    def __init__(self):
+        self._arrived = set()
+        self._finished = False
+        self._condition = threading.Condition()
+
+    def arrived(self, filename: str):
+        with self._condition:
+            self._arrived.add(os.path.abspath(filename))
+            self._condition.notify_all()
+
+    def finish(self):
+        with self._condition:
+            self._finished = True
+            self._condition.notify_all()
+
+    def wait(self, filename: str) -> bool:
+        """
+        Block until filename has arrived or the download has finished
+        :return: whether the file arrived
+        """
+        filename = os.path.abspath(filename)
+        with self._condition:
+            self._condition.wait_for(lambda: filename in self._arrived or self._finished)
+            return filename in self._arrived
 
 
 class CloudBackupInterface(metaclass=ABCMeta):
     __storage_location = NotImplemented
+    config_dir = NotImplemented
+    concurrency = UPLOAD_CONCURRENCY
+    # exceptions raised by a backend when a file fails to upload or download
+    upload_errors = (OSError,)
 
     @classmethod
     def __subclasshook__(cls, subclass):
@@ -45,3 +204,419 @@ class CloudBackupInterface(metaclass=ABCMeta):
         :param upload_list: set: strings of fully qualified paths to file or directories to upload
         """
         raise NotImplementedError
+
+    # object primitives used by the snapshot store
+    def _put_object(self, name: str, data: bytes):
+        """
+        Store data as an object
+        :param name: Name of the object within the storage location
+        :param data: Content of the object
+        """
+        raise NotImplementedError
+
+    def _get_object(self, name: str) -> bytes:
+        """
+        :param name: Name of the object within the storage location
+        :return: Content of the object
+        """
+        raise NotImplementedError
+
+    def _list_objects(self, prefix: str) -> set:
+        """
+        :param prefix: Only list objects with names starting with prefix
+        :return: set of object names
+        """
+        raise NotImplementedError
+
+    def _copy_object(self, source: str, name: str):
+        """
+        Copy an object within the storage location, without downloading it
+        :param source: Name of the object to copy
+        :param name: Name of the copy
+        """
+        raise NotImplementedError
+
+    def _upload_function(self):
+        """
+        :return: callable taking a local file name and remote path, uploading the file and returning the number of
+            bytes uploaded
+        """
+        raise NotImplementedError
+
+    # helpers shared by storage backends for uploading many files and skipping unchanged ones
+    def _remote_path(self, filename: str, folder: str, directory: str = None) -> str:
+        directory = directory or os.path.basename(os.path.normpath(self.config_dir))
+        return os.path.join(folder, directory, os.path.relpath(filename, self.config_dir))
+
+    def _local_checksums(self, filename: str) -> dict:
+        """
+        Checksums of a local file in the form the storage location keeps them for objects
+        """
+        raise NotImplementedError
+
+    def _remote_checksums(self, folder: str, directory: str = None) -> dict:
+        """
+        List the objects under our remote directory once
+        :param directory: (optional) Remote directory to list instead of the one named after config_dir
+        :return: dict of object name to its checksums
+        """
+        raise NotImplementedError
+
+    def _previous_directory(self, folder: str):
+        """
+        Find the latest directory uploaded before ours, for config directories named after each backup. E.g.
+        202001010000 when ours is 202001020000. The snapshot store's directories are left out
+        :return: name of the directory sorting last before ours, or None if there isn't one
+        """
+        prefix = os.path.join(folder, '')
+        directory = os.path.basename(os.path.normpath(self.config_dir))
+        names = {name[len(prefix):].split('/', 1)[0] for name in self._list_objects(prefix)
+                 if '/' in name[len(prefix):]}
+        earlier = sorted(name for name in names - {'chunks', 'snapshots'} if name < directory)
+        return earlier[-1] if earlier else None
+
+    def _unchanged(self, local: dict, remote: dict) -> bool:
+        raise NotImplementedError
+
+    def _load_manifest(self, manifest: str) -> dict:
+        if manifest and os.path.isfile(manifest):
+            with open(manifest, 'r') as f:
+                data = json.load(f)
+            if data.get('bucket') == self.storage_location:
+                return data['objects']
+        return {}
+
+    def _save_manifest(self, manifest: str, objects: dict):
+        with open(manifest, 'w') as f:
+            json.dump({'bucket': self.storage_location, 'objects': objects}, f)
+
+    def _changed_files(self, upload_list: set, folder: str, manifest: str):
+        """
+        Compare local files with what's stored, from the manifest if we have one or else from listing the storage
+        location. When nothing is stored under our directory, e.g. because it is named after each backup, files are
+        compared with the latest directory uploaded before it and unchanged ones are copied from there
+        :return: tuple of (dict of files to upload to their checksums, dict of files to copy to the object they are
+            copied from, dict of remote path to checksums of all files)
+        """
+        directory = os.path.basename(os.path.normpath(self.config_dir))
+        prefix = os.path.join(folder, directory, '')
+        remote = self._load_manifest(manifest)
+        if any(remote_path.startswith(prefix) for remote_path in remote):
+            _info('Comparing with manifest {}', manifest)
+        else:
+            remote = self._remote_checksums(folder)
+        previous = None
+        if not remote:
+            previous = self._previous_directory(folder)
+        if previous:
+            _info('Nothing uploaded from a directory named {}. Comparing with {}', directory, previous)
+            remote = self._remote_checksums(folder, previous)
+        elif not remote:
+            _warn('Nothing uploaded from a directory named {} or before it found in {}. All files will be uploaded',
+                  directory, self.storage_location)
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='hash') as executor:
+            checksums = dict(zip(upload_list, executor.map(self._local_checksums, upload_list)))
+        changed = {}
+        copies = {}
+        objects = {}
+        for filename, local in checksums.items():
+            remote_path = self._remote_path(filename, folder)
+            objects[remote_path] = local
+            stored_path = self._remote_path(filename, folder, previous) if previous else remote_path
+            if not remote.get(stored_path) or not self._unchanged(local, remote[stored_path]):
+                changed[filename] = local
+            elif previous:
+                copies[filename] = stored_path
+        return changed, copies, objects
+
+    def _copy_or_upload(self, upload_file, source: str):
+        """
+        :return: callable like upload_file, which copies the source object instead, uploading the file if the copy
+            fails. It returns the number of bytes uploaded, 0 for a copy
+        """
+        def copy(filename, remote_path):
+            try:
+                self._copy_object(source, remote_path)
+                return 0
+            except self.upload_errors as err:
+                _warn('Failed to copy {} to {}, uploading it: {}', source, remote_path, err)
+                return upload_file(filename, remote_path)
+        return copy
+
+    def _upload_files(self, upload_file, upload_list: set, folder: str = '', sync: bool = False,
+                      manifest: str = None) -> dict:
+        """
+        Upload files `self.concurrency` at a time
+        :param upload_file: callable taking a local file name and remote path, returning the number of bytes uploaded
+        :param upload_list: set of files to upload
+        :param folder: Folder within the storage location to upload config_dir to
+        :param sync: Only upload files which are new or differ from the stored objects. Files unchanged since an
+            earlier directory was uploaded are copied from it
+        :param manifest: Local file recording what was stored by the last sync. When present, it is used instead of
+            listing the storage location
+        :return: summary of the upload with the number of files and bytes uploaded, files skipped (including those
+            copied), files copied, seconds taken and failed files
+        """
+        start = time.time()
+        summary = {'files': 0, 'bytes': 0, 'skipped': 0, 'copied': 0, 'seconds': 0.0, 'failed': []}
+        objects = {}
+        copies = {}
+        if manifest:
+            upload_list = {filename for filename in upload_list
+                           if os.path.abspath(filename) != os.path.abspath(manifest)}
+        if sync:
+            changed, copies, objects = self._changed_files(upload_list, folder, manifest)
+            summary['skipped'] = len(upload_list) - len(changed)
+            upload_list = set(changed)
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='upload') as executor:
+            futures = {executor.submit(upload_file, filename, self._remote_path(filename, folder)): filename
+                       for filename in upload_list}
+            copied = {executor.submit(self._copy_or_upload(upload_file, source), filename,
+                                      self._remote_path(filename, folder)): filename
+                      for filename, source in copies.items()}
+            for future in as_completed(copied):
+                try:
+                    uploaded = future.result()
+                    summary['bytes'] += uploaded
+                    # a copy which failed was uploaded instead
+                    summary['files' if uploaded else 'copied'] += 1
+                except self.upload_errors as err:
+                    _warn('Failed to upload {}: {}', copied[future], err)
+                    summary['failed'].append(copied[future])
+            for future in as_completed(futures):
+                try:
+                    summary['bytes'] += future.result()
+                    summary['files'] += 1
+                except self.upload_errors as err:
+                    _warn('Failed to upload {}: {}', futures[future], err)
+                    summary['failed'].append(futures[future])
+        if sync and manifest:
+            for filename in summary['failed']:
+                objects.pop(self._remote_path(filename, folder))
+            self._save_manifest(manifest, objects)
+        summary['seconds'] = time.time() - start
+        return summary
+
+    def _put_chunk(self, folder: str, digest: str, chunk: bytes) -> int:
+        data = zlib.compress(chunk)
+        self._put_object(os.path.join(folder, 'chunks', digest), data)
+        return len(data)
+
+    def upload_snapshot(self, upload_list: set, folder: str = '', name: str = None) -> dict:
+        """
+        Store files as a deduplicated snapshot. Each file is split into content defined chunks, which are compressed
+        and stored once under `folder/chunks/<sha256 of chunk>`. Only chunks the storage location doesn't already
+        have are uploaded. The snapshot is recorded in `folder/snapshots/<name>.json`, listing the chunks of each file
+        by its path relative to config_dir. It is written after all of its chunks are stored
+        :param upload_list: set of files to store
+        :param folder: (optional) Folder within the storage location holding the snapshot store
+        :param name: (optional) Name of the snapshot. Defaults to the name of config_dir
+        :return: summary of the upload with the number of files in the snapshot, bytes uploaded, chunks in the
+            snapshot, chunks already stored (skipped), seconds taken and failed files
+        """
+        start = time.time()
+        name = name or os.path.basename(os.path.normpath(self.config_dir))
+        summary = {'files': 0, 'bytes': 0, 'chunks': 0, 'skipped': 0, 'seconds': 0.0, 'failed': []}
+        chunk_prefix = os.path.join(folder, 'chunks', '')
+        stored = {os.path.basename(object_name) for object_name in self._list_objects(chunk_prefix)}
+        files = {}
+        failed = set()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='chunk') as executor:
+            pending = {}
+
+            def collect(futures):
+                for future in futures:
+                    filename = pending.pop(future)
+                    try:
+                        summary['bytes'] += future.result()
+                    except self.upload_errors as err:
+                        _warn('Failed to upload chunk of {}: {}', filename, err)
+                        failed.add(filename)
+
+            for filename in sorted(upload_list):
+                checksum = hashlib.sha256()
+                chunks = []
+                size = 0
+                for chunk in file_chunks(filename):
+                    digest = hashlib.sha256(chunk).hexdigest()
+                    checksum.update(chunk)
+                    chunks.append(digest)
+                    size += len(chunk)
+                    if digest in stored:
+                        summary['skipped'] += 1
+                        continue
+                    stored.add(digest)
+                    pending[executor.submit(self._put_chunk, folder, digest, chunk)] = filename
+                    # keep a bounded number of chunks in memory
+                    if len(pending) >= 4 * self.concurrency:
+                        collect(wait(pending, return_when=FIRST_COMPLETED).done)
+                summary['chunks'] += len(chunks)
+                files[os.path.relpath(filename, self.config_dir)] = {'size': size, 'sha256': checksum.hexdigest(),
+                                                                     'chunks': chunks}
+            collect(list(pending))
+        summary['failed'] = sorted(failed)
+        if not failed:
+            snapshot_path = os.path.join(folder, 'snapshots', '{}.json'.format(name))
+            try:
+                self._put_object(snapshot_path, json.dumps({'name': name, 'created': time.time(),
+                                                            'files': files}).encode())
+                summary['files'] = len(files)
+            except self.upload_errors as err:
+                _warn('Failed to upload snapshot {}: {}', snapshot_path, err)
+                summary['failed'] = [snapshot_path]
+        summary['seconds'] = time.time() - start
+        return summary
+
+    def _get_chunk(self, folder: str, digest: str) -> bytes:
+        return zlib.decompress(self._get_object(os.path.join(folder, 'chunks', digest)))
+
+    def download(self, folder: str, name: str, destination: str, on_file=None, order: list = ()) -> dict:
+        """
+        Download a backup into destination, `self.concurrency` objects at a time. Either a snapshot stored by
+        `upload_snapshot` or the files uploaded by `upload` from a config directory called name. Each file is written
+        as soon as all of its content has arrived, in the order given, so that it can be used while the rest are
+        still downloading. At most DOWNLOAD_AHEAD objects per thread are fetched ahead of the file being written
+        :param folder: Folder within the storage location the backup was stored in
+        :param name: Name of the snapshot or of the uploaded config directory
+        :param destination: Local directory to write files to, by their path relative to the config directory
+        :param on_file: (optional) callable taking the path of each file written
+        :param order: (optional) paths, relative to the config directory, of files to download first
+        :return: summary of the download with the number of files and bytes written, seconds taken and failed files
+        """
+        start = time.time()
+        summary = {'files': 0, 'bytes': 0, 'seconds': 0.0, 'failed': []}
+        snapshot_path = os.path.join(folder, 'snapshots', '{}.json'.format(name))
+        snapshot = None
+        if snapshot_path in self._list_objects(snapshot_path):
+            snapshot = json.loads(self._get_object(snapshot_path))['files']
+            files = list(snapshot)
+        else:
+            prefix = os.path.join(folder, name, '')
+            objects = self._list_objects(prefix)
+            files = [os.path.relpath(object_name, prefix) for object_name in objects]
+        if not files:
+            _warn('No snapshot or files named {} found in {}', name, self.storage_location)
+            summary['failed'] = [name]
+            return summary
+        files.sort(key=lambda filename: (order.index(filename) if filename in order else len(order), filename))
+        # the objects making up each file: the chunks of a snapshot, or the uploaded file itself
+        needed = [snapshot[filename]['chunks'] if snapshot else [filename] for filename in files]
+        last_use = {key: index for index, keys in enumerate(needed) for key in keys}
+        ahead = ((index, key) for index, keys in enumerate(needed) for key in keys)
+        next_fetch = next(ahead, None)
+        fetched = {}
+
+        def fetch(key):
+            return self._get_chunk(folder, key) if snapshot else self._get_object(os.path.join(prefix, key))
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='download') as executor:
+            for index, filename in enumerate(files):
+                # fetch ahead while fewer than DOWNLOAD_AHEAD objects per thread are held, and always all of this
+                # file. Each object is dropped once the last file using it is written, so memory stays bounded
+                while next_fetch and (next_fetch[0] <= index or len(fetched) < DOWNLOAD_AHEAD * self.concurrency):
+                    if next_fetch[1] not in fetched:
+                        fetched[next_fetch[1]] = executor.submit(fetch, next_fetch[1])
+                    next_fetch = next(ahead, None)
+                path = os.path.join(destination, filename)
+                size = 0
+                try:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    checksum = hashlib.sha256()
+                    # written in full before it appears under its own name
+                    with open(path + '.part', 'wb') as f:
+                        for key in needed[index]:
+                            data = fetched[key].result()
+                            checksum.update(data)
+                            f.write(data)
+                            size += len(data)
+                    if snapshot and checksum.hexdigest() != snapshot[filename]['sha256']:
+                        raise ValueError('content does not match snapshot')
+                    os.replace(path + '.part', path)
+                except self.upload_errors + (ValueError, zlib.error) as err:
+                    _warn('Failed to download {}: {}', filename, err)
+                    summary['failed'].append(filename)
+                    if os.path.exists(path + '.part'):
+                        os.remove(path + '.part')
+                    continue
+                finally:
+                    for key in needed[index]:
+                        if last_use[key] == index:
+                            fetched.pop(key, None)
+                summary['files'] += 1
+                summary['bytes'] += size
+                if on_file:
+                    on_file(path)
+        summary['seconds'] = time.time() - start
+        return summary
+
+
+class UploadPipeline:
+    """
+    Upload files while they are still being written. Files put on the pipeline wait in a bounded queue for one of
+    the backend's `concurrency` upload threads, so a producer which is faster than the uploads is held back rather
+    than queueing without limit
+
+    with UploadPipeline(backend, 'folder') as pipeline:
+        pipeline.put(filename)
+    pipeline.summary
+    """
+
+    def __init__(self, backend: CloudBackupInterface, folder: str = '', queue_size: int = None):
+        """
+        :param backend: storage backend to upload with
+        :param folder: (optional) Folder within the storage location to upload config_dir to
+        :param queue_size: (optional) Most files waiting to be uploaded. Defaults to twice the backend's concurrency
+        """
+        self.backend = backend
+        self.folder = folder
+        self.summary = {'files': 0, 'bytes': 0, 'skipped': 0, 'seconds': 0.0, 'failed': []}
+        self._upload_file = backend._upload_function()
+        self._queue = queue.Queue(maxsize=queue_size or 2 * backend.concurrency)
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._workers = [threading.Thread(target=self._work, name='upload_{}'.format(index))
+                         for index in range(backend.concurrency)]
+        for worker in self._workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _work(self):
+        while True:
+            filename = self._queue.get()
+            if filename is None:
+                return
+            try:
+                size = self._upload_file(filename, self.backend._remote_path(filename, self.folder))
+                with self._lock:
+                    self.summary['files'] += 1
+                    self.summary['bytes'] += size
+            except Exception as err:
+                # any failure is reported for the file rather than ending the worker, which would leave put and
+                # close waiting forever on the queue
+                _warn('Failed to upload {}: {}', filename, err)
+                with self._lock:
+                    self.summary['failed'].append(filename)
+
+    def put(self, filename: str):
+        """
+        Queue a file for upload, blocking while the queue is full
+        :param filename: Path of a file within the backend's config_dir
+        """
+        self._queue.put(filename)
+
+    def close(self) -> dict:
+        """
+        Wait for the queued files to be uploaded
+        :return: summary of the upload in the same form as `CloudBackupInterface.upload`
+        """
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self.summary['seconds'] = time.time() - self._start
+        return self.summary
@@ -6,12 +6,24 @@
 """
 import subprocess
 import os
+import re
 import sys
+import json
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+import requests
 
-DOCKER_CERT_PATH = "/tmp/certs"
+DOCKER_CERT_PATH = os.getenv('DOCKER_CERT_PATH', "/tmp/certs")
 DOCKER_CLIENT_TIMEOUT = 800
 COMPOSE_HTTP_TIMEOUT = 800
+LOAD_ITEM_KEY = 'system.cpu.util'
+DRAIN_GRACE_PERIOD = 30
+HEALTH_TIMEOUT = 60
+DOCKER_COMPOSE_BIN = os.getenv('DOCKER_COMPOSE_BIN',
+                               '/usr/local/bin/docker-compose')
+DOCKER_COMPOSE_DIR = os.getenv('DOCKER_COMPOSE_DIR', '/etc/docker')
 
 
 # logging
@@ -35,11 +47,111 @@ def _info(message, *args):
     __LOG.log(logging.INFO, message.format(*args))
 
 
+def _warn(message, *args):
+    __LOG.log(logging.WARN, message.format(*args))
+
+
 def _log_error_and_fail(message, *args):
     __LOG.log(logging.ERROR, message.format(*args))
     sys.exit(-1)
 
 
+_MEMORY_UNITS = {'': 1, 'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_memory(value):
+    """
+    convert a docker style memory size (E.g. 512m, 2g) to bytes
+    :param value: memory size as a string or number of bytes
+    :return: int
+    """
+    if value is None or isinstance(value, int):
+        return value
+    match = re.match(r'^(\d+)([bkmg]?)$', str(value).strip().lower())
+    if not match:
+        raise ValueError('Invalid memory size {}'.format(value))
+    return int(match.group(1)) * _MEMORY_UNITS[match.group(2)]
+
+
+class DockerEngineClient:
+    """
+    Minimal client for the parts of the Docker Engine API which docker-compose
+    doesn't give us access to
+    """
+
+    def __init__(self, data_center, cert_path=DOCKER_CERT_PATH,
+                 timeout=DOCKER_CLIENT_TIMEOUT):
+        """
+        :param data_center: The URL of the docker engine we want to connect to
+        :param cert_path: directory holding cert.pem, key.pem and ca.pem for
+                          engines protected with TLS
+        :param timeout: seconds to wait for the engine to respond
+        """
+        self.timeout = timeout
+        self.session = requests.Session()
+        cert = os.path.join(cert_path, 'cert.pem')
+        key = os.path.join(cert_path, 'key.pem')
+        scheme = 'http'
+        if os.path.isfile(cert) and os.path.isfile(key):
+            scheme = 'https'
+            self.session.cert = (cert, key)
+            ca = os.path.join(cert_path, 'ca.pem')
+            self.session.verify = ca if os.path.isfile(ca) else True
+        self.base_url = re.sub(r'^tcp://', scheme + '://', data_center)
+
+    def _request(self, method, path, **kwargs):
+        response = self.session.request(method, self.base_url + path,
+                                        timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response.json() if response.content else None
+
+    def containers(self, project, service=None, show_all=False):
+        """
+        list the containers docker-compose created for a project's service
+        :return: list of container summaries
+        """
+        labels = ['com.docker.compose.project={}'.format(project)]
+        if service:
+            labels.append('com.docker.compose.service={}'.format(service))
+        return self._request('GET', '/containers/json', params={
+            'all': int(show_all), 'filters': json.dumps({'label': labels})})
+
+    def inspect(self, container_id):
+        return self._request('GET', '/containers/{}/json'.format(container_id))
+
+    def update(self, container_id, **resources):
+        """
+        change the resource limits of a running container in place
+        :param resources: Engine API resource settings. E.g. Memory=536870912
+        """
+        return self._request('POST', '/containers/{}/update'.format(
+            container_id), json=resources)
+
+    def start(self, container_id):
+        return self._request('POST', '/containers/{}/start'.format(
+            container_id))
+
+    def stop(self, container_id, grace_period=None):
+        """
+        :param grace_period: seconds to wait for the container to exit after
+                             SIGTERM before it is killed
+        """
+        params = {} if grace_period is None else {'t': grace_period}
+        return self._request('POST', '/containers/{}/stop'.format(
+            container_id), params=params)
+
+    def stats(self, container_id):
+        """
+        a single sample of a container's resource usage
+        """
+        return self._request('GET', '/containers/{}/stats'.format(
+            container_id), params={'stream': 0})
+
+    def remove(self, container_id):
+        return self._request('DELETE', '/containers/{}'.format(container_id),
+                             params={'force': 1})
+
+
 class DockerAdmin:
     """
     Instance of a object for managing Docker containers
@@ -51,63 +163,430 @@ class DockerAdmin:
                  project,
                  service_name,
                  current_scale=None,
-                 delta=None):
+                 delta=None,
+                 timeout=COMPOSE_HTTP_TIMEOUT,
+                 memory_step=None,
+                 memory_limit=None,
+                 cpu_step=None,
+                 cpu_limit=None,
+                 warm_pool=0,
+                 scale_down_to_pool=False,
+                 victim_selection='newest',
+                 load_item_key=LOAD_ITEM_KEY,
+                 grace_period=DRAIN_GRACE_PERIOD,
+                 health_timeout=HEALTH_TIMEOUT,
+                 profiler=None):
         """
 
         :param zbx_client: instance of a Zabbix API client object
-        :param data_center: The URL of the docker engine we want to connect to
+        :param data_center: The URL, or list of URLs, of the docker engines we
+                            want to connect to
         :param project: the name of the project of which our container service
                         is part of
         :param service_name: service name of the containers to manage
         :param current_scale: the current number of running containers for the
                             given service
         :param delta: how much container resource we want to add or remove
+        :param timeout: seconds a command is allowed to run in each data center
+        :param memory_step: memory added or removed per step of delta when
+                            scaling vertically. E.g. 256m
+        :param memory_limit: most memory a container may be scaled to
+        :param cpu_step: CPUs added or removed per step of delta when scaling
+                         vertically. E.g. 0.5
+        :param cpu_limit: most CPUs a container may be scaled to
+        :param warm_pool: number of created but stopped containers to keep
+                          ready for scaling up
+        :param scale_down_to_pool: stop containers back into the warm pool
+                                   when scaling down instead of removing them
+        :param victim_selection: how containers to remove are chosen when
+                    scaling down. newest (the default) leaves the choice to
+                    docker-compose, stats picks the containers using least CPU
+                    according to the engine and zabbix the ones with the lowest
+                    value for load_item_key
+        :param load_item_key: key of the Zabbix item holding a container's load
+        :param grace_period: seconds a container is given to finish its work
+                             after being asked to stop
+        :param health_timeout: seconds to wait for the remaining containers to
+                               be healthy before removing any
+        :param profiler: (optional) concierge_profile.Profiler to record each
+                         step run in the data centers with
         """
         self.current_scale = current_scale
         self.delta = delta
         self.service_name = service_name
         self.project = project
-        self.data_center = data_center
+        self.data_centers = [data_center] if isinstance(data_center, str) \
+            else list(data_center)
+        self.timeout = timeout
         self.zbx_client = zbx_client
+        self.memory_step = parse_memory(memory_step)
+        self.memory_limit = parse_memory(memory_limit)
+        self.cpu_step = cpu_step
+        self.cpu_limit = cpu_limit
+        self.warm_pool = warm_pool
+        self.scale_down_to_pool = scale_down_to_pool
+        self.victim_selection = victim_selection
+        self.load_item_key = load_item_key
+        self.grace_period = grace_period
+        self.health_timeout = health_timeout
+        self.refills = []
+        self.profiler = profiler
         self.command_mapping = {
             'scale_up': self.scale_up,
             'scale_down': self.scale_down,
+            'scale_memory': self.scale_memory,
             'list': self.list
         }
-        self.service_cmd_template = \
-            '/usr/local/bin/docker-compose ' \
-            '--host={} ' \
-            '--file /etc/docker/{}/compose.yml '.format(
-                self.data_center, self.project)
+        self.service_cmd_templates = {
+            data_center:
+                '{} '
+                '--host={} '
+                '--file {}/{}/compose.yml '.format(
+                    DOCKER_COMPOSE_BIN, data_center, DOCKER_COMPOSE_DIR,
+                    self.project)
+            for data_center in self.data_centers
+        }
 
     def run(self, action):
         self.command_mapping[action]()
 
+    def wait_for_refill(self):
+        """
+        warm pools are refilled by a detached docker-compose process after
+        scaling, which the command doesn't wait for. Wait for them to be full
+        again
+        """
+        for data_center, refill in self.refills:
+            if refill.wait() != 0:
+                _warn('Failed to refill warm pool of {} in {}: exit code {}',
+                      self.service_name, data_center, refill.returncode)
+
+    def _run_in_data_center(self, data_center, command):
+        start = time.time()
+        result = subprocess.run(
+            str(self.service_cmd_templates[data_center] + command).split(),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, timeout=self.timeout, check=True)
+        _info('{} finished in {} after {:.2f}s', command, data_center,
+              time.time() - start)
+        return result.stdout
+
+    def _phase(self, name):
+        return self.profiler.phase(name) if self.profiler else nullcontext()
+
+    def _in_worker(self, func, data_center):
+        with self.profiler.worker() if self.profiler else nullcontext():
+            return func(data_center)
+
+    def in_data_centers(self, description, func):
+        """
+        call a function concurrently for each of our data centers.
+        Every data center is allowed to finish before any failure is reported.
+        With a profiler, this is a phase and the worker threads are profiled
+
+        :param description: what we're doing, for logging
+        :param func: callable taking the data center URL
+        :return: dict of data center URL to the function's result
+        """
+        results = {}
+        failures = {}
+        with self._phase(description), ThreadPoolExecutor(
+                max_workers=len(self.data_centers),
+                thread_name_prefix='dc') as executor:
+            futures = {executor.submit(self._in_worker, func, data_center):
+                       data_center for data_center in self.data_centers}
+            for future in as_completed(futures):
+                data_center = futures[future]
+                try:
+                    results[data_center] = future.result()
+                except (subprocess.TimeoutExpired, requests.Timeout):
+                    failures[data_center] = 'timed out after {}s'.format(
+                        self.timeout)
+                except subprocess.CalledProcessError as err:
+                    failures[data_center] = (err.stderr or str(err)).strip()
+                except (OSError, RuntimeError,
+                        requests.RequestException) as err:
+                    failures[data_center] = str(err)
+        for data_center, reason in sorted(failures.items()):
+            _warn('{} failed in {}: {}', description, data_center, reason)
+        if failures:
+            _log_error_and_fail(
+                '{} failed in {} of {} data centers: {}', description,
+                len(failures), len(self.data_centers),
+                ', '.join(sorted(failures)))
+        return results
+
+    def run_in_data_centers(self, command):
+        """
+        run a docker-compose command concurrently in all of our data centers
+
+        :param command: docker-compose command and arguments to run
+        :return: dict of data center URL to the command's output
+        """
+        return self.in_data_centers(
+            command,
+            lambda data_center: self._run_in_data_center(data_center, command))
+
+    def engine(self, data_center):
+        return DockerEngineClient(data_center, timeout=self.timeout)
+
     def scale_service(self, desired_scale):
+        self.run_in_data_centers('up -d --scale {}={} --no-recreate'.format(
+            self.service_name, desired_scale))
+        _info("Scaled {} from {} to {} in {} data centers".format(
+            self.service_name, self.current_scale, desired_scale,
+            len(self.data_centers)))
+
+    def _service_containers(self, engine):
+        containers = sorted(
+            engine.containers(self.project, self.service_name, show_all=True),
+            key=lambda c: c.get('Created', 0))
+        running = [c for c in containers if c['State'] == 'running']
+        pool = [c for c in containers if c['State'] != 'running']
+        return running, pool
+
+    def _start_refill(self, data_center, running):
+        """
+        create stopped containers until the warm pool is full again. This
+        runs docker-compose in its own session, so it carries on after the
+        command exits. Its output is discarded; a pool which wasn't refilled
+        is reported by the next scale up
+        :param running: number of containers running in the data center
+        """
+        command = 'up --no-start --scale {}={} --no-recreate'.format(
+            self.service_name, running + self.warm_pool)
         try:
-            subprocess.call(
-                str(self.service_cmd_template +
-                    'up -d --scale {}={} --no-recreate'.format(
-                        self.service_name, desired_scale)).split())
-        except subprocess.CalledProcessError as err:
-            _log_error_and_fail('docker-compose failed', err)
+            refill = subprocess.Popen(
+                str(self.service_cmd_templates[data_center] + command).split(),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                start_new_session=True)
+        except OSError as err:
+            _warn('Failed to refill warm pool of {} in {}: {}',
+                  self.service_name, data_center, err)
+            return
+        _info('Refilling warm pool of {} in {} in the background',
+              self.service_name, data_center)
+        self.refills.append((data_center, refill))
+
+    def _scale_up_from_pool(self, data_center):
+        engine = self.engine(data_center)
+        running, pool = self._service_containers(engine)
+        for container in pool[:self.delta]:
+            engine.start(container['Id'])
+        started = min(self.delta, len(pool))
+        if started < self.delta:
+            _warn('Warm pool of {} in {} only had {} containers',
+                  self.service_name, data_center, started)
+            self._run_in_data_center(
+                data_center, 'up -d --scale {}={} --no-recreate'.format(
+                    self.service_name, len(running) + self.delta))
+        self._start_refill(data_center, len(running) + self.delta)
+        return started
+
+    @staticmethod
+    def _cpu_percent(stats):
+        cpu_delta = stats['cpu_stats']['cpu_usage']['total_usage'] - \
+            stats['precpu_stats'].get('cpu_usage', {}).get('total_usage', 0)
+        system_delta = stats['cpu_stats'].get('system_cpu_usage', 0) - \
+            stats['precpu_stats'].get('system_cpu_usage', 0)
+        if system_delta <= 0:
+            return 0.0
+        cpus = stats['cpu_stats'].get('online_cpus') or 1
+        return cpu_delta / system_delta * cpus * 100
+
+    def _engine_loads(self, engine, containers):
+        with ThreadPoolExecutor(max_workers=max(1, len(containers)),
+                                thread_name_prefix='stats') as executor:
+            samples = executor.map(lambda c: engine.stats(c['Id']), containers)
+            return {container['Id']: self._cpu_percent(sample)
+                    for container, sample in zip(containers, samples)}
+
+    def _zabbix_loads(self, containers):
+        """
+        get the load of each container from Zabbix, asking only for the items of the hosts named after them
+        """
+        container_names = {container['Id']: [name.lstrip('/') for name in container.get('Names', [])] +
+                           [container['Id'][:12]] for container in containers}
+        hosts = self.zbx_client.host.get(
+            output=['hostid'],
+            filter={'host': [name for names in container_names.values() for name in names]})
+        if not hosts:
+            return {}
+        items = self.zbx_client.item.get(
+            output=['lastvalue'], selectHosts=['host'],
+            hostids=[host['hostid'] for host in hosts],
+            filter={'key_': self.load_item_key})
+        host_loads = {item['hosts'][0]['host']: float(item['lastvalue'])
+                      for item in items if item.get('hosts')}
+        loads = {}
+        for container_id, names in container_names.items():
+            for name in names:
+                if name in host_loads:
+                    loads[container_id] = host_loads[name]
+                    break
+        return loads
+
+    def _select_victims(self, engine, running):
+        """
+        choose which running containers to remove
+        :param running: running containers, oldest first
+        :return: list of containers
+        """
+        if not self.delta:
+            return []
+        if self.victim_selection == 'newest':
+            return running[-self.delta:]
+        if self.victim_selection == 'zabbix':
+            loads = self._zabbix_loads(running)
         else:
-            _info("Scaled {} from {} to {}".format(
-                self.service_name, self.current_scale, desired_scale))
+            loads = self._engine_loads(engine, running)
+        for container in running:
+            if container['Id'] not in loads:
+                _warn('No load found for container {}', container['Id'][:12])
+        # containers with no known load may be busy, so they are only chosen when there aren't enough others
+        victims = sorted(running, key=lambda c: loads.get(c['Id'], float('inf')))
+        _info('Least loaded containers are {}', ', '.join(
+            '{}={:.1f}'.format(c['Id'][:12], loads.get(c['Id'], float('inf')))
+            for c in victims[:self.delta]))
+        return victims[:self.delta]
+
+    def _wait_until_healthy(self, engine, containers):
+        """
+        wait for the containers which will take over the work to be healthy
+        :return: bool
+        """
+        deadline = time.time() + self.health_timeout
+        pending = [c['Id'] for c in containers]
+        while pending:
+            states = [engine.inspect(container_id)['State']
+                      for container_id in pending]
+            pending = [container_id for container_id, state
+                       in zip(pending, states)
+                       if not state.get('Running') or
+                       state.get('Health', {}).get('Status', 'healthy')
+                       != 'healthy']
+            if not pending:
+                return True
+            if time.time() > deadline:
+                return False
+            time.sleep(1)
+        return True
+
+    def _scale_down_with_engine(self, data_center):
+        engine = self.engine(data_center)
+        running, pool = self._service_containers(engine)
+        victims = self._select_victims(engine, running)
+        victim_ids = {c['Id'] for c in victims}
+        survivors = [c for c in running if c['Id'] not in victim_ids]
+        if not self._wait_until_healthy(engine, survivors):
+            raise RuntimeError('remaining containers not healthy after {}s'
+                               .format(self.health_timeout))
+        for container in victims:
+            engine.stop(container['Id'], self.grace_period)
+            if not self.scale_down_to_pool:
+                engine.remove(container['Id'])
+        if self.scale_down_to_pool:
+            pool = pool + victims
+            for container in pool[self.warm_pool:]:
+                engine.remove(container['Id'])
+        if self.warm_pool:
+            self._start_refill(data_center, len(survivors))
+        return len(victims)
 
     def scale_up(self):
         desired_scale = (self.current_scale + self.delta)
-        self.scale_service(desired_scale)
+        if not self.warm_pool:
+            return self.scale_service(desired_scale)
+        started = self.in_data_centers('scale up from warm pool',
+                                       self._scale_up_from_pool)
+        _info('Scaled {} from {} to {} in {} data centers, {} containers from'
+              ' the warm pool', self.service_name, self.current_scale,
+              desired_scale, len(self.data_centers), sum(started.values()))
 
     def scale_down(self):
         desired_scale = (self.current_scale - self.delta)
-        self.scale_service(desired_scale)
+        if not self.warm_pool and self.victim_selection == 'newest':
+            return self.scale_service(desired_scale)
+        self.in_data_centers('scale down', self._scale_down_with_engine)
+        _info('Scaled {} from {} to {} in {} data centers', self.service_name,
+              self.current_scale, desired_scale, len(self.data_centers))
+
+    def _scaled_resources(self, host_config):
+        """
+        work out the new resource limits for a container from its current ones
+        :param host_config: HostConfig of the inspected container
+        :return: dict of Engine API resource settings to update
+        """
+        resources = {}
+        if self.memory_step:
+            memory = host_config.get('Memory') or 0
+            if memory:
+                new_memory = max(self.memory_step,
+                                 memory + self.delta * self.memory_step)
+                if self.memory_limit:
+                    new_memory = min(new_memory, self.memory_limit)
+                resources['Memory'] = new_memory
+                swap = host_config.get('MemorySwap') or 0
+                if swap > 0:
+                    # keep the same amount of swap on top of the new limit
+                    resources['MemorySwap'] = new_memory + swap - memory
+        if self.cpu_step:
+            if host_config.get('CpuQuota'):
+                period = host_config.get('CpuPeriod') or 100000
+                cpus = host_config['CpuQuota'] / period
+            else:
+                period = None
+                cpus = (host_config.get('NanoCpus') or 0) / 1e9
+            if cpus:
+                new_cpus = max(self.cpu_step, cpus + self.delta * self.cpu_step)
+                if self.cpu_limit:
+                    new_cpus = min(new_cpus, self.cpu_limit)
+                if period:
+                    resources['CpuQuota'] = int(new_cpus * period)
+                else:
+                    resources['NanoCpus'] = int(new_cpus * 1e9)
+        return resources
+
+    def _scale_memory_in_data_center(self, data_center):
+        engine = self.engine(data_center)
+        updated = 0
+        for container in engine.containers(self.project, self.service_name):
+            host_config = engine.inspect(container['Id'])['HostConfig']
+            resources = self._scaled_resources(host_config)
+            if not resources:
+                _warn('Container {} in {} has no limits to scale from',
+                      container['Id'][:12], data_center)
+                continue
+            engine.update(container['Id'], **resources)
+            updated += 1
+            _info('Updated container {} in {} to {}', container['Id'][:12],
+                  data_center, resources)
+        return updated
+
+    def scale_memory(self):
+        """
+        vertically scale the memory, and optionally CPUs, of the running
+        containers of our service by delta steps, without restarting them
+        """
+        if not (self.memory_step or self.cpu_step):
+            _log_error_and_fail('A memory or CPU step is needed to scale {}',
+                                self.service_name)
+        updated = self.in_data_centers(
+            'scale memory', self._scale_memory_in_data_center)
+        _info('Scaled resources of {} containers of {} in {} data centers',
+              sum(updated.values()), self.service_name,
+              len(self.data_centers))
 
     def list(self):
         """
         provide a list of containers running in a given project
-        :return: list
+        :return: dict of data center URL to list of container IDs
         """
-        container_list = subprocess.call(
-            str(self.service_cmd_template + 'ps -q').split())
+        container_list = {
+            data_center: output.split()
+            for data_center, output in self.run_in_data_centers(
+                'ps -q').items()}
+        for data_center in self.data_centers:
+            print('# {}'.format(data_center))
+            print('\n'.join(container_list[data_center]))
         return container_list
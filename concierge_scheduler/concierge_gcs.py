@@ -1,19 +1,112 @@
+import base64
+import hashlib
 import json
 import os
+import re
+import tarfile
+import threading
+import time
+import logging
+import requests
+import google_crc32c
+from google.api_core import exceptions as google_exceptions
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage
+from google.cloud.storage.retry import DEFAULT_RETRY
 from google.oauth2 import service_account
-from concierge_cloud import CloudBackupInterface
+from concierge_cloud import CloudBackupInterface, UPLOAD_CONCURRENCY, UPLOAD_RETRIES
+
+ARCHIVE_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_SESSION_FILE = '~/.concierge_upload_sessions.json'
+# resumable upload chunks must be a multiple of 256 KiB
+_CHUNK_MULTIPLE = 256 * 1024
+# seconds to wait for each request of a resumable upload, the same deadline the client library gives its own retried
+# requests. A request which times out is retried with the rest of the upload by upload_file
+RESUMABLE_REQUEST_TIMEOUT = getattr(DEFAULT_RETRY, 'timeout', None) or DEFAULT_RETRY.deadline
+
+
+# logging
+def get_logger(name):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+
+    stream = logging.StreamHandler()
+    fmt = logging.Formatter('%(asctime)s [%(threadName)s] '
+                            '[%(name)s] %(levelname)s: %(message)s')
+    stream.setFormatter(fmt)
+    logger.addHandler(stream)
+
+    return logger
+
+
+__LOG = get_logger(__name__)
+
+
+def _info(message, *args):
+    __LOG.log(logging.INFO, message.format(*args))
+
+
+def _warn(message, *args):
+    __LOG.log(logging.WARN, message.format(*args))
+
+
+def file_checksums(filename: str) -> dict:
+    """
+    MD5 and CRC32C of a file, base64 encoded in the same way as GCS object metadata
+    :param filename: Path of local file
+    :return: dict with md5 and crc32c keys
+    """
+    md5 = hashlib.md5()
+    crc32c = google_crc32c.Checksum()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+            crc32c.update(chunk)
+    return {'md5': base64.b64encode(md5.digest()).decode(),
+            'crc32c': base64.b64encode(crc32c.digest()).decode()}
+
+
+class _CountingWriter:
+    """
+    Pass writes through to a file object, counting the bytes written
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        pass
 
 
 class GCSBackup(CloudBackupInterface):
+    upload_errors = (google_exceptions.GoogleAPIError, requests.RequestException, OSError)
 
-    def __init__(self, credential_file_path: str, config_dir: str, bucket: str):
+    def __init__(self, credential_file_path: str, config_dir: str, bucket: str,
+                 concurrency: int = UPLOAD_CONCURRENCY, retries: int = UPLOAD_RETRIES,
+                 chunk_size: int = UPLOAD_CHUNK_SIZE, session_file: str = UPLOAD_SESSION_FILE):
         """
         :param credential_file_path: Path to GCP service account credential file
         :param config_dir: Path to directory containing configuration files
         :param bucket: Name of the bucket upload files to
+        :param concurrency: Number of files to upload at the same time
+        :param retries: Number of times to retry a failed file upload
+        :param chunk_size: Size in bytes of each request of a resumable upload. Files larger than this are uploaded in
+            chunks and can be resumed. Rounded up to a multiple of 256 KiB
+        :param session_file: Local file recording resumable upload sessions, so that an interrupted upload continues
+            where it stopped when run again
         """
         self.credential = credential_file_path
+        self.concurrency = concurrency
+        self.retries = retries
+        self.chunk_size = max(1, -(-chunk_size // _CHUNK_MULTIPLE)) * _CHUNK_MULTIPLE
+        self.session_file = os.path.expanduser(session_file)
+        self._session_lock = threading.Lock()
         self._client = self.authenticate()
         self.config_dir = config_dir
         self.storage_location = bucket
@@ -25,8 +118,14 @@ class GCSBackup(CloudBackupInterface):
         with open(self.credential, 'r') as f:
             credential_file = json.load(f)
             if 'project_id' in credential_file:
-                storage_credentials = service_account.Credentials.from_service_account_info(credential_file)
-                return storage.Client(project=credential_file['project_id'], credentials=storage_credentials)
+                storage_credentials = service_account.Credentials.from_service_account_info(
+                    credential_file, scopes=storage.Client.SCOPE)
+                # one pooled connection per upload thread, shared by every upload
+                session = AuthorizedSession(storage_credentials)
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+                session.mount('https://', adapter)
+                return storage.Client(project=credential_file['project_id'], credentials=storage_credentials,
+                                      _http=session)
             else:
                 raise KeyError('Key "project_id" not found in credential file. Invalid credential File')
 
@@ -38,16 +137,197 @@ class GCSBackup(CloudBackupInterface):
                 config_files.add(os.path.join(root, file))
         return config_files
 
-    def upload(self, upload_list: set, folder: str = ''):
+    def _update_sessions(self, key: str, session: dict = None) -> dict:
+        """
+        Record, or forget when session is None, the resumable upload session for an object
+        :return: the sessions recorded before the update
+        """
+        with self._session_lock:
+            sessions = {}
+            if os.path.isfile(self.session_file):
+                with open(self.session_file, 'r') as f:
+                    sessions = json.load(f)
+            previous = dict(sessions)
+            if session:
+                sessions[key] = session
+            else:
+                sessions.pop(key, None)
+            if sessions != previous:
+                with open(self.session_file, 'w') as f:
+                    json.dump(sessions, f)
+            return previous
+
+    def _uploaded_bytes(self, url: str, size: int):
+        """
+        Ask GCS how much of a resumable upload it has persisted
+        :return: number of bytes persisted, size when the upload is complete or None when the session has expired
+        """
+        response = self._client._http.put(url, headers={'Content-Range': 'bytes */{}'.format(size),
+                                                        'Content-Length': '0'}, timeout=RESUMABLE_REQUEST_TIMEOUT)
+        if response.status_code in (200, 201):
+            return size
+        if response.status_code == 308:
+            match = re.match(r'bytes=0-(\d+)', response.headers.get('Range', ''))
+            return int(match.group(1)) + 1 if match else 0
+        if response.status_code in (404, 410):
+            return None
+        response.raise_for_status()
+        return None
+
+    def _resumable_upload(self, blob: storage.Blob, filename: str) -> int:
+        """
+        Upload a file in chunks of `self.chunk_size` through a resumable session. The session is recorded in
+        `self.session_file` so that an interrupted upload of the same, unchanged, file carries on from the last
+        chunk GCS has persisted
+        :return: number of bytes uploaded
+        """
+        size = os.path.getsize(filename)
+        key = '{}/{}'.format(self.storage_location, blob.name)
+        fingerprint = {'filename': os.path.abspath(filename), 'size': size, 'mtime': os.path.getmtime(filename)}
+        session = self._update_sessions(key).get(key)
+        offset = None
+        if session and all(session.get(k) == v for k, v in fingerprint.items()):
+            offset = self._uploaded_bytes(session['url'], size)
+            if offset is not None:
+                _info('Resuming upload of {} from byte {}', filename, offset)
+        if offset is None:
+            session = dict(fingerprint, url=blob.create_resumable_upload_session(size=size, client=self._client))
+            self._update_sessions(key, session)
+            offset = 0
+        with open(filename, 'rb') as f:
+            while offset < size:
+                f.seek(offset)
+                chunk = f.read(self.chunk_size)
+                end = offset + len(chunk) - 1
+                response = self._client._http.put(session['url'], data=chunk, headers={
+                    'Content-Range': 'bytes {}-{}/{}'.format(offset, end, size)}, timeout=RESUMABLE_REQUEST_TIMEOUT)
+                if response.status_code in (200, 201):
+                    offset = size
+                elif response.status_code == 308:
+                    match = re.match(r'bytes=0-(\d+)', response.headers.get('Range', ''))
+                    offset = int(match.group(1)) + 1 if match else 0
+                else:
+                    response.raise_for_status()
+        self._update_sessions(key)
+        return size
+
+    def upload_file(self, bucket: storage.Bucket, filename: str, remote_path: str) -> int:
+        """
+        Upload a single file, retrying failed attempts
+        :param bucket: Bucket to upload to
+        :param filename: Path of local file
+        :param remote_path: Name of the object to create
+        :return: number of bytes uploaded
         """
-        Upload files to bucket (`self._storage_location`)
+        for attempt in range(self.retries + 1):
+            try:
+                if os.path.getsize(filename) > self.chunk_size:
+                    return self._resumable_upload(bucket.blob(remote_path), filename)
+                bucket.blob(remote_path).upload_from_filename(filename)
+                return os.path.getsize(filename)
+            except (google_exceptions.GoogleAPIError, requests.RequestException) as err:
+                if attempt == self.retries:
+                    raise
+                _warn('Upload of {} failed, retrying ({}/{}): {}', filename, attempt + 1, self.retries, err)
+                time.sleep(2 ** attempt)
+
+    def _local_checksums(self, filename: str) -> dict:
+        return file_checksums(filename)
+
+    def _remote_checksums(self, folder: str, directory: str = None) -> dict:
+        prefix = os.path.join(folder, directory or os.path.basename(os.path.normpath(self.config_dir)), '')
+        bucket = self._client.get_bucket(self.storage_location)
+        return {blob.name: {'md5': blob.md5_hash, 'crc32c': blob.crc32c}
+                for blob in bucket.list_blobs(prefix=prefix)}
+
+    def _unchanged(self, local: dict, remote: dict) -> bool:
+        # composite objects only have a CRC32C
+        if remote.get('md5'):
+            return local['md5'] == remote['md5']
+        return local['crc32c'] == remote.get('crc32c')
+
+    def _put_object(self, name: str, data: bytes):
+        # snapshot objects are never changed once written, so retrying them is safe
+        self._client.bucket(self.storage_location).blob(name).upload_from_string(data, retry=DEFAULT_RETRY)
+
+    def _get_object(self, name: str) -> bytes:
+        return self._client.bucket(self.storage_location).blob(name).download_as_bytes()
+
+    def _list_objects(self, prefix: str) -> set:
+        return {blob.name for blob in self._client.list_blobs(self.storage_location, prefix=prefix)}
+
+    def _copy_object(self, source: str, name: str):
+        # large objects are rewritten over several calls
+        bucket = self._client.bucket(self.storage_location)
+        token, _, _ = bucket.blob(name).rewrite(bucket.blob(source))
+        while token:
+            token, _, _ = bucket.blob(name).rewrite(bucket.blob(source), token=token)
+
+    def upload(self, upload_list: set, folder: str = '', sync: bool = False, manifest: str = None) -> dict:
+        """
+        Upload files to bucket (`self._storage_location`), `self.concurrency` files at a time
         :param upload_list: set of files/directories to upload to bucket
         :param folder: (optional) Folder within bucket to upload config_dir to
+        :param sync: (optional) Only upload files which are new or differ from the stored objects
+        :param manifest: (optional) Local file recording what was stored by the last sync. When present, it is used
+            instead of listing the bucket
+        :return: summary of the upload with the number of files and bytes uploaded, files skipped, seconds taken and
+            failed files
+        """
+        return self._upload_files(self._upload_function(), upload_list, folder, sync, manifest)
+
+    def _upload_function(self):
+        bucket = self._client.get_bucket(self.storage_location)
+        return lambda filename, remote_path: self.upload_file(bucket, filename, remote_path)
+
+    def _stream_archive(self, blob: storage.Blob, upload_list: set, compression: str) -> int:
+        directory = os.path.basename(os.path.normpath(self.config_dir))
+        with blob.open('wb', chunk_size=ARCHIVE_CHUNK_SIZE, ignore_flush=True) as writer:
+            counter = _CountingWriter(writer)
+            if compression == 'zstd':
+                import zstandard
+                compressor = zstandard.ZstdCompressor().stream_writer(counter, closefd=False)
+                archive = tarfile.open(fileobj=compressor, mode='w|')
+            else:
+                compressor = None
+                archive = tarfile.open(fileobj=counter, mode='w|gz')
+            with archive:
+                for filename in sorted(upload_list):
+                    archive.add(filename, arcname=os.path.join(directory, os.path.relpath(filename, self.config_dir)),
+                                recursive=False)
+            if compressor:
+                compressor.close()
+        return counter.bytes
+
+    def upload_archive(self, upload_list: set, folder: str = '', compression: str = 'gzip') -> dict:
+        """
+        Stream files into a single compressed tar archive in the bucket, without writing it to disk first.
+        Paths within the archive are relative to the parent of config_dir
+        :param upload_list: set of files to add to the archive
+        :param folder: (optional) Folder within bucket to upload the archive to
+        :param compression: gzip or zstd (needs the zstandard package)
+        :return: summary of the upload in the same form as `upload`
         """
+        if compression not in ('gzip', 'zstd'):
+            raise ValueError('Unknown compression {}'.format(compression))
+        start = time.time()
         bucket = self._client.get_bucket(self.storage_location)
-        directory = os.path.basename(self.config_dir)
-        for filename in upload_list:
-            file = os.path.basename(filename)
-            remote_path = os.path.join(folder, directory, file)
-            blob = bucket.blob(remote_path)
-            blob.upload_from_filename(filename)
+        extension = 'tar.gz' if compression == 'gzip' else 'tar.zst'
+        remote_path = os.path.join(folder, '{}.{}'.format(os.path.basename(os.path.normpath(self.config_dir)),
+                                                         extension))
+        summary = {'files': 0, 'bytes': 0, 'skipped': 0, 'seconds': 0.0, 'failed': []}
+        for attempt in range(self.retries + 1):
+            try:
+                summary['bytes'] = self._stream_archive(bucket.blob(remote_path), upload_list, compression)
+                summary['files'] = len(upload_list)
+                break
+            except (google_exceptions.GoogleAPIError, requests.RequestException) as err:
+                if attempt == self.retries:
+                    _warn('Failed to upload archive {}: {}', remote_path, err)
+                    summary['failed'] = [remote_path]
+                    break
+                _warn('Upload of archive {} failed, retrying ({}/{}): {}', remote_path, attempt + 1, self.retries,
+                      err)
+                time.sleep(2 ** attempt)
+        summary['seconds'] = time.time() - start
+        return summary
@@ -0,0 +1,218 @@
+"""
+@author: Gareth Brown
+@contact: gareth@mesoform.com
+@date: 2017
+"""
+import threading
+import time
+import logging
+from contextlib import contextmanager
+import requests
+
+API_CONCURRENCY_FLOOR = 1
+API_CONCURRENCY_CEILING = 8
+# how many times slower than the fastest call seen a call may be before the window is cut
+API_LATENCY_TOLERANCE = 2.0
+# share of the window kept when it is cut
+API_BACKOFF = 0.5
+# configuration exports and imports cost the server many times more than a get
+API_WEIGHTS = {'configuration.export': 4, 'confimport': 4}
+# how quickly the fastest latency seen follows calls which are slower, so that it settles on what is normal for a
+# server rather than the one fastest call
+_BASELINE_DRIFT = 0.05
+# slowdowns smaller than this many seconds are jitter, however many times slower they are
+_MIN_SLOWDOWN = 0.05
+
+
+# logging
+def get_logger(name):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+
+    stream = logging.StreamHandler()
+    fmt = logging.Formatter('%(asctime)s [%(threadName)s] '
+                            '[%(name)s] %(levelname)s: %(message)s')
+    stream.setFormatter(fmt)
+    logger.addHandler(stream)
+
+    return logger
+
+
+__LOG = get_logger(__name__)
+
+
+def _info(message, *args):
+    __LOG.log(logging.INFO, message.format(*args))
+
+
+def is_overload(err):
+    """
+    :param err: exception raised by an API call
+    :return: whether the error shows the server is overloaded. I.e. a timeout or an HTTP 5xx response
+    """
+    if isinstance(err, requests.Timeout):
+        return True
+    response = getattr(err, 'response', None)
+    return isinstance(err, requests.HTTPError) and response is not None and response.status_code >= 500
+
+
+def call_kind(method, args, kwargs):
+    """
+    :param method: Zabbix API method called. E.g. configuration.export
+    :param args: positional arguments of the call
+    :param kwargs: keyword arguments of the call
+    :return: what the call works on, so that its latency is only compared with calls like it. The object types of a
+        configuration export, the size class of a configuration import, or '' for other methods, whose name already
+        says what they work on
+    """
+    if method == 'configuration.export':
+        return ','.join(sorted(kwargs.get('options', {})))
+    if method == 'confimport':
+        source = kwargs.get('source', args[1] if len(args) > 1 else '')
+        return 'up to {} KiB'.format(1 << (len(source) // 1024).bit_length())
+    return ''
+
+
+def parse_weights(weights):
+    """
+    :param weights: comma separated method=weight pairs. E.g. configuration.export=4,host.get=2
+    :return: dict of method to weight
+    """
+    parsed = {}
+    for pair in filter(None, (weights or '').split(',')):
+        method, separator, weight = pair.partition('=')
+        try:
+            weight = float(weight)
+        except ValueError:
+            weight = 0
+        if not separator or not method.strip() or weight <= 0:
+            raise ValueError('Invalid API weight {}. Expected method=weight, e.g. configuration.export=4'.format(
+                pair))
+        parsed[method.strip()] = weight
+    return parsed
+
+
+class AdaptiveLimiter:
+    """
+    Limit the calls in flight to a server with a window which adapts to how the server copes (AIMD). Each call
+    which completes without slowing down widens the window additively, by about one call per window of calls. A
+    call slower than `latency_tolerance` times the fastest seen for its kind, a timeout or an HTTP 5xx response
+    cuts the window by `backoff`, at most once for calls started under the same window. Calls take up their
+    method's weight of the window, so heavy calls like configuration exports leave room for fewer others
+    """
+
+    def __init__(self, floor=API_CONCURRENCY_FLOOR, ceiling=API_CONCURRENCY_CEILING, weights=None,
+                 latency_tolerance=API_LATENCY_TOLERANCE, backoff=API_BACKOFF):
+        """
+        :param floor: Smallest window. Calls up to this weight are always allowed in flight
+        :param ceiling: Largest window
+        :param weights: (optional) dict of method to weight, added to API_WEIGHTS. Other methods weigh 1
+        :param latency_tolerance: How many times slower than the fastest call of its method a call may be before the
+            window is cut
+        :param backoff: Share of the window kept when it is cut
+        """
+        if not 0 < floor <= ceiling:
+            raise ValueError('API concurrency floor must be at least 1 and no more than the ceiling')
+        self.floor = floor
+        self.ceiling = ceiling
+        self.weights = dict(API_WEIGHTS, **(weights or {}))
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.window = float(floor)
+        self.summary = {'calls': 0, 'cuts': 0, 'largest window': self.window}
+        self._in_flight = 0.0
+        self._baselines = {}
+        # incremented each time the window is cut, so that calls started before a cut don't cut it again
+        self._generation = 0
+        self._condition = threading.Condition()
+
+    def weight(self, method):
+        return self.weights.get(method, 1)
+
+    def acquire(self, weight):
+        """
+        Block until there is room in the window for a call of weight. A call is always allowed when nothing else is
+        in flight, however heavy
+        :return: token to pass to release
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: not self._in_flight or self._in_flight + weight <= self.window)
+            self._in_flight += weight
+            return self._generation
+
+    def release(self, method, weight, latency, overloaded, token, kind=''):
+        """
+        Make room for other calls and adjust the window to how the call went
+        :param method: Zabbix API method called. E.g. host.get
+        :param weight: weight the call was acquired with
+        :param latency: seconds the call took
+        :param overloaded: whether the call failed because the server is overloaded
+        :param token: returned by acquire
+        :param kind: (optional) what the call worked on, as returned by call_kind. Latencies are compared with calls
+            of the same method and kind, so that e.g. exporting all hosts isn't mistaken for a slowdown after
+            exporting a few host groups
+        """
+        key = '{}:{}'.format(method, kind) if kind else method
+        with self._condition:
+            self._in_flight -= weight
+            self.summary['calls'] += 1
+            baseline = self._baselines.get(key, latency)
+            slowed = latency > self.latency_tolerance * baseline and latency - baseline > _MIN_SLOWDOWN
+            if overloaded or slowed:
+                if token == self._generation:
+                    self._generation += 1
+                    self.window = max(float(self.floor), self.window * self.backoff)
+                    self.summary['cuts'] += 1
+                    _info('{} {} after {:.2f}s. Cut API window to {:.1f}', method,
+                          'failed' if overloaded else 'slowed', latency, self.window)
+            else:
+                self.window = min(float(self.ceiling), self.window + weight / self.window)
+                self.summary['largest window'] = max(self.summary['largest window'], self.window)
+            if not overloaded:
+                self._baselines[key] = latency if latency < baseline else \
+                    baseline + (latency - baseline) * _BASELINE_DRIFT
+            self._condition.notify_all()
+
+    @contextmanager
+    def limit(self, method, kind=''):
+        """
+        Make a call within the window
+        :param method: Zabbix API method being called. E.g. host.get
+        :param kind: (optional) what the call works on, as returned by call_kind
+        """
+        weight = self.weight(method)
+        token = self.acquire(weight)
+        start = time.time()
+        overloaded = False
+        try:
+            yield
+        except Exception as err:
+            overloaded = is_overload(err)
+            raise
+        finally:
+            self.release(method, weight, time.time() - start, overloaded, token, kind)
+
+
+class LimitedClient:
+    """
+    Zabbix API client which makes every call through an AdaptiveLimiter. E.g. client.host.get(output='extend') waits
+    for room in the limiter's window for host.get
+    """
+
+    def __init__(self, client, limiter, name=''):
+        """
+        :param client: Zabbix API client, or an object or method of one
+        :param limiter: AdaptiveLimiter shared by all calls to the server
+        :param name: name of the API object or method. E.g. host
+        """
+        self._client = client
+        self._limiter = limiter
+        self._name = name
+
+    def __getattr__(self, attr):
+        return LimitedClient(getattr(self._client, attr), self._limiter,
+                             '{}.{}'.format(self._name, attr) if self._name else attr)
+
+    def __call__(self, *args, **kwargs):
+        with self._limiter.limit(self._name, call_kind(self._name, args, kwargs)):
+            return self._client(*args, **kwargs)
@@ -0,0 +1,157 @@
+"""
+@author: Gareth Brown
+@contact: gareth@mesoform.com
+@date: 2017
+"""
+import cProfile
+import io
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+import logging
+from contextlib import contextmanager
+
+PROFILE_TOP = 25
+
+
+# logging
+def get_logger(name):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+
+    stream = logging.StreamHandler()
+    fmt = logging.Formatter('%(asctime)s [%(threadName)s] '
+                            '[%(name)s] %(levelname)s: %(message)s')
+    stream.setFormatter(fmt)
+    logger.addHandler(stream)
+
+    return logger
+
+
+__LOG = get_logger(__name__)
+
+
+def _info(message, *args):
+    __LOG.log(logging.INFO, message.format(*args))
+
+
+def _memory_snapshot():
+    # leave out the memory of the snapshots themselves
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+class _Phase:
+    def __init__(self, name):
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.start = time.time()
+        self.seconds = 0.0
+        self.peak = 0
+        self.memory_start = _memory_snapshot()
+        self.allocations = []
+        self.worker_profiles = []
+
+
+class Profiler:
+    """
+    Collect a CPU profile and memory allocation report for each phase of a command. Phases may be nested, in which
+    case CPU time and memory are counted in the innermost phase running, while wall time includes nested phases.
+    The thread which starts a phase is CPU profiled, as are other threads while they run work wrapped in worker()
+    """
+
+    def __init__(self):
+        self.phases = []
+        self._active = []
+        tracemalloc.start()
+
+    def start(self, name: str):
+        """
+        Start profiling a phase, pausing the phase currently running
+        :param name: Name of the phase. E.g. export templates
+        """
+        if self._active:
+            self._active[-1].profile.disable()
+            self._active[-1].peak = max(self._active[-1].peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        phase = _Phase(name)
+        self._active.append(phase)
+        phase.profile.enable()
+
+    def stop(self):
+        """
+        Stop profiling the phase currently running and carry on with the one it paused
+        """
+        phase = self._active.pop()
+        phase.profile.disable()
+        phase.seconds = time.time() - phase.start
+        phase.peak = max(phase.peak, tracemalloc.get_traced_memory()[1])
+        phase.allocations = _memory_snapshot().compare_to(phase.memory_start, 'lineno')[:PROFILE_TOP]
+        phase.memory_start = None
+        self.phases.append(phase)
+        tracemalloc.reset_peak()
+        if self._active:
+            self._active[-1].profile.enable()
+
+    @contextmanager
+    def phase(self, name: str):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    @contextmanager
+    def worker(self):
+        """
+        CPU profile the calling thread into the innermost phase running, for work a phase hands to other threads.
+        E.g. a thread pool. The thread's profile is merged into the phase's when it is written
+        """
+        phase = self._active[-1] if self._active else None
+        profile = cProfile.Profile()
+        if phase is not None:
+            try:
+                profile.enable()
+            except ValueError as err:
+                # from Python 3.12 only one profiler can be enabled at a time
+                _info('Not profiling {}: {}', threading.current_thread().name, err)
+                phase = None
+        try:
+            yield
+        finally:
+            if phase is not None:
+                profile.disable()
+                phase.worker_profiles.append(profile)
+
+    def write(self, output_dir: str):
+        """
+        Stop any phases still running and write a .pstats file of each phase, which can be read with pstats or
+        converted for viewing as a flame graph, and a report.txt summarising the time, peak memory, busiest functions
+        and largest allocations of every phase
+        :param output_dir: Directory to write the profile to
+        """
+        while self._active:
+            self.stop()
+        os.makedirs(output_dir, exist_ok=True)
+        report = io.StringIO()
+        report.write('{:<4} {:<32} {:>10} {:>12} {:>12}\n'.format('#', 'phase', 'wall (s)', 'profiled (s)',
+                                                                  'peak (MB)'))
+        details = io.StringIO()
+        for number, phase in enumerate(sorted(self.phases, key=lambda p: p.start), 1):
+            filename = '{:02d}-{}.pstats'.format(number, re.sub(r'[^\w.-]+', '_', phase.name))
+            stats = pstats.Stats(phase.profile, *phase.worker_profiles, stream=details)
+            stats.dump_stats(os.path.join(output_dir, filename))
+            report.write('{:<4} {:<32} {:>10.3f} {:>12.3f} {:>12.1f}\n'.format(
+                number, phase.name, phase.seconds, stats.total_tt, phase.peak / 1e6))
+            details.write('\n== {}. {} ({}) ==\n'.format(number, phase.name, filename))
+            stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+            details.write('Largest allocations still held at the end of the phase:\n')
+            for allocation in phase.allocations:
+                details.write('  {}\n'.format(allocation))
+        with open(os.path.join(output_dir, 'report.txt'), 'w') as f:
+            f.write(report.getvalue())
+            f.write(details.getvalue())
+        tracemalloc.stop()
+        _info('Profile written to {}', output_dir)
@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+"""
+@author: Gareth Brown
+@contact: gareth@mesoform.com
+@date: 2017
+
+Indexed record format for configuration backups.
+
+A backup file such as templates.json is stored as:
+    templates.records.gz: one JSON object per line, gzip compressed in independent blocks. The blocks are gzip
+        members, so the whole file can still be read with zcat
+    templates.index.json: where each record is, by block and offset, with its name, ID and hash, plus whatever is
+        needed to rebuild the original JSON document
+
+Any record can be read by decompressing only the block holding it.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+import logging
+
+RECORDS_FORMAT = 1
+RECORDS_SUFFIX = '.records.gz'
+INDEX_SUFFIX = '.index.json'
+RECORD_BLOCK_SIZE = 64 * 1024
+# keys holding the name and ID of an object, in order of preference. Configuration exports identify objects by
+# uuid, API objects by their ID
+_NAME_KEYS = ('template', 'host', 'name', 'description')
+_ID_KEYS = ('uuid', 'actionid', 'serviceid', 'proxyid', 'hostid', 'templateid', 'groupid', 'mediatypeid')
+_WHITESPACE = re.compile(r'\s*')
+
+
+# logging
+def get_logger(name):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+
+    stream = logging.StreamHandler()
+    fmt = logging.Formatter('%(asctime)s [%(threadName)s] '
+                            '[%(name)s] %(levelname)s: %(message)s')
+    stream.setFormatter(fmt)
+    logger.addHandler(stream)
+
+    return logger
+
+
+__LOG = get_logger(__name__)
+
+
+def _info(message, *args):
+    __LOG.log(logging.INFO, message.format(*args))
+
+
+def record_identity(record: dict) -> tuple:
+    """
+    :param record: Zabbix object
+    :return: tuple of the object's name and ID. Either may be None
+    """
+    name = next((record[key] for key in _NAME_KEYS if isinstance(record.get(key), str)), None)
+    record_id = next((record[key] for key in _ID_KEYS if key in record), None)
+    return name, record_id
+
+
+def record_hash(record: dict) -> str:
+    return hashlib.md5(json.dumps(record, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def records_path(path: str) -> str:
+    """
+    :param path: Path of a backup file in either format. E.g. data_dir/templates.json
+    :return: path without its suffix, which the files of the record format are named after. E.g. data_dir/templates
+    """
+    for suffix in (RECORDS_SUFFIX, INDEX_SUFFIX, '.json'):
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+class RecordWriter:
+    """
+    Write records, compressing them a block at a time, and index them when closed
+    """
+
+    def __init__(self, path: str, block_size: int = RECORD_BLOCK_SIZE):
+        """
+        :param path: Path to write the files to, without suffix. E.g. data_dir/templates
+        :param block_size: Uncompressed size of each compressed block. Reading a record decompresses at most one
+            block
+        """
+        self.path = records_path(path)
+        self.block_size = block_size
+        self.index = {'format': RECORDS_FORMAT, 'document': 'list', 'header': {}, 'sections': [], 'blocks': [],
+                      'records': []}
+        # an index left by an earlier backup would make the records look complete while they are being written
+        if os.path.exists(self.path + INDEX_SUFFIX):
+            os.remove(self.path + INDEX_SUFFIX)
+        self._file = open(self.path + RECORDS_SUFFIX, 'wb')
+        self._block = []
+        self._block_length = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # without an index the incomplete records are never read as a backup
+            self._file.close()
+
+    def write(self, record: dict, section: str = None):
+        """
+        :param record: Zabbix object
+        :param section: (optional) Section of a configuration export the object belongs to. E.g. templates
+        """
+        line = json.dumps(record).encode('utf-8') + b'\n'
+        name, record_id = record_identity(record)
+        if section is not None and section not in self.index['sections']:
+            self.index['sections'].append(section)
+        self.index['records'].append({'section': section, 'name': name, 'id': record_id,
+                                      'block': len(self.index['blocks']), 'offset': self._block_length,
+                                      'length': len(line), 'hash': record_hash(record)})
+        self._block.append(line)
+        self._block_length += len(line)
+        if self._block_length >= self.block_size:
+            self._write_block()
+
+    def _write_block(self):
+        if not self._block:
+            return
+        data = gzip.compress(b''.join(self._block), mtime=0)
+        self.index['blocks'].append([self._file.tell(), len(data)])
+        self._file.write(data)
+        self._block = []
+        self._block_length = 0
+
+    def close(self):
+        self._write_block()
+        self._file.close()
+        # the index is written last so that it only exists for complete records
+        with open(self.path + INDEX_SUFFIX, 'w') as f:
+            json.dump(self.index, f)
+
+
+class RecordReader:
+    """
+    Read records lazily. Only the index is held in memory
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: Path of the files, with or without suffix. E.g. data_dir/templates
+        """
+        self.path = records_path(path)
+        with open(self.path + INDEX_SUFFIX, 'r') as f:
+            self.index = json.load(f)
+        if self.index.get('format') != RECORDS_FORMAT:
+            raise ValueError('Unsupported record format {} in {}'.format(self.index.get('format'), self.path))
+        self._names = {}
+        for entry in self.index['records']:
+            self._names.setdefault(entry['name'], []).append(entry)
+
+    def __len__(self):
+        return len(self.index['records'])
+
+    def __iter__(self):
+        for section, record in self.items():
+            yield record
+
+    def _read_block(self, f, number: int) -> bytes:
+        offset, length = self.index['blocks'][number]
+        f.seek(offset)
+        return gzip.decompress(f.read(length))
+
+    def items(self, section: str = None, entries: list = None):
+        """
+        :param section: (optional) only read records of this section
+        :param entries: (optional) only read the records of these index entries
+        :return: generator of (section, record) tuples in the order they were written
+        """
+        entries = [entry for entry in (self.index['records'] if entries is None else entries)
+                   if section is None or entry['section'] == section]
+        with open(self.path + RECORDS_SUFFIX, 'rb') as f:
+            block_number, block = None, b''
+            for entry in entries:
+                if entry['block'] != block_number:
+                    block_number, block = entry['block'], self._read_block(f, entry['block'])
+                yield entry['section'], json.loads(block[entry['offset']:entry['offset'] + entry['length']])
+
+    def find(self, name: str, section: str = None) -> list:
+        """
+        :return: index entries of records with the given name
+        """
+        return [entry for entry in self._names.get(name, []) if section is None or entry['section'] == section]
+
+    def read(self, entry: dict) -> dict:
+        """
+        :param entry: index entry of a record
+        :return: the record
+        """
+        with open(self.path + RECORDS_SUFFIX, 'rb') as f:
+            block = self._read_block(f, entry['block'])
+        return json.loads(block[entry['offset']:entry['offset'] + entry['length']])
+
+    def get(self, name: str, section: str = None):
+        """
+        :param name: Name of the object. E.g. the host of a template
+        :param section: (optional) Section the object is in. E.g. templates
+        :return: the first record with the given name, or None
+        """
+        entries = self.find(name, section)
+        return self.read(entries[0]) if entries else None
+
+    def document(self, entries: list = None):
+        """
+        :param entries: (optional) only include the records of these index entries
+        :return: the JSON document the records were written from
+        """
+        if self.index['document'] == 'list':
+            return [record for section, record in self.items(entries=entries)]
+        export = dict(self.index['header'])
+        for section in self.index['sections']:
+            export[section] = []
+        for section, record in self.items(entries=entries):
+            export[section].append(record)
+        return {self.index['document']: export}
+
+
+class DocumentRecords(RecordReader):
+    """
+    Records of a JSON backup document held in memory, read in the same way as the record format
+    """
+
+    def __init__(self, document):
+        """
+        :param document: a list of API objects, or a configuration export. I.e. {"zabbix_export": {...}}
+        """
+        self.path = None
+        self.index = {'format': RECORDS_FORMAT, 'document': 'list', 'header': {}, 'sections': [], 'blocks': [],
+                      'records': []}
+        self._records = []
+        self._names = {}
+        for section, record in split_document(document, self.index):
+            name, record_id = record_identity(record)
+            entry = {'section': section, 'name': name, 'id': record_id, 'position': len(self._records)}
+            self.index['records'].append(entry)
+            self._names.setdefault(name, []).append(entry)
+            self._records.append(record)
+
+    def items(self, section: str = None, entries: list = None):
+        for entry in (self.index['records'] if entries is None else entries):
+            if section is None or entry['section'] == section:
+                yield entry['section'], self._records[entry['position']]
+
+    def read(self, entry: dict) -> dict:
+        return self._records[entry['position']]
+
+
+def split_document(document, index: dict):
+    """
+    Split a backup document into records, filling in what else is needed to rebuild it
+    :param document: a list of API objects, a configuration export. I.e. {"zabbix_export": {...}}, or None for a
+        component with no objects
+    :param index: index to record the kind of document, its header and sections in
+    :return: generator of (section, record) tuples
+    """
+    if document is None:
+        return
+    if isinstance(document, list):
+        for record in document:
+            yield None, record
+    elif isinstance(document, dict) and len(document) == 1:
+        root, export = next(iter(document.items()))
+        index['document'] = root
+        for key, value in export.items():
+            if isinstance(value, list):
+                index['sections'].append(key)
+                for record in value:
+                    yield key, record
+            else:
+                index['header'][key] = value
+    else:
+        raise ValueError('Expected a list or a configuration export')
+
+
+def iter_json_array(f, read_size: int = RECORD_BLOCK_SIZE):
+    """
+    Parse a JSON array from a file one element at a time. Only the element being parsed and what is left of the
+    last read are held in memory, however long the array is
+    :param f: text file positioned at the start of a JSON array. E.g. a services.json backup file
+    :param read_size: Number of characters to read from the file at a time
+    :return: generator of the elements of the array
+    """
+    decoder = json.JSONDecoder()
+    buffer, position = '', 0
+
+    def next_character():
+        # skip whitespace, reading more of the file as needed, and return the character after it
+        nonlocal buffer, position
+        while True:
+            position = _WHITESPACE.match(buffer, position).end()
+            if position < len(buffer):
+                return buffer[position]
+            buffer, position = f.read(read_size), 0
+            if not buffer:
+                raise ValueError('Unexpected end of file in JSON array')
+
+    if next_character() != '[':
+        raise ValueError('Expected a JSON array')
+    position += 1
+    if next_character() == ']':
+        return
+    while True:
+        next_character()
+        while True:
+            # an element is only complete once the , or ] after it has been read. Until then it may continue in the
+            # file, e.g. 12. followed by 5, which decodes as 12 on its own
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                element, end = None, None
+            if end is not None:
+                following = _WHITESPACE.match(buffer, end).end()
+                if following < len(buffer) and buffer[following] in ',]':
+                    break
+            more = f.read(max(read_size, len(buffer) - position))
+            if not more:
+                if end is None:
+                    raise ValueError('Invalid JSON array element: {:.80}'.format(buffer[position:]))
+                break
+            buffer, position = buffer[position:] + more, 0
+        yield element
+        position = end
+        separator = next_character()
+        position += 1
+        if separator == ']':
+            return
+        if separator != ',':
+            raise ValueError('Expected , or ] after JSON array element, not {}'.format(separator))
+
+
+def write_records(path: str, document, block_size: int = RECORD_BLOCK_SIZE):
+    """
+    Write a backup document as records
+    :param path: Path to write the files to, with or without suffix. E.g. data_dir/templates
+    :param document: a list of API objects, or a configuration export. I.e. {"zabbix_export": {...}}
+    """
+    with RecordWriter(path, block_size) as writer:
+        for section, record in split_document(document, writer.index):
+            writer.write(record, section)
+
+
+def json_to_records(json_file: str) -> str:
+    """
+    Convert a backup file to records
+    :param json_file: Path of JSON backup file. E.g. data_dir/templates.json
+    :return: path of the records, without suffix
+    """
+    with open(json_file, 'r') as f:
+        document = json.load(f)
+    write_records(json_file, document)
+    return records_path(json_file)
+
+
+def records_to_json(path: str) -> str:
+    """
+    Convert records back to a JSON backup file
+    :param path: Path of the records, with or without suffix
+    :return: path of the JSON file
+    """
+    json_file = records_path(path) + '.json'
+    with open(json_file, 'w') as f:
+        json.dump(RecordReader(path).document(), f)
+    return json_file
+
+
+def convert_backup(data_dir: str, to_format: str) -> list:
+    """
+    Convert every backup file in a directory
+    :param data_dir: directory of a backup
+    :param to_format: records or json
+    :return: list of files written
+    """
+    converted = []
+    for filename in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, filename)
+        if to_format == 'records' and filename.endswith('.json') and not filename.endswith(INDEX_SUFFIX):
+            try:
+                converted.append(json_to_records(path))
+            except ValueError as err:
+                _info('Skipping {}: {}', path, err)
+        elif to_format == 'json' and filename.endswith(INDEX_SUFFIX):
+            converted.append(records_to_json(path))
+    return converted
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Convert and inspect backups in the indexed record format')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert_parser = subparsers.add_parser('convert', help='convert all backup files in a directory')
+    convert_parser.add_argument('data_dir', help='directory of a backup')
+    convert_parser.add_argument('--to', choices=('records', 'json'), required=True, help='format to convert to')
+    list_parser = subparsers.add_parser('list', help='list the records of a backup file')
+    list_parser.add_argument('path', help='backup file in record format. E.g. data_dir/templates')
+    get_parser = subparsers.add_parser('get', help='print one record of a backup file')
+    get_parser.add_argument('path', help='backup file in record format. E.g. data_dir/templates')
+    get_parser.add_argument('name', help='name of the object. E.g. the host of a template')
+    get_parser.add_argument('--section', help='section of a configuration export. E.g. templates')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    cmd_args = arg_parser()
+    if cmd_args.command == 'convert':
+        for converted_file in convert_backup(cmd_args.data_dir, cmd_args.to):
+            _info('Converted {}', converted_file)
+    elif cmd_args.command == 'list':
+        for index_entry in RecordReader(cmd_args.path).index['records']:
+            print('{}\t{}\t{}\t{}'.format(index_entry['section'] or '', index_entry['name'], index_entry['id'],
+                                          index_entry['hash']))
+    else:
+        found = RecordReader(cmd_args.path).get(cmd_args.name, cmd_args.section)
+        if found is None:
+            sys.exit('{} not found in {}'.format(cmd_args.name, cmd_args.path))
+        print(json.dumps(found, indent=2))
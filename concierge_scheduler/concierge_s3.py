@@ -0,0 +1,142 @@
+import hashlib
+import os
+import boto3
+import botocore.session
+from boto3.exceptions import Boto3Error
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from concierge_cloud import CloudBackupInterface, UPLOAD_CONCURRENCY, UPLOAD_RETRIES
+
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')
+AWS_PROFILE = os.getenv('AWS_PROFILE')
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# S3 doesn't accept multipart upload parts smaller than 5 MiB
+_MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def file_etag(filename: str, part_size: int) -> str:
+    """
+    The ETag S3 gives an object uploaded from a file. Files smaller than part_size are uploaded whole and have the
+    MD5 of their content. Others are uploaded in parts and have the MD5 of the parts' MD5s followed by the number of
+    parts
+    :param filename: Path of local file
+    :param part_size: Size of the parts of a multipart upload
+    :return: str
+    """
+    if os.path.getsize(filename) < part_size:
+        with open(filename, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+    digests = []
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(part_size), b''):
+            digests.append(hashlib.md5(chunk).digest())
+    return '{}-{}'.format(hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+
+
+class S3Backup(CloudBackupInterface):
+    # upload_file raises S3UploadFailedError, a Boto3Error, rather than the ClientError behind it
+    upload_errors = (Boto3Error, BotoCoreError, ClientError, OSError)
+
+    def __init__(self, credential_file_path: str, config_dir: str, bucket: str,
+                 concurrency: int = UPLOAD_CONCURRENCY, retries: int = UPLOAD_RETRIES,
+                 chunk_size: int = UPLOAD_CHUNK_SIZE, endpoint_url: str = S3_ENDPOINT_URL):
+        """
+        :param credential_file_path: Path to AWS shared credentials file
+        :param config_dir: Path to directory containing configuration files
+        :param bucket: Name of the bucket upload files to
+        :param concurrency: Number of files, and parts of each large file, to upload at the same time
+        :param retries: Number of times to retry a failed request
+        :param chunk_size: Files larger than this are uploaded in parts of this size. At least 5 MiB
+        :param endpoint_url: URL of an S3 compatible service, such as MinIO. Defaults to AWS
+        """
+        self.credential = credential_file_path
+        self.concurrency = concurrency
+        self.retries = retries
+        self.chunk_size = max(chunk_size, _MIN_PART_SIZE)
+        self.endpoint_url = endpoint_url
+        self._client = self.authenticate()
+        self.config_dir = config_dir
+        self.storage_location = bucket
+        self._transfer_config = TransferConfig(multipart_threshold=self.chunk_size,
+                                               multipart_chunksize=self.chunk_size,
+                                               max_concurrency=self.concurrency)
+
+    def authenticate(self):
+        """
+        :return: boto3 S3 client
+        """
+        core_session = botocore.session.Session(profile=AWS_PROFILE)
+        core_session.set_config_variable('credentials_file', os.path.expanduser(self.credential))
+        session = boto3.session.Session(botocore_session=core_session)
+        # each of the files uploading at once can have `concurrency` parts in flight
+        config = Config(max_pool_connections=self.concurrency * self.concurrency,
+                        retries={'max_attempts': self.retries + 1, 'mode': 'standard'})
+        return session.client('s3', endpoint_url=self.endpoint_url, config=config)
+
+    def assemble_upload_list(self) -> set:
+        assert os.path.isdir(self.config_dir)
+        config_files = set()
+        for root, dirs, files in os.walk(self.config_dir):
+            for file in files:
+                config_files.add(os.path.join(root, file))
+        return config_files
+
+    def upload_file(self, filename: str, remote_path: str) -> int:
+        """
+        Upload a single file, in concurrent parts when it is larger than `self.chunk_size`
+        :param filename: Path of local file
+        :param remote_path: Key of the object to create
+        :return: number of bytes uploaded
+        """
+        self._client.upload_file(filename, self.storage_location, remote_path, Config=self._transfer_config)
+        return os.path.getsize(filename)
+
+    def _local_checksums(self, filename: str) -> dict:
+        return {'etag': file_etag(filename, self.chunk_size)}
+
+    def _remote_checksums(self, folder: str, directory: str = None) -> dict:
+        prefix = os.path.join(folder, directory or os.path.basename(os.path.normpath(self.config_dir)), '')
+        objects = {}
+        for page in self._client.get_paginator('list_objects_v2').paginate(Bucket=self.storage_location,
+                                                                            Prefix=prefix):
+            for item in page.get('Contents', []):
+                objects[item['Key']] = {'etag': item['ETag'].strip('"')}
+        return objects
+
+    def _unchanged(self, local: dict, remote: dict) -> bool:
+        return local['etag'] == remote.get('etag')
+
+    def _put_object(self, name: str, data: bytes):
+        self._client.put_object(Bucket=self.storage_location, Key=name, Body=data)
+
+    def _get_object(self, name: str) -> bytes:
+        return self._client.get_object(Bucket=self.storage_location, Key=name)['Body'].read()
+
+    def _list_objects(self, prefix: str) -> set:
+        names = set()
+        for page in self._client.get_paginator('list_objects_v2').paginate(Bucket=self.storage_location,
+                                                                            Prefix=prefix):
+            names.update(item['Key'] for item in page.get('Contents', []))
+        return names
+
+    def _copy_object(self, source: str, name: str):
+        # copied in parts like an upload, so the copy has the ETag the local file is compared with
+        self._client.copy({'Bucket': self.storage_location, 'Key': source}, self.storage_location, name,
+                          Config=self._transfer_config)
+
+    def upload(self, upload_list: set, folder: str = '', sync: bool = False, manifest: str = None) -> dict:
+        """
+        Upload files to bucket (`self._storage_location`), `self.concurrency` files at a time
+        :param upload_list: set of files/directories to upload to bucket
+        :param folder: (optional) Folder within bucket to upload config_dir to
+        :param sync: (optional) Only upload files which are new or differ from the stored objects
+        :param manifest: (optional) Local file recording what was stored by the last sync. When present, it is used
+            instead of listing the bucket
+        :return: summary of the upload with the number of files and bytes uploaded, files skipped, seconds taken and
+            failed files
+        """
+        return self._upload_files(self._upload_function(), upload_list, folder, sync, manifest)
+
+    def _upload_function(self):
+        return self.upload_file
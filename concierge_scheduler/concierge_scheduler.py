@@ -6,24 +6,60 @@
 """
 import os
 import sys
+import json
+import time
+import atexit
 import logging
 import argparse
 import urllib3
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pyzabbix import ZabbixAPI
-from concierge_docker import DockerAdmin
-from concierge_zabbix import ZabbixAdmin
+from concierge_docker import DockerAdmin, COMPOSE_HTTP_TIMEOUT, \
+    LOAD_ITEM_KEY, DRAIN_GRACE_PERIOD, HEALTH_TIMEOUT
+from concierge_zabbix import ZabbixAdmin, ExportStore, RESTORE_ORDER, SELECTABLE_COMPONENTS, IMPORT_BATCH_SIZE, \
+    parse_selectors
+from concierge_cloud import FileArrivals, UploadPipeline
+from concierge_limiter import AdaptiveLimiter, API_CONCURRENCY_FLOOR, API_CONCURRENCY_CEILING, API_WEIGHTS, \
+    parse_weights
+from concierge_profile import Profiler
 from concierge_gcs import GCSBackup
+try:
+    from concierge_s3 import S3Backup
+except ImportError:
+    # boto3 is only needed for S3 storage
+    S3Backup = None
 
 __DEFAULT_CONFIG_DIR = os.getenv('ZBX_CONFIG_DIR') or os.path.abspath(__file__)
 STORAGE_LOCATION = os.getenv('STORAGE_LOCATION', '')
 STORAGE_FOLDER = os.getenv('STORAGE_FOLDER', '')
+UPLOAD_CONCURRENCY = int(os.getenv('UPLOAD_CONCURRENCY', 8))
+UPLOAD_RETRIES = int(os.getenv('UPLOAD_RETRIES', 3))
+UPLOAD_MANIFEST = os.getenv('UPLOAD_MANIFEST')
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 8))
+UPLOAD_SESSION_FILE = os.getenv('UPLOAD_SESSION_FILE', '~/.concierge_upload_sessions.json')
+SNAPSHOT_NAME = os.getenv('SNAPSHOT_NAME')
+PROFILE_DIR = os.getenv('PROFILE_DIR')
 GCP_CREDENTIAL_FILE = os.getenv('GCP_CREDENTIAL_FILE') or '~/.config/gcloud/application_default_credentials.json'
 AWS_CREDENTIAL_FILE = os.getenv('AWS_CREDENTIAL_FILE') or '~/.aws/credentials'
 ZBX_API_HOST = os.getenv('ZBX_API_HOST', 'zabbix-web')
 ZBX_API_USER = os.getenv('ZBX_API_USER', 'Admin')
 ZBX_API_PASS = os.getenv('ZBX_API_PASS', 'zabbix')
 ZBX_TLS_VERIFY = os.getenv('ZBX_TLS_VERIFY', 'True')
+ZBX_API_TIMEOUT = float(os.getenv('ZBX_API_TIMEOUT', 0)) or None
+ZBX_API_MIN_CONCURRENCY = int(os.getenv('ZBX_API_MIN_CONCURRENCY', API_CONCURRENCY_FLOOR))
+ZBX_API_MAX_CONCURRENCY = int(os.getenv('ZBX_API_MAX_CONCURRENCY', API_CONCURRENCY_CEILING))
+ZBX_API_WEIGHTS = os.getenv('ZBX_API_WEIGHTS', '')
 ZBX_FORCE_TEMPLATES = os.getenv('ZBX_FORCE_TEMPLATES', 'False')
+ZBX_SERVERS_FILE = os.getenv('ZBX_SERVERS_FILE')
+BACKUP_WORKERS = int(os.getenv('BACKUP_WORKERS', 4))
+ZBX_SOURCE_API_HOST = os.getenv('ZBX_SOURCE_API_HOST')
+ZBX_SOURCE_API_USER = os.getenv('ZBX_SOURCE_API_USER', 'Admin')
+ZBX_SOURCE_API_PASS = os.getenv('ZBX_SOURCE_API_PASS', 'zabbix')
+ZBX_BACKUP_FORMAT = os.getenv('ZBX_BACKUP_FORMAT', 'json')
+ZBX_IMPORT_BATCH_SIZE = int(os.getenv('ZBX_IMPORT_BATCH_SIZE', IMPORT_BATCH_SIZE))
+DOCKER_DATACENTERS_FILE = os.getenv('DOCKER_DATACENTERS_FILE', '/etc/docker/datacenters.json')
+DOCKER_WARM_POOL = int(os.getenv('DOCKER_WARM_POOL', 0))
+DOCKER_DATACENTER_TIMEOUT = int(os.getenv('DOCKER_DATACENTER_TIMEOUT', COMPOSE_HTTP_TIMEOUT))
 zbx_client = object
 zbx_admin = object
 
@@ -34,7 +70,8 @@ event_administrators = {
     'zabbix': ZabbixAdmin
 }
 cloud_administrators = {
-    'gcp': GCSBackup
+    'gcp': GCSBackup,
+    'aws': S3Backup
 }
 credential_files = {
     'gcp': GCP_CREDENTIAL_FILE,
@@ -53,11 +90,23 @@ def arg_parser():
         c_parser = parser.add_parser(
             'container',
             help='commands to control our container management system')
+        dc_group = c_parser.add_mutually_exclusive_group(required=True)
+        dc_group.add_argument(
+            '-u', '--datacenter-url', action='append',
+            help='url endpoint of the Docker API for the services to be'
+                 ' managed. Repeat to run the command in several data centers')
+        dc_group.add_argument(
+            '-g', '--datacenter-group',
+            help='name of a group of data center urls defined in'
+                 ' --datacenter-config')
         c_parser.add_argument(
-            '-u', '--datacenter-url',
-            help='(required) url endpoint of the Docker '
-                 ' API for the services to be managed',
-            required=True)
+            '--datacenter-config',
+            help='JSON file mapping data center group names to lists of urls',
+            default=DOCKER_DATACENTERS_FILE)
+        c_parser.add_argument(
+            '-t', '--datacenter-timeout', type=int,
+            help='seconds a command may take in each data center',
+            default=DOCKER_DATACENTER_TIMEOUT)
         c_parser.add_argument(
             '-p', '--project',
             help='(required) project namespace of services to be managed',
@@ -77,16 +126,119 @@ def arg_parser():
         )
         e_parser.add_argument('--force-templates', action='store_true', default=ZBX_FORCE_TEMPLATES,
                               help='Forces template configuration to delete all current existing templates')
+        e_parser.add_argument(
+            '--backup-format', choices=('json', 'records'), default=ZBX_BACKUP_FORMAT,
+            help='json: one JSON file for each component.\n'
+                 'records: an indexed, compressed record for each object, which can be read on its own.\n'
+                 'DEFAULT=json'
+        )
+        e_parser.add_argument(
+            '--import-batch-size', type=int, default=ZBX_IMPORT_BATCH_SIZE,
+            help='Number of services, proxies or actions created with each API request by restore_config.\n'
+                 'DEFAULT={}'.format(IMPORT_BATCH_SIZE)
+        )
+        e_parser.add_argument(
+            '--api-min-concurrency', type=int, default=ZBX_API_MIN_CONCURRENCY,
+            help='Fewest Zabbix API calls allowed in flight, however slow the server gets. DEFAULT={}'.format(
+                API_CONCURRENCY_FLOOR)
+        )
+        e_parser.add_argument(
+            '--api-max-concurrency', type=int, default=ZBX_API_MAX_CONCURRENCY,
+            help='Most Zabbix API calls allowed in flight. Calls in flight are widened towards this while\n'
+                 'the server keeps up and cut back when it slows down. DEFAULT={}'.format(API_CONCURRENCY_CEILING)
+        )
+        e_parser.add_argument(
+            '--api-weights', default=ZBX_API_WEIGHTS,
+            help='Comma separated method=weight pairs, giving how many calls each call of method counts as.\n'
+                 'Added to: {}'.format(','.join('{}={}'.format(method, weight)
+                                              for method, weight in API_WEIGHTS.items()))
+        )
+        e_parser.add_argument(
+            '--only', action='append', metavar='COMPONENT:GLOB',
+            help='With restore_config, only restore objects of COMPONENT with names matching GLOB, and what they\n'
+                 'depend on. Repeat to select more. COMPONENT is one of:\n{}.\n'
+                 "E.g. --only 'templates:Template App *' --only 'hosts:web-*'".format(
+                     ', '.join(SELECTABLE_COMPONENTS))
+        )
+        e_parser.add_argument(
+            '--from-cloud', action='store_true',
+            help='With restore_config, download the backup from cloud storage into --config-dir, importing each'
+                 ' file as soon as it arrives'
+        )
+        e_parser.add_argument(
+            '--upload', action='store_true',
+            help='With backup_config, upload each file to cloud storage as soon as it has been written'
+        )
+        e_parser.add_argument(
+            '--storage-location',
+            help='With --from-cloud or --upload, remote storage location name/url the backup is stored in',
+            default=STORAGE_LOCATION
+        )
+        e_parser.add_argument(
+            '--storage-folder',
+            help='With --from-cloud or --upload, folder in storage location the backup is stored in',
+            default=STORAGE_FOLDER
+        )
+        e_parser.add_argument(
+            '--snapshot-name',
+            help='With --from-cloud, name of the snapshot or uploaded config directory to restore.'
+                 ' DEFAULT=name of --config-dir',
+            default=SNAPSHOT_NAME
+        )
+        e_parser.add_argument(
+            '--concurrency', type=int,
+            help='With --from-cloud or --upload, number of objects to download or upload at the same time',
+            default=UPLOAD_CONCURRENCY
+        )
+        e_parser.add_argument(
+            '--retries', type=int,
+            help='With --upload, number of times to retry uploading a file',
+            default=UPLOAD_RETRIES
+        )
+        e_parser.add_argument(
+            '--servers-file',
+            help='With backup_config, JSON file listing several Zabbix servers to back up, each into its own\n'
+                 'subdirectory of --config-dir. E.g.\n'
+                 '{"servers": [{"name": "eu", "host": "https://zabbix-eu/", "user": "Admin",'
+                 ' "password": "/run/secrets/eu"}]}',
+            default=ZBX_SERVERS_FILE
+        )
+        e_parser.add_argument(
+            '--workers', type=int,
+            help='With --servers-file, number of servers to back up at the same time. DEFAULT=4',
+            default=BACKUP_WORKERS
+        )
+        e_parser.add_argument(
+            '--source-host',
+            help='With migrate, url of the Zabbix API to copy configuration from',
+            default=ZBX_SOURCE_API_HOST
+        )
+        e_parser.add_argument(
+            '--source-user',
+            help='With migrate, user to log in to the source Zabbix API with',
+            default=ZBX_SOURCE_API_USER
+        )
+        e_parser.add_argument(
+            '--source-pass',
+            help='With migrate, password, or file containing the password, of --source-user',
+            default=ZBX_SOURCE_API_PASS
+        )
         return e_parser.add_argument(
             'command', choices=('backup_config', 'restore_config',
-                                'get_simple_id_map'),
+                                'get_simple_id_map', 'migrate', 'verify'),
             help='\nbackup_config:\n'
                  'backup the event managers configuration.\n'
                  'restore_config:\n'
                  'restore the event managers configuration.\n'
                  'get_simple_id_map:\n'
                  'create a simple JSON file of the IDs to names of hostgroups'
-                 ' and templates')
+                 ' and templates\n'
+                 'migrate:\n'
+                 'copy the configuration of the --source-host server to this one, without'
+                 ' staging it on disk\n'
+                 'verify:\n'
+                 'compare the server with the ID file of the backup in --config-dir, listing\n'
+                 'missing, extra and differing objects. Exits non-zero if there are any')
 
     def add_cloud_parser(parser):
         cl_parser = parser.add_parser(
@@ -106,10 +258,62 @@ def arg_parser():
             help='Folder in storage location to upload files to',
             default=STORAGE_FOLDER
         )
+        cl_parser.add_argument(
+            '--concurrency', type=int,
+            help='Number of files to upload at the same time',
+            default=UPLOAD_CONCURRENCY
+        )
+        cl_parser.add_argument(
+            '--retries', type=int,
+            help='Number of times to retry uploading a file',
+            default=UPLOAD_RETRIES
+        )
+        cl_parser.add_argument(
+            '--chunk-size', type=int,
+            help='Size in MiB of each request when uploading large files. Files larger than this are uploaded in'
+                 ' resumable chunks. DEFAULT=8',
+            default=UPLOAD_CHUNK_SIZE
+        )
+        cl_parser.add_argument(
+            '--session-file',
+            help='File recording resumable uploads, so that an interrupted upload is continued by the next run',
+            default=UPLOAD_SESSION_FILE
+        )
+        cl_parser.add_argument(
+            '--sync', action='store_true',
+            help='Only upload files which are new or differ from those already in the storage folder'
+        )
+        cl_parser.add_argument(
+            '--manifest',
+            help='With --sync, local file recording what has been uploaded. When it exists the storage location is'
+                 ' not listed',
+            default=UPLOAD_MANIFEST
+        )
+        cl_parser.add_argument(
+            '--mode', choices=('files', 'archive'),
+            help='files: upload each file as an object, keeping paths relative to the config directory.\n'
+                 'archive: stream the config directory into one compressed tar object. DEFAULT=files',
+            default='files'
+        )
+        cl_parser.add_argument(
+            '--compression', choices=('gzip', 'zstd'),
+            help='Compression of the archive in archive mode. zstd needs the zstandard package. DEFAULT=gzip',
+            default='gzip'
+        )
+        cl_parser.add_argument(
+            '--snapshot-name',
+            help='Name of the snapshot to store with the snapshot command, or of the snapshot or uploaded config'
+                 ' directory to fetch with the download command. DEFAULT=name of the config directory',
+            default=SNAPSHOT_NAME
+        )
         return cl_parser.add_argument(
-            'command', choices='upload',
+            'command', choices=('upload', 'snapshot', 'download'),
             help='\nupload:\n'
                  'upload config files to cloud storage\n'
+                 'snapshot:\n'
+                 'store config files as a deduplicated snapshot, uploading only content not already stored\n'
+                 'download:\n'
+                 'download a snapshot or uploaded config files into the config directory\n'
         )
 
     def add_container_list_parser(parser):
@@ -136,6 +340,10 @@ def arg_parser():
             '-s', '--scale-delta', type=int, default=None,
             help='(required) the number of containers we want to add or remove',
             required=True)
+        cs_parser.add_argument(
+            '--warm-pool', type=int, default=DOCKER_WARM_POOL,
+            help='number of stopped containers to keep ready for scaling up.'
+                 ' DEFAULT=0 (no warm pool)')
         return cs_parser.add_subparsers(
             help='horizontally scale up or down the number of containers; or'
                  ' vertically scale the memory of the containers',
@@ -150,10 +358,46 @@ def arg_parser():
             'scale_down', aliases=['down'],
             help='horizontally scale service by removing containers.')
         down_parser.set_defaults(command='scale_down')
+        down_parser.add_argument(
+            '--to-pool', action='store_true',
+            help='stop removed containers back into the warm pool instead of'
+                 ' deleting them')
+        down_parser.add_argument(
+            '--victim-selection', choices=('newest', 'stats', 'zabbix'),
+            default='newest',
+            help='how to choose the containers to remove. newest: let'
+                 ' docker-compose decide; stats: least CPU used according to'
+                 ' the Docker engine; zabbix: lowest value of --load-item-key.'
+                 ' DEFAULT=newest')
+        down_parser.add_argument(
+            '--load-item-key', default=LOAD_ITEM_KEY,
+            help='Zabbix item key holding the load of each container.'
+                 ' DEFAULT={}'.format(LOAD_ITEM_KEY))
+        down_parser.add_argument(
+            '--grace-period', type=int, default=DRAIN_GRACE_PERIOD,
+            help='seconds a container has to finish its work after being'
+                 ' asked to stop. DEFAULT={}'.format(DRAIN_GRACE_PERIOD))
+        down_parser.add_argument(
+            '--health-timeout', type=int, default=HEALTH_TIMEOUT,
+            help='seconds to wait for the remaining containers to be healthy'
+                 ' before removing any. DEFAULT={}'.format(HEALTH_TIMEOUT))
         mem_parser = parser.add_parser(
             'memory', help='vertically scale the amount of memory for our '
                            'service. (EXPERIMENTAL)')
         mem_parser.set_defaults(command='scale_memory')
+        mem_parser.add_argument(
+            '--memory-step', default='256m',
+            help='memory added or removed for each step of --scale-delta.'
+                 ' Use a negative delta to remove memory. DEFAULT=256m')
+        mem_parser.add_argument(
+            '--memory-limit', default=None,
+            help='most memory a container may be given. E.g. 4g')
+        mem_parser.add_argument(
+            '--cpu-step', type=float, default=None,
+            help='CPUs added or removed for each step of --scale-delta')
+        mem_parser.add_argument(
+            '--cpu-limit', type=float, default=None,
+            help='most CPUs a container may be given')
 
     root_parser = argparse.ArgumentParser(
         description='Script to construct and automate common actions on an'
@@ -169,9 +413,19 @@ def arg_parser():
         default='docker')
     root_parser.add_argument(
         '--cloud-engine',
-        help='cloud engine used for cloud functionality. DEFAULT=gcp',
+        help='cloud engine used for cloud functionality. gcp for Cloud Storage or aws for S3 compatible storage.'
+             ' DEFAULT=gcp',
         default='gcp'
     )
+    root_parser.add_argument(
+        '--profile', action='store_true',
+        help='record CPU profiles and memory allocation reports of each phase'
+             ' of the command')
+    root_parser.add_argument(
+        '--profile-dir', default=PROFILE_DIR,
+        help='directory to write --profile output to. DEFAULT=next to'
+             ' --config-dir, named <config dir>-profile, or'
+             ' concierge_profile_<time> in the working directory')
 
     mgmt_parser = \
         root_parser.add_subparsers(help='management system to control')
@@ -218,33 +472,287 @@ def __log_error_and_fail(message, *args):
     sys.exit(-1)
 
 
-def process_password():
-    password = ZBX_API_PASS
-    if os.path.isfile(ZBX_API_PASS):
-        with open(ZBX_API_PASS, 'r') as f:
+def process_password(password=ZBX_API_PASS):
+    """
+    :param password: password, or path of a file containing it
+    :return: str
+    """
+    if os.path.isfile(password):
+        with open(password, 'r') as f:
             password = f.readline().strip()
     return password
 
 
-def initiate_zabbix_client():
+def get_data_centers(args):
+    """
+    work out which data centers a container command should run in
+    :param args: parsed container command arguments
+    :return: list of data center urls
+    """
+    if args.datacenter_url:
+        return args.datacenter_url
+    try:
+        with open(args.datacenter_config, 'r') as f:
+            groups = json.load(f)['groups']
+    except (OSError, ValueError, KeyError) as err:
+        __log_error_and_fail('Unable to read data center groups from {}: {}',
+                             args.datacenter_config, err)
+    if args.datacenter_group not in groups:
+        __log_error_and_fail('Data center group {} not found in {}',
+                             args.datacenter_group, args.datacenter_config)
+    if not groups[args.datacenter_group]:
+        __log_error_and_fail('Data center group {} in {} has no data centers',
+                             args.datacenter_group, args.datacenter_config)
+    return groups[args.datacenter_group]
+
+
+def get_servers(args):
+    """
+    read the Zabbix servers to back up from the servers file
+    :param args: parsed event command arguments
+    :return: list of dicts of server name, host, user and password
+    """
+    try:
+        with open(args.servers_file, 'r') as f:
+            servers = json.load(f)['servers']
+    except (OSError, ValueError, KeyError) as err:
+        __log_error_and_fail('Unable to read servers from {}: {}', args.servers_file, err)
+    names = [server.get('name') for server in servers]
+    if not all(names) or len(set(names)) != len(names) or not all(server.get('host') for server in servers):
+        __log_error_and_fail('Each server in {} needs a host and a unique name', args.servers_file)
+    return [{'name': server['name'], 'host': server['host'], 'user': server.get('user', ZBX_API_USER),
+             'password': server.get('password', ZBX_API_PASS)} for server in servers]
+
+
+def get_limiter(args):
+    """
+    :param args: parsed event command arguments
+    :return: AdaptiveLimiter for the Zabbix API calls to one server
+    """
+    try:
+        return AdaptiveLimiter(args.api_min_concurrency, args.api_max_concurrency, parse_weights(args.api_weights))
+    except ValueError as err:
+        __log_error_and_fail(str(err))
+
+
+def get_cloud_admin(cloud_engine, config_dir, storage_location, **options):
+    """
+    create an authenticated instance of a cloud storage backend
+    :param cloud_engine: name of the cloud engine. E.g. gcp
+    :param config_dir: directory containing the configuration files
+    :param storage_location: bucket to store files in
+    :param options: options of the backend, such as concurrency
+    :return: object
+    """
+    __info('Connecting to {}...', cloud_engine)
+    if cloud_administrators.get(cloud_engine) is None:
+        __log_error_and_fail('Cloud engine {} is not available', cloud_engine)
+    if cloud_engine != 'gcp':
+        options.pop('session_file', None)
+    cloud_admin = cloud_administrators[cloud_engine](credential_files[cloud_engine], config_dir, storage_location,
+                                                     **options)
+    __info('Authenticated with {}', cloud_engine)
+    return cloud_admin
+
+
+def get_profile_dir(args):
+    """
+    work out where to write profiles of a command
+    :param args: parsed command arguments
+    :return: path of directory
+    """
+    if args.profile_dir:
+        return args.profile_dir
+    if getattr(args, 'config_dir', None):
+        return '{}-profile'.format(os.path.normpath(args.config_dir))
+    return os.path.abspath('concierge_profile_{}'.format(time.strftime('%Y%m%d%H%M%S')))
+
+
+def get_selectors(args):
+    """
+    :param args: parsed event command arguments
+    :return: dict of component to globs of objects to restore, or None to restore everything
+    """
+    if not args.only:
+        return None
+    try:
+        return parse_selectors(args.only)
+    except ValueError as err:
+        __log_error_and_fail(str(err))
+
+
+def restore_from_cloud(client, args, profiler=None):
+    """
+    restore configuration from a backup in cloud storage. The files are downloaded into the config directory in the
+    order they are imported, and each import starts as soon as its file has arrived
+    :param client: Zabbix API client
+    :param args: parsed event command arguments
+    :param profiler: (optional) Profiler recording the phases of the restore
+    """
+    selectors = get_selectors(args)
+    cloud_admin = get_cloud_admin(args.cloud_engine, args.config_dir, args.storage_location,
+                                  concurrency=args.concurrency)
+    name = args.snapshot_name or os.path.basename(os.path.normpath(args.config_dir))
+    arrivals = FileArrivals()
+
+    def download():
+        try:
+            return cloud_admin.download(args.storage_folder, name, args.config_dir, on_file=arrivals.arrived,
+                                        order=RESTORE_ORDER)
+        finally:
+            arrivals.finish()
+
+    __info('Restoring {} from {} ...', name, args.storage_location)
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='download') as executor:
+        download_future = executor.submit(download)
+        event_administrators[args.event_engine](client, args.config_dir, args.force_templates,
+                                                wait_for_file=arrivals.wait, profiler=profiler,
+                                                backup_format=args.backup_format, selectors=selectors,
+                                                import_batch_size=args.import_batch_size,
+                                                limiter=get_limiter(args)).run('restore_config')
+        summary = download_future.result()
+    __info('Downloaded {} files, {:.1f} MB in {:.1f}s', summary['files'], summary['bytes'] / 1e6,
+           summary['seconds'])
+    if summary['failed']:
+        __log_error_and_fail('Failed to download {}', ', '.join(summary['failed']))
+
+
+def migrate(source_client, target_client, args, profiler=None):
+    """
+    copy configuration from one server to another without staging it on disk. The source server is exported in
+    another thread, in the order the target imports it, and the target imports each component as soon as it has
+    been exported, so the migration takes about as long as the slower of the two servers
+    :param source_client: Zabbix API client of the server to copy from
+    :param target_client: Zabbix API client of the server to copy to
+    :param args: parsed event command arguments
+    :param profiler: (optional) Profiler recording the phases of the import
+    """
+    selectors = get_selectors(args)
+    store = ExportStore()
+    event_admin = event_administrators[args.event_engine]
+
+    def export():
+        try:
+            event_admin(source_client, args.config_dir, args.force_templates, export_store=store,
+                        limiter=get_limiter(args)).run('migrate_export')
+        finally:
+            store.finish()
+
+    __info('Migrating configuration from {} ...', args.source_host)
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='export') as executor:
+        export_future = executor.submit(export)
+        try:
+            event_admin(target_client, args.config_dir, args.force_templates, profiler=profiler,
+                        selectors=selectors, import_batch_size=args.import_batch_size,
+                        export_store=store, limiter=get_limiter(args)).run('restore_config')
+        except FileNotFoundError:
+            # the export failed before writing what the import needed. Raise the export's error instead
+            export_future.result()
+            raise
+        export_future.result()
+    __info('Migrated configuration from {} in {:.1f}s', args.source_host, time.time() - start)
+
+
+def backup_servers(args):
+    """
+    backup several servers concurrently, `args.workers` at a time, each into a subdirectory of the config directory
+    named after the server. With --upload, the files of every server are uploaded through one cloud client as soon
+    as they have been written. Every server is allowed to finish before any failure is reported
+    :param args: parsed event command arguments
+    """
+    servers = get_servers(args)
+    pipeline = None
+    if args.upload:
+        cloud_admin = get_cloud_admin(args.cloud_engine, args.config_dir, args.storage_location,
+                                      concurrency=args.concurrency, retries=args.retries)
+        pipeline = UploadPipeline(cloud_admin, args.storage_folder)
+
+    def backup(server):
+        client = initiate_zabbix_client(server['host'], server['user'], server['password'])
+        event_administrators[args.event_engine](client, os.path.join(args.config_dir, server['name']),
+                                                args.force_templates,
+                                                on_file_written=pipeline.put if pipeline else None,
+                                                backup_format=args.backup_format,
+                                                limiter=get_limiter(args)).run('backup_config')
+
+    __info('Backing up {} servers, {} at a time ...', len(servers), args.workers)
+    failures = {}
+    summary = None
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='backup') as executor:
+            futures = {executor.submit(backup, server): server['name'] for server in servers}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    __info('Backed up {}', futures[future])
+                except SystemExit as err:
+                    # the backup has already logged why it stopped
+                    failures[futures[future]] = 'exited with code {}'.format(err.code)
+                except Exception as err:
+                    failures[futures[future]] = str(err) or repr(err)
+    finally:
+        if pipeline:
+            summary = pipeline.close()
+    for name, reason in sorted(failures.items()):
+        __warn('Backup failed for {}: {}', name, reason)
+    errors = []
+    if summary:
+        __info('Uploaded {} files, {:.1f} MB in {:.1f}s', summary['files'], summary['bytes'] / 1e6,
+               summary['seconds'])
+        if summary['failed']:
+            errors.append('Failed to upload {}'.format(', '.join(sorted(summary['failed']))))
+    if failures:
+        errors.append('Backup failed for {} of {} servers: {}'.format(len(failures), len(servers),
+                                                                      ', '.join(sorted(failures))))
+    if errors:
+        __log_error_and_fail('{}', '. '.join(errors))
+
+
+def backup_and_upload(client, args, profiler=None):
+    """
+    backup configuration and upload it to cloud storage in one pass. Each file is queued for upload as soon as it
+    has been exported, so uploads overlap with the rest of the export
+    :param client: Zabbix API client
+    :param args: parsed event command arguments
+    :param profiler: (optional) Profiler recording the phases of the backup
+    """
+    cloud_admin = get_cloud_admin(args.cloud_engine, args.config_dir, args.storage_location,
+                                  concurrency=args.concurrency, retries=args.retries)
+    __info('Backing up and uploading to {} ...', args.storage_location)
+    with UploadPipeline(cloud_admin, args.storage_folder) as pipeline:
+        event_administrators[args.event_engine](client, args.config_dir, args.force_templates,
+                                                on_file_written=pipeline.put, profiler=profiler,
+                                                backup_format=args.backup_format,
+                                                limiter=get_limiter(args)).run('backup_config')
+    summary = pipeline.summary
+    __info('Uploaded {} files, {:.1f} MB in {:.1f}s', summary['files'], summary['bytes'] / 1e6, summary['seconds'])
+    if summary['failed']:
+        __log_error_and_fail('Failed to upload {}', ', '.join(sorted(summary['failed'])))
+
+
+def initiate_zabbix_client(host=ZBX_API_HOST, user=ZBX_API_USER, password=ZBX_API_PASS):
     """
     create an instance of Zabbix API client
+    :param host: url of the Zabbix API
+    :param user: user to log in with
+    :param password: password, or path of a file containing it
     :return: object
     """
-    __info('Logging in using url={} ...', ZBX_API_HOST)
+    __info('Logging in using url={} ...', host)
     tls_verify = ZBX_TLS_VERIFY.lower() != 'false'
     detect_version = True
     if not tls_verify:
         __warn('TLS Verification disabled, HTTPS requests to host are unverified')
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-        if ZBX_API_HOST.startswith('https'):
+        if host.startswith('https'):
             # TODO: detect_version is set to false to avoid SSL errors before authentication.
             #  Issue with pyzabbix https://github.com/lukecyca/pyzabbix/issues/157 is pending release.
             #  After new release, detect_version can be removed from this code
             detect_version = False
-    client = ZabbixAPI(ZBX_API_HOST, detect_version=detect_version)
+    client = ZabbixAPI(host, detect_version=detect_version, timeout=ZBX_API_TIMEOUT)
     client.session.verify = tls_verify
-    client.login(user=ZBX_API_USER, password=process_password())
+    client.login(user=user, password=process_password(password))
     __info('Connected to Zabbix API Version {}', client.api_version())
     return client
 
@@ -252,31 +760,110 @@ def initiate_zabbix_client():
 if __name__ == '__main__':
     # Capture arguments passed to module
     cmd_args = arg_parser()
+    profiler = None
+    if cmd_args.profile:
+        profiler = Profiler()
+        # written however the command ends, including on failure
+        atexit.register(profiler.write, get_profile_dir(cmd_args))
+        profiler.start(cmd_args.command)
     container_admin = container_administrators[cmd_args.container_engine]
-    if cmd_args.event_engine == 'zabbix' and cmd_args.command != 'upload':
+    # with a servers file, each server is logged in to by backup_servers
+    backup_servers_file = cmd_args.command == 'backup_config' and cmd_args.servers_file
+    if cmd_args.event_engine == 'zabbix' and cmd_args.command not in ['upload', 'snapshot', 'download'] \
+            and not backup_servers_file:
         zbx_client = initiate_zabbix_client()
     event_admin = event_administrators[cmd_args.event_engine]
 
     if cmd_args.command in ['scale_up', 'scale_down']:
-        container_admin(zbx_client, cmd_args.datacenter_url, cmd_args.project,
-                        cmd_args.service_name, cmd_args.current_scale,
-                        cmd_args.scale_delta).run(cmd_args.command)
+        container_admin(zbx_client, get_data_centers(cmd_args),
+                        cmd_args.project, cmd_args.service_name,
+                        cmd_args.current_scale, cmd_args.scale_delta,
+                        cmd_args.datacenter_timeout,
+                        warm_pool=cmd_args.warm_pool,
+                        scale_down_to_pool=getattr(cmd_args, 'to_pool', False),
+                        victim_selection=getattr(cmd_args, 'victim_selection',
+                                                 'newest'),
+                        load_item_key=getattr(cmd_args, 'load_item_key',
+                                              LOAD_ITEM_KEY),
+                        grace_period=getattr(cmd_args, 'grace_period',
+                                             DRAIN_GRACE_PERIOD),
+                        health_timeout=getattr(cmd_args, 'health_timeout',
+                                               HEALTH_TIMEOUT),
+                        profiler=profiler).run(cmd_args.command)
+    elif cmd_args.command in ['scale_memory']:
+        container_admin(zbx_client, get_data_centers(cmd_args),
+                        cmd_args.project, cmd_args.service_name,
+                        cmd_args.current_scale, cmd_args.scale_delta,
+                        cmd_args.datacenter_timeout,
+                        memory_step=cmd_args.memory_step,
+                        memory_limit=cmd_args.memory_limit,
+                        cpu_step=cmd_args.cpu_step,
+                        cpu_limit=cmd_args.cpu_limit,
+                        profiler=profiler).run(cmd_args.command)
     elif cmd_args.command in ['list']:
-        container_admin(zbx_client, cmd_args.datacenter_url,
-                        cmd_args.project,
-                        cmd_args.service_name).run(cmd_args.command)
+        container_admin(zbx_client, get_data_centers(cmd_args),
+                        cmd_args.project, cmd_args.service_name,
+                        timeout=cmd_args.datacenter_timeout,
+                        profiler=profiler).run(cmd_args.command)
     elif cmd_args.command in ['backup_config', 'restore_config',
-                              'get_simple_id_map']:
+                              'get_simple_id_map', 'migrate', 'verify']:
         force_templates = False if ZBX_FORCE_TEMPLATES.upper() == "FALSE" else cmd_args.force_templates
-        event_admin(zbx_client, cmd_args.config_dir, cmd_args.force_templates).run(cmd_args.command)
-    elif cmd_args.command in ['upload']:
-        __info('Connecting to {}...', cmd_args.cloud_engine)
-        cloud_admin = cloud_administrators[cmd_args.cloud_engine](
-            credential_files[cmd_args.cloud_engine], cmd_args.config_dir, cmd_args.storage_location)
-        __info('Authenticated with {}', cmd_args.cloud_engine)
+        if backup_servers_file:
+            backup_servers(cmd_args)
+        elif cmd_args.command == 'migrate':
+            if not cmd_args.source_host:
+                __log_error_and_fail('migrate needs --source-host or ZBX_SOURCE_API_HOST')
+            migrate(initiate_zabbix_client(cmd_args.source_host, cmd_args.source_user, cmd_args.source_pass),
+                    zbx_client, cmd_args, profiler)
+        elif cmd_args.from_cloud and cmd_args.command == 'restore_config':
+            restore_from_cloud(zbx_client, cmd_args, profiler)
+        elif cmd_args.upload and cmd_args.command == 'backup_config':
+            backup_and_upload(zbx_client, cmd_args, profiler)
+        else:
+            event_admin(zbx_client, cmd_args.config_dir, cmd_args.force_templates,
+                        profiler=profiler, backup_format=cmd_args.backup_format,
+                        selectors=get_selectors(cmd_args),
+                        import_batch_size=cmd_args.import_batch_size,
+                        limiter=get_limiter(cmd_args)).run(cmd_args.command)
+    elif cmd_args.command in ['download']:
+        cloud_admin = get_cloud_admin(cmd_args.cloud_engine, cmd_args.config_dir, cmd_args.storage_location,
+                                      concurrency=cmd_args.concurrency, retries=cmd_args.retries)
+        name = cmd_args.snapshot_name or os.path.basename(os.path.normpath(cmd_args.config_dir))
+        summary = cloud_admin.download(cmd_args.storage_folder, name, cmd_args.config_dir)
+        __info('Downloaded {} files, {:.1f} MB in {:.1f}s', summary['files'], summary['bytes'] / 1e6,
+               summary['seconds'])
+        if summary['failed']:
+            __log_error_and_fail('Failed to download {}', ', '.join(summary['failed']))
+    elif cmd_args.command in ['upload', 'snapshot']:
+        cloud_admin = get_cloud_admin(cmd_args.cloud_engine, cmd_args.config_dir, cmd_args.storage_location,
+                                      concurrency=cmd_args.concurrency, retries=cmd_args.retries,
+                                      chunk_size=cmd_args.chunk_size * 1024 * 1024,
+                                      session_file=cmd_args.session_file)
         upload_list = cloud_admin.assemble_upload_list()
         __info('Uploading {} to {} ...', upload_list, cmd_args.storage_location)
-        cloud_admin.upload(upload_list=upload_list, folder=cmd_args.storage_folder)
+        if cmd_args.command == 'snapshot':
+            summary = cloud_admin.upload_snapshot(upload_list=upload_list, folder=cmd_args.storage_folder,
+                                                  name=cmd_args.snapshot_name)
+            __info('Stored {} files in {} chunks, {} already stored. Uploaded {:.1f} MB in {:.1f}s',
+                   summary['files'], summary['chunks'], summary['skipped'], summary['bytes'] / 1e6,
+                   summary['seconds'])
+        else:
+            if cmd_args.mode == 'archive':
+                if not hasattr(cloud_admin, 'upload_archive'):
+                    __log_error_and_fail('Archive mode is not supported by {}', cmd_args.cloud_engine)
+                if cmd_args.sync:
+                    __warn('--sync is ignored in archive mode')
+                summary = cloud_admin.upload_archive(upload_list=upload_list, folder=cmd_args.storage_folder,
+                                                     compression=cmd_args.compression)
+            else:
+                summary = cloud_admin.upload(upload_list=upload_list, folder=cmd_args.storage_folder,
+                                             sync=cmd_args.sync, manifest=cmd_args.manifest)
+            __info('Uploaded {} files, {:.1f} MB in {:.1f}s ({:.2f} MB/s). {} unchanged files skipped, {} of them'
+                   ' copied from an earlier upload', summary['files'], summary['bytes'] / 1e6, summary['seconds'],
+                   summary['bytes'] / 1e6 / max(summary['seconds'], 1e-6), summary['skipped'],
+                   summary.get('copied', 0))
+        if summary['failed']:
+            __log_error_and_fail('Failed to upload {}', ', '.join(sorted(summary['failed'])))
         __info('Finished uploading files.')
 
     else:
@@ -5,16 +5,66 @@
 @date: 2017
 """
 from pyzabbix import ZabbixAPIException
+import fnmatch
+import io
 import json
 import os
+import re
 import sys
+import threading
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import hashlib
+from contextlib import nullcontext
+from concierge_limiter import LimitedClient
+from concierge_records import RecordReader, DocumentRecords, iter_json_array, write_records, RECORDS_SUFFIX, \
+    INDEX_SUFFIX
 
 _ORIGINAL_IDS_FILE = 'id_map_backup.json'
 _TRIGGER_ACTIONS_FILE = 'trigger_actions.json'
 _REG_ACTIONS_FILE = 'reg_actions.json'
+# components in the order restore_config imports them, which is also the order they are exported in, so that each
+# can be imported as soon as it has arrived. Components are exported as a configuration export of the API object
+# with the export option, as API objects, or for actions, as the actions of the event source
+EXPORTS = {
+    'hostgroups': {'label': 'hostgroups', 'api_name': 'hostgroup', 'id': 'groupid', 'option': 'groups'},
+    'mediatypes': {'label': 'media types', 'api_name': 'mediatype', 'id': 'mediatypeid', 'option': 'mediaTypes'},
+    'templates': {'label': 'templates', 'api_name': 'template', 'id': 'templateid', 'option': 'templates'},
+    'hosts': {'label': 'hosts', 'api_name': 'host', 'id': 'hostid', 'option': 'hosts'},
+    'services': {'label': 'services', 'api_name': 'service'},
+    'proxies': {'label': 'proxies', 'api_name': 'proxy'},
+    'trigger_actions': {'label': 'trigger actions', 'event_source': 0},
+    'reg_actions': {'label': 'registration actions', 'event_source': 2}
+}
+# files read by restore_config, in the order they are needed, in either backup format
+RESTORE_ORDER = [_ORIGINAL_IDS_FILE] + [
+    filename for component in EXPORTS
+    for filename in (component + '.json', component + RECORDS_SUFFIX, component + INDEX_SUFFIX)]
+# components which can be chosen with restore_config --only
+SELECTABLE_COMPONENTS = tuple(EXPORTS)
+# sections of configuration exports holding groups, and objects which belong to several hosts or templates
+_GROUP_SECTIONS = ('groups', 'host_groups', 'template_groups')
+_SHARED_SECTIONS = ('triggers', 'graphs')
+# properties of actions holding the IDs of other components, and condition types whose value is one
+_ACTION_ID_KEYS = {'groupid': 'hostgroups', 'templateid': 'templates', 'hostid': 'hosts',
+                   'mediatypeid': 'mediatypes'}
+_ACTION_CONDITION_TYPES = {'0': 'hostgroups', '1': 'hosts', '13': 'templates'}
+# number of services, proxies or actions created with each API request
+IMPORT_BATCH_SIZE = 100
+_ID_MAP_COMPONENTS = ('templates', 'hostgroups', 'hosts', 'mediatypes')
+# properties hashed to compare objects between servers and over time. IDs, which differ between servers, and
+# runtime state such as availability, errors and maintenance are left out. They are stored in the ID file as
+# hash_fields, so that a backup is always compared using the properties it was hashed with
+HASH_FIELDS = {
+    'templates': ('host', 'name', 'description'),
+    'hostgroups': ('name',),
+    'hosts': ('host', 'name', 'description', 'status', 'inventory_mode', 'tls_connect', 'tls_accept',
+              'ipmi_authtype', 'ipmi_privilege', 'ipmi_username'),
+    'mediatypes': ('name', 'type', 'status', 'description', 'smtp_server', 'smtp_port', 'smtp_helo', 'smtp_email',
+                   'exec_path', 'gsm_modem', 'username', 'maxsessions', 'maxattempts', 'attempt_interval')
+}
 _rules = {
     'applications': {
         'createMissing': True,
@@ -88,6 +138,133 @@ _rules = {
 }
 
 
+def parse_selectors(selectors):
+    """
+    :param selectors: list of component:glob strings. E.g. ['templates:Template App *', 'hosts:web-*']
+    :return: dict of component to list of globs
+    """
+    selection = defaultdict(list)
+    for selector in selectors:
+        component, separator, pattern = selector.partition(':')
+        if not separator or not pattern or component not in SELECTABLE_COMPONENTS:
+            raise ValueError('Invalid selector {}. Expected component:glob with component one of {}'.format(
+                selector, ', '.join(SELECTABLE_COMPONENTS)))
+        selection[component].append(pattern)
+    return dict(selection)
+
+
+def _id_references(data):
+    """
+    find the IDs of host groups, hosts, templates and media types in an action
+    :return: generator of (container, key, component) tuples, where container[key] is an ID of component
+    """
+    if isinstance(data, list):
+        for item in data:
+            yield from _id_references(item)
+    elif isinstance(data, dict):
+        if str(data.get('conditiontype')) in _ACTION_CONDITION_TYPES and 'value' in data:
+            yield data, 'value', _ACTION_CONDITION_TYPES[str(data['conditiontype'])]
+        for key, value in data.items():
+            if key in _ACTION_ID_KEYS and value not in ('0', 0):
+                yield data, key, _ACTION_ID_KEYS[key]
+            elif isinstance(value, (dict, list)):
+                yield from _id_references(value)
+
+
+def _object_hash(item, fields, id_key):
+    """
+    :param item: Zabbix object. E.g. a host
+    :param fields: properties to hash. E.g. HASH_FIELDS['hosts']. None hashes every property except the ID, as ID
+        files written before hash_fields was stored did
+    :param id_key: property holding the ID of the object. E.g. hostid
+    :return: md5 of the object's fields, the same on any server holding the same object
+    """
+    if fields is None:
+        data = {key: value for key, value in item.items() if key != id_key}
+    else:
+        data = {field: item.get(field) for field in fields}
+    return hashlib.md5(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _hash_fields(original_ids):
+    """
+    :param original_ids: contents of an ID file
+    :return: dict of component to the properties its hashes were made from. Empty for ID files written before these
+        were stored, whose hashes cover every property except the ID
+    """
+    return original_ids.get('hash_fields', {})
+
+
+def _batches(items, size):
+    """
+    :return: generator of lists of up to size items, taking items from the iterable only as each list is needed
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _shared_object_hosts(record):
+    """
+    :return: set of names of the hosts or templates a trigger or graph uses
+    """
+    names = set()
+    for key in ('expression', 'recovery_expression'):
+        names.update(re.findall(r'/([^/{}()]+)/', record.get(key) or ''))
+    for graph_item in record.get('graph_items', []):
+        names.add(graph_item.get('item', {}).get('host'))
+    return names
+
+
+class ExportStore:
+    """
+    Backup files held in memory, so that configuration exported from one server can be imported into another
+    without staging it on disk. Each file can be read as soon as it has been exported, while the export carries on
+    in another thread
+    """
+
+    def __init__(self):
+        self._files = {}
+        self._taken = set()
+        self._finished = False
+        self._condition = threading.Condition()
+
+    def put(self, name, data):
+        """
+        :param name: name of the backup file. E.g. templates.json
+        :param data: str of the file's JSON document
+        """
+        with self._condition:
+            self._files[name] = data
+            self._condition.notify_all()
+
+    def finish(self):
+        with self._condition:
+            self._finished = True
+            self._condition.notify_all()
+
+    def get(self, name):
+        """
+        Block until the file has been exported, and take it out of the store. Each file is read once, so only the
+        files exported but not yet imported are held in memory
+        :param name: name of the backup file. E.g. templates.json
+        :return: str of the file's JSON document
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: name in self._files or name in self._taken or self._finished)
+            if name in self._taken:
+                raise FileNotFoundError('{} has already been read'.format(name))
+            if name not in self._files:
+                raise FileNotFoundError('{} was not exported'.format(name))
+            self._taken.add(name)
+            return self._files.pop(name)
+
+
 # logging
 def get_logger(name):
     logger = logging.getLogger(name)
@@ -123,12 +300,33 @@ class ZabbixAdmin:
     Class for administering common operational activities for a Zabbix instance
     """
 
-    def __init__(self, zbx_client, data_dir, force_template):
+    def __init__(self, zbx_client, data_dir, force_template, wait_for_file=None, on_file_written=None,
+                 profiler=None, backup_format='json', selectors=None, import_batch_size=IMPORT_BATCH_SIZE,
+                 export_store=None, limiter=None):
         """
         :param zbx_client: instance of a Zabbix API client object
         :param data_dir: directory where we will keep configuration data
+        :param wait_for_file: (optional) callable taking the path of a file, blocking until it is ready to be read and
+            returning whether it arrived. Used when restoring from files which are still being downloaded
+        :param on_file_written: (optional) callable taking the path of each backup file once it has been written
+        :param profiler: (optional) concierge_profile.Profiler to record each phase of a backup or restore with
+        :param backup_format: json to keep each component in one JSON file, or records to keep each object as an
+            indexed, compressed record (see concierge_records)
+        :param selectors: (optional) dict of component to list of globs. Only restore objects with matching names,
+            and what they depend on. See parse_selectors
+        :param import_batch_size: (optional) number of services, proxies or actions to create with each request
+        :param export_store: (optional) ExportStore to export configuration to and import it from, instead of JSON
+            files in data_dir
+        :param limiter: (optional) concierge_limiter.AdaptiveLimiter to make every Zabbix API call through
         """
-        self.zbx_client = zbx_client
+        self.zbx_client = LimitedClient(zbx_client, limiter) if limiter else zbx_client
+        self.wait_for_file = wait_for_file
+        self.on_file_written = on_file_written
+        self.profiler = profiler
+        self.backup_format = backup_format
+        self.selectors = selectors
+        self.import_batch_size = import_batch_size
+        self.export_store = export_store
         self.force_template = force_template
         self.imported_template_ids = []
         self.imported_hostgroup_ids = []
@@ -142,7 +340,9 @@ class ZabbixAdmin:
         self.command_mapping = {
             'backup_config': self.backup_config,
             'restore_config': self.restore_config,
-            'get_simple_id_map': self.get_id_file
+            'get_simple_id_map': self.get_id_file,
+            'migrate_export': self.migrate_export,
+            'verify': self.verify_config
         }
         self.id_mapping = {
             'templates': {'api_name': "template", 'id': "templateid", 'name': "host"},
@@ -161,12 +361,29 @@ class ZabbixAdmin:
     def run(self, action):
         self.command_mapping[action]()
 
+    def _phase(self, name):
+        return self.profiler.phase(name) if self.profiler else nullcontext()
+
     # backups aka exports
     def _export_json_to_file(self, result, export_filename):
+        if self.export_store is not None:
+            self.export_store.put('{}.json'.format(export_filename), result)
+            return
+        if self.backup_format == 'records':
+            target_path = os.path.join(self.data_dir, export_filename)
+            write_records(target_path, json.loads(result))
+            self._file_written(target_path + RECORDS_SUFFIX)
+            self._file_written(target_path + INDEX_SUFFIX)
+            return
         target_absolute_path = '{}/{}.json'.format(self.data_dir,
                                                    export_filename)
         with open(target_absolute_path, "w") as export_file:
             export_file.write(result)
+        self._file_written(target_absolute_path)
+
+    def _file_written(self, path):
+        if self.on_file_written:
+            self.on_file_written(path)
 
     def _get_data(self, component, label_for_logging=None, **kwargs):
         if not label_for_logging:
@@ -246,28 +463,54 @@ class ZabbixAdmin:
 
         self._export_json_to_file(result, export_filename)
 
+    def _get_all(self, components, hash_fields=HASH_FIELDS):
+        """
+        get all objects of several components at the same time, with only their ID, name and hashed fields. With a
+        limiter, the calls are held back while the server is slow. With a profiler, the calls are profiled in the phase
+        running
+        :param components: list of components. E.g. ['templates', 'hosts']
+        :param hash_fields: dict of component to the properties hashed. Components missing from it are fetched with
+            all their properties
+        :return: list of the objects of each component
+        """
+        def get(component):
+            if hash_fields.get(component) is None:
+                output = 'extend'
+            else:
+                output = [self.id_mapping[component]['id'], self.id_mapping[component]['name']]
+                output += [field for field in hash_fields[component] if field not in output]
+            with self.profiler.worker() if self.profiler else nullcontext():
+                return getattr(self.zbx_client, self.id_mapping[component]['api_name']).get(output=output)
+        with ThreadPoolExecutor(max_workers=len(components), thread_name_prefix='get') as executor:
+            return list(executor.map(get, components))
+
     def get_id_file(self):
         """
         we need to have a simplified map of component IDs to their names because
         when we're importing things like auto-registration actions, we need to
         know what our old and new IDs are so we can correctly link them upon
         import.
-        The hash of the components data (excluding id) is also stored for comparing data.
+        The hash of the components data (excluding id) is also stored for comparing data, along with the
+        properties hashed.
 
         :return: file
         """
         data = defaultdict(list)
-        for component in ['templates', 'hostgroups', 'hosts', 'mediatypes']:
+        data['hash_fields'] = HASH_FIELDS
+        components = list(_ID_MAP_COMPONENTS)
+        for component, items in zip(components, self._get_all(components)):
             component_id = self.id_mapping[component]['id']
             component_name = self.id_mapping[component]['name']
-            for item in getattr(self.zbx_client, self.id_mapping[component]['api_name']).get(output="extend"):
-                item_copy = dict(item)
-                del item_copy[component_id]
-                item_hash = hashlib.md5(json.dumps(item_copy, sort_keys=True).encode("utf-8")).hexdigest()
-                data[component].append(
-                    {component_name: item[component_name], 'hash': item_hash, component_id: item[component_id]})
+            for item in items:
+                data[component].append({component_name: item[component_name],
+                                        'hash': _object_hash(item, HASH_FIELDS[component], component_id),
+                                        component_id: item[component_id]})
+        if self.export_store is not None:
+            self.export_store.put(_ORIGINAL_IDS_FILE, json.dumps(data))
+            return
         with open(self.original_ids_file, "w") as export_file:
             export_file.write(json.dumps(data))
+        self._file_written(self.original_ids_file)
 
     def backup_config(self):
         """
@@ -277,75 +520,121 @@ class ZabbixAdmin:
         """
         if not os.path.isdir(self.data_dir):
             os.makedirs(self.data_dir)
+        self.export_components()
+        with self._phase('export id map'):
+            self.get_id_file()
 
-        _info('Exporting templates and hostgroups')
-        self.export_component_config('template', 'templateid', 'templates',
-                                     'templates')
-        self.export_component_config('hostgroup', 'groupid', 'groups',
-                                     'hostgroups')
-        _info('Exporting hosts')
-        self.export_component_config('host', 'hostid', 'hosts', 'hosts')
-        _info('Exporting registration actions')
-        self.export_action_config(2, 'reg_actions',
-                                  'auto-registration actions')
-        _info('Exporting trigger actions')
-        self.export_action_config(0, 'trigger_actions',
-                                  'trigger actions')
-        _info('Exporting media types')
-        self.export_component_config('mediatype', 'mediatypeid', 'mediaTypes', 'mediatypes')
-
-        _info('Exporting services')
-        self.export_component('service', 'services')
-
-        _info('Exporting proxies')
-        self.export_component('proxy', 'proxies')
-
-        self.get_id_file()
+    def migrate_export(self):
+        """
+        Export all of our application configuration to `self.export_store`, so that a restore to another server
+        reading from the same store can import each component as soon as it has been exported. The ID map is
+        exported first, as restore_config needs it before anything else
+        """
+        with self._phase('export id map'):
+            self.get_id_file()
+        self.export_components()
+
+    def export_components(self):
+        """
+        Export each component of EXPORTS, in the order restore_config imports them
+        """
+        for component, export in EXPORTS.items():
+            _info('Exporting {}', export['label'])
+            with self._phase('export {}'.format(export['label'])):
+                if 'event_source' in export:
+                    filename = os.path.splitext(os.path.basename(self._component_file(component)))[0]
+                    self.export_action_config(export['event_source'], filename, export['label'])
+                elif 'option' in export:
+                    self.export_component_config(export['api_name'], export['id'], export['option'], component)
+                else:
+                    self.export_component(export['api_name'], component)
 
     # imports
-    def import_configuration(self, component):
+    def _wait_for_file(self, path):
+        if self.wait_for_file and not self.wait_for_file(path):
+            _log_error_and_fail('Backup file {} was not downloaded', path)
+        return path
+
+    def _wait_for_records(self, path):
+        path = os.path.splitext(path)[0]
+        self._wait_for_file(path + RECORDS_SUFFIX)
+        self._wait_for_file(path + INDEX_SUFFIX)
+        return path
+
+    def _open_json(self, import_file):
+        """
+        :param import_file: path of a JSON backup file. E.g. data_dir/services.json
+        :return: text file of the backup, from `self.export_store` when there is one
+        """
+        if self.export_store is not None:
+            return io.StringIO(self.export_store.get(os.path.basename(import_file)))
+        return open(self._wait_for_file(import_file), 'r')
+
+    def _read_export(self, import_file):
+        """
+        :param import_file: path of a configuration export backup file. E.g. data_dir/templates.json
+        :return: str of the configuration export, from either backup format
+        """
+        if self.backup_format == 'records':
+            return json.dumps(RecordReader(self._wait_for_records(import_file)).document())
+        with self._open_json(import_file) as f:
+            return f.read()
+
+    def _load_objects(self, import_file):
+        """
+        :param import_file: path of a backup file of API objects. E.g. data_dir/services.json
+        :return: generator of the objects, read from the file one at a time in either backup format
+        """
+        if self.backup_format == 'records':
+            yield from RecordReader(self._wait_for_records(import_file))
+            return
+        with self._open_json(import_file) as f:
+            yield from iter_json_array(f)
+
+    def _open_records(self, import_file):
+        """
+        :param import_file: path of a backup file. E.g. data_dir/templates.json
+        :return: RecordReader of the objects in the backup file, from either backup format
+        """
+        if self.backup_format == 'records':
+            return RecordReader(self._wait_for_records(import_file))
+        with self._open_json(import_file) as f:
+            return DocumentRecords(json.load(f))
+
+    def import_configuration(self, component, component_data=None):
         """
         import a JSON file backup of Zabbix components like templates or hosts
 
         :param component: which component to import. E.g. hosts, hostgroups,
                         templates
+        :param component_data: (optional) configuration export to import instead of the backup file
         """
         import_file = '{}/{}.json'.format(self.data_dir, component)
-        with open(import_file, 'r') as f:
-            component_data = f.read()
-            try:
-                self.zbx_client.confimport('json', component_data, _rules)
-            except ZabbixAPIException:
-                _warn('Could not import configuration for {}. Attempting manual {} update', component, component)
-                if component == 'templates' and self.force_template:
-                    _info('Deleting all current templates')
-                    self.delete_all(component)
-                else:
-                    self.compare_ids(component)
-                _info('Importing components')
-                self.zbx_client.confimport('json', component_data, _rules)
+        if component_data is None:
+            component_data = self._read_export(import_file)
+        try:
+            self.zbx_client.confimport('json', component_data, _rules)
+        except ZabbixAPIException:
+            _warn('Could not import configuration for {}. Attempting manual {} update', component, component)
+            if component == 'templates' and self.force_template:
+                _info('Deleting all current templates')
+                self.delete_all(component)
+            else:
+                self.compare_ids(component)
+            _info('Importing components')
+            self.zbx_client.confimport('json', component_data, _rules)
 
     def import_trigger_actions(self):
         trig_actions_path = os.path.join(self.data_dir, _TRIGGER_ACTIONS_FILE)
-        with open(trig_actions_path) as trigger_actions:
-            # trig_actions_list = json.load(trigger_actions)
-            trig_actions_list = self._remove_keys(json.load(trigger_actions), self.keys_to_remove['trigger_actions'])
-            for trigger_action in trig_actions_list:
-                try:
-                    self.zbx_client.action.create(trigger_action)
-                except ZabbixAPIException as err:
-                    self.zbx_client.action.update(trigger_action)
+        trigger_actions = (self._strip_keys(trigger_action, self.keys_to_remove['trigger_actions'])
+                           for trigger_action in self._load_objects(trig_actions_path))
+        self._create_in_batches('action', 'actionid', 'name', trigger_actions)
 
     def import_registration_actions(self):
         reg_actions_path = os.path.join(self.data_dir, _REG_ACTIONS_FILE)
-        with open(reg_actions_path, 'r') as reg_actions:
-            for reg_action in json.load(reg_actions):
-                self._remove_keys(reg_action, self.keys_to_remove['reg_actions'])
-                try:
-                    self._update_ids(reg_action)
-                    self.zbx_client.action.create(reg_action)
-                except ZabbixAPIException:
-                    self.zbx_client.action.update(reg_action)
+        reg_actions = (self._update_ids(self._strip_keys(reg_action, self.keys_to_remove['reg_actions']))
+                       for reg_action in self._load_objects(reg_actions_path))
+        self._create_in_batches('action', 'actionid', 'name', reg_actions)
 
     def import_actions(self):
         """
@@ -388,23 +677,48 @@ class ZabbixAdmin:
         for item_id in self.dest_ids[component].keys():
             getattr(self.zbx_client, self.id_mapping[component]['api_name']).delete(item_id)
 
-    def import_components(self, component):
+    def import_components(self, component, items=None):
         """
         Method for importing components which cannot be configured using a configuration import.
         If the component exists in destination server it is updated
         :param component: Component to import
+        :param items: (optional) objects to import instead of those in the backup file
         """
         import_file = '{}/{}.json'.format(self.data_dir, component)
-        component_method = self.id_mapping[component]['api_name']
-        file = open(import_file).read()
-        if os.path.isfile(import_file):
-            for item in json.loads(file):
-                if component in self.keys_to_remove:
-                    self._remove_keys(item, self.keys_to_remove[component])
-                try:
-                    getattr(self.zbx_client, component_method).create(item)
-                except ZabbixAPIException:
-                    getattr(self.zbx_client, component_method).update()
+        if items is None:
+            items = self._load_objects(import_file)
+        if component in self.keys_to_remove:
+            items = (self._strip_keys(item, self.keys_to_remove[component]) for item in items)
+        self._create_in_batches(self.id_mapping[component]['api_name'], self.id_mapping[component]['id'],
+                                self.id_mapping[component]['name'], items)
+
+    def _create_in_batches(self, api_name, id_key, name_key, items):
+        """
+        create objects `self.import_batch_size` at a time, so that only one batch is held in memory. When creating a
+        batch fails, e.g. because some of its objects already exist, they are created one at a time and those which
+        exist are updated
+        :param api_name: Zabbix API object. E.g. service
+        :param id_key: property holding the ID of an object. E.g. serviceid
+        :param name_key: property holding the unique name of an object. E.g. name
+        :param items: iterable of objects to create
+        """
+        for batch in _batches(items, self.import_batch_size):
+            try:
+                getattr(self.zbx_client, api_name).create(batch)
+            except ZabbixAPIException:
+                for item in batch:
+                    self._create_or_update(api_name, id_key, name_key, item)
+
+    def _create_or_update(self, api_name, id_key, name_key, item):
+        api = getattr(self.zbx_client, api_name)
+        try:
+            api.create(item)
+        except ZabbixAPIException:
+            existing = api.get(filter={name_key: item[name_key]}, output=[id_key])
+            if not existing:
+                raise
+            item[id_key] = existing[0][id_key]
+            api.update(item)
 
     def get_id_maps(self, components):
         """
@@ -413,16 +727,17 @@ class ZabbixAdmin:
         :param components: list of components to get id maps for
         :return: map of components.
         """
-        for component in components:
+        if self.original_ids == {}:
+            with self._open_json(self.original_ids_file) as f:
+                self.original_ids = json.load(f)
+        hash_fields = _hash_fields(self.original_ids)
+        for component, items in zip(components, self._get_all(components, hash_fields)):
             component_id = self.id_mapping[component]['id']
             component_name = self.id_mapping[component]['name']
-            for item in getattr(self.zbx_client, self.id_mapping[component]['api_name']).get(output="extend"):
-                data = dict(item)
-                del data[component_id]
-                item_hash = hashlib.md5(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
-                self.dest_ids[component][item[component_id]] = {'name': item[component_name], 'hash': item_hash,
-                                                                'id': item[component_id]}
-        self.original_ids = json.load(open(self.original_ids_file)) if self.original_ids == {} else self.original_ids
+            for item in items:
+                self.dest_ids[component][item[component_id]] = {
+                    'name': item[component_name], 'hash': _object_hash(item, hash_fields.get(component), component_id),
+                    'id': item[component_id]}
 
     def _update_ids(self, reg_action):
         """
@@ -480,20 +795,241 @@ class ZabbixAdmin:
         return {key: self._remove_keys(value, keys_to_remove) for key, value in data.items()
                 if key not in keys_to_remove}
 
-    def restore_config(self):
+    def _strip_keys(self, data, keys_to_remove):
+        """
+        remove keys from data and everything nested in it, in place rather than copying like _remove_keys
+        :return: data
+        """
+        if isinstance(data, dict):
+            for key in [key for key in data if key in keys_to_remove]:
+                del data[key]
+            values = data.values()
+        elif isinstance(data, list):
+            values = data
+        else:
+            return data
+        for value in values:
+            self._strip_keys(value, keys_to_remove)
+        return data
+
+    # selective restore
+    def _component_file(self, component):
+        filename = {'trigger_actions': _TRIGGER_ACTIONS_FILE, 'reg_actions': _REG_ACTIONS_FILE}.get(
+            component, '{}.json'.format(component))
+        return os.path.join(self.data_dir, filename)
+
+    def _is_object_section(self, component, section):
+        if component == 'hostgroups':
+            return section in _GROUP_SECTIONS
+        return section not in _GROUP_SECTIONS + _SHARED_SECTIONS
+
+    def _select_records(self, records, component, names):
+        """
+        find the objects of a backup file matching the selectors of component or named in names. The templates
+        linked to selected templates are selected too
+        :param records: RecordReader of the backup file
+        :param component: component the backup file holds
+        :param names: set of names of objects needed by other selected objects
+        :return: dict of name to (index entry, object)
+        """
+        globs = self.selectors.get(component, [])
+        wanted = [entry for entry in records.index['records'] if self._is_object_section(component, entry['section'])
+                  and (entry['name'] in names or any(fnmatch.fnmatchcase(entry['name'] or '', glob)
+                                                     for glob in globs))]
+        selected = {}
+        while wanted:
+            entry = wanted.pop()
+            if entry['name'] in selected:
+                continue
+            selected[entry['name']] = (entry, records.read(entry))
+            if component == 'templates':
+                for linked in selected[entry['name']][1].get('templates', []):
+                    wanted.extend(linked_entry for linked_entry in records.find(linked['name'])
+                                  if self._is_object_section(component, linked_entry['section']))
+        return selected
+
+    def _selected_export(self, records, selected):
+        """
+        :return: configuration export of the selected objects, the groups they are in and the triggers and graphs
+            which use them
+        """
+        groups = {group['name'] for entry, record in selected.values() for group in record.get('groups', [])}
+        entries = {id(entry) for entry, record in selected.values()}
+        for entry in records.index['records']:
+            if entry['section'] in _GROUP_SECTIONS and entry['name'] in groups:
+                entries.add(id(entry))
+            elif entry['section'] in _SHARED_SECTIONS and _shared_object_hosts(records.read(entry)) & set(selected):
+                entries.add(id(entry))
+        return json.dumps(records.document([entry for entry in records.index['records'] if id(entry) in entries]))
+
+    def _original_names(self):
+        """
+        :return: dict of component to dict of ID in the backup to name
+        """
+        names = {}
+        for component in ('templates', 'hostgroups', 'hosts', 'mediatypes'):
+            component_id = self.id_mapping[component]['id']
+            component_name = self.id_mapping[component]['name']
+            names[component] = {item[component_id]: item[component_name]
+                                for item in self.original_ids.get(component, [])}
+        return names
+
+    def _translate_ids(self, action, original_names, new_ids):
+        """
+        replace the IDs of host groups, hosts, templates and media types in an action with the IDs of the objects of
+        the same name on the destination server
+        :return: list of the objects used by the action which are not on the destination server. E.g. ['hosts/web-1']
+        """
+        missing = []
+        for container, key, component in _id_references(action):
+            name = original_names[component].get(container[key])
+            if name in new_ids[component]:
+                container[key] = new_ids[component][name]
+            else:
+                missing.append('{}/{}'.format(component, name or container[key]))
+        return missing
+
+    def restore_selected(self):
+        """
+        Restore only the objects matching `self.selectors`, with what they depend on: the groups, linked templates
+        and proxy of hosts, the groups and linked templates of templates and the host groups, hosts, templates and
+        media types used by actions. IDs in actions are translated to those of the destination server
+        """
         _info('Getting current ID\'s')
         self.get_id_maps(components=['templates', 'hostgroups', 'hosts', 'mediatypes'])
+        original_names = self._original_names()
+        names = defaultdict(set)
+        actions = {}
+        for component in ('trigger_actions', 'reg_actions'):
+            if component in self.selectors:
+                actions[component] = [record for entry, record in self._select_records(
+                    self._open_records(self._component_file(component)), component, set()).values()]
+                for action in actions[component]:
+                    for container, key, dependency in _id_references(action):
+                        if container[key] in original_names[dependency]:
+                            names[dependency].add(original_names[dependency][container[key]])
+        exports = {}
+        for component in ('hosts', 'templates', 'hostgroups', 'mediatypes'):
+            if component not in self.selectors and not names[component]:
+                continue
+            records = self._open_records(self._component_file(component))
+            selected = self._select_records(records, component, names[component])
+            for entry, record in selected.values():
+                names['hostgroups'].update(group['name'] for group in record.get('groups', []))
+                names['templates'].update(template['name'] for template in record.get('templates', []))
+                if record.get('proxy', {}).get('name'):
+                    names['proxies'].add(record['proxy']['name'])
+            if selected:
+                _info('Selected {} {}: {}', len(selected), component, ', '.join(sorted(selected)))
+                exports[component] = self._selected_export(records, selected)
+        objects = {}
+        for component in ('proxies', 'services'):
+            if component in self.selectors or names[component]:
+                selected = self._select_records(self._open_records(self._component_file(component)), component,
+                                                names[component])
+                _info('Selected {} {}: {}', len(selected), component, ', '.join(sorted(selected)))
+                objects[component] = [record for entry, record in selected.values()]
+        for component in ('hostgroups', 'mediatypes', 'templates', 'proxies', 'hosts', 'services'):
+            if component in exports:
+                _info('Importing {}', component)
+                self.import_configuration(component, exports[component])
+            elif component in objects:
+                _info('Importing {}', component)
+                self.import_components(component, objects[component])
+        if actions:
+            self.dest_ids = defaultdict(dict)
+            self.get_id_maps(components=['templates', 'hostgroups', 'hosts', 'mediatypes'])
+            new_ids = {component: {item['name']: item['id'] for item in self.dest_ids[component].values()}
+                       for component in original_names}
+            skipped = []
+            for component, selected_actions in actions.items():
+                _info('Importing {}', component)
+                keys_to_remove = self.keys_to_remove['trigger_actions'] | self.keys_to_remove.get(component, set())
+                for action in selected_actions:
+                    missing = self._translate_ids(action, original_names, new_ids)
+                    if missing:
+                        _warn('Skipping action {}. It uses {} which are not on the destination server',
+                              action.get('name'), ', '.join(missing))
+                        skipped.append(action.get('name'))
+                        continue
+                    self._create_or_update('action', 'actionid', 'name', self._strip_keys(action, keys_to_remove))
+            if skipped:
+                _log_error_and_fail('Actions not restored because objects they use are missing: {}',
+                                    ', '.join(skipped))
+
+    # verification
+    def get_hashes(self, components, hash_fields=HASH_FIELDS):
+        """
+        Get the hashes of all objects of several components, as stored by get_id_file. Each component is fetched
+        with one request for only the fields needed, all components at the same time. The Zabbix API has no offset
+        to page by, and without nested objects or unneeded fields each response is small
+        :param components: list of components. E.g. ['templates', 'hosts']
+        :param hash_fields: dict of component to the properties hashed, as stored in the ID file
+        :return: dict of component to dict of object name to hash
+        """
+        hashes = {}
+        for component, items in zip(components, self._get_all(components, hash_fields)):
+            component_id = self.id_mapping[component]['id']
+            component_name = self.id_mapping[component]['name']
+            hashes[component] = {item[component_name]: _object_hash(item, hash_fields.get(component), component_id)
+                                 for item in items}
+        return hashes
+
+    def verify_config(self):
+        """
+        Compare the objects on the server with the hashes stored in the backup's ID file, logging those missing from
+        the server, extra on the server and differing from the backup. Exits with an error if there are any
+        :return: dict of missing, extra and differing lists of component/name strings
+        """
+        start = time.time()
+        with self._open_json(self.original_ids_file) as f:
+            original_ids = json.load(f)
+        components = [component for component in _ID_MAP_COMPONENTS if component in original_ids]
+        with self._phase('verify'):
+            hashes = self.get_hashes(components, _hash_fields(original_ids))
+        drift = {'missing': [], 'extra': [], 'differing': []}
+        for component in components:
+            component_name = self.id_mapping[component]['name']
+            expected = {item[component_name]: item['hash'] for item in original_ids[component]}
+            found = hashes[component]
+            drift['missing'].extend('{}/{}'.format(component, name) for name in sorted(expected.keys() - found.keys()))
+            drift['extra'].extend('{}/{}'.format(component, name) for name in sorted(found.keys() - expected.keys()))
+            drift['differing'].extend('{}/{}'.format(component, name) for name in sorted(expected.keys() & found.keys())
+                                      if expected[name] != found[name])
+        for kind, names in drift.items():
+            for name in names:
+                _warn('{}: {}', kind.capitalize(), name)
+        _info('Verified {} objects in {:.1f}s. {} missing, {} extra, {} differing',
+              sum(len(found) for found in hashes.values()), time.time() - start, len(drift['missing']),
+              len(drift['extra']), len(drift['differing']))
+        if any(drift.values()):
+            _log_error_and_fail('Configuration on the server differs from the backup in {}', self.data_dir)
+        return drift
+
+    def restore_config(self):
+        if self.selectors:
+            return self.restore_selected()
+        _info('Getting current ID\'s')
+        with self._phase('get id maps'):
+            self.get_id_maps(components=['templates', 'hostgroups', 'hosts', 'mediatypes'])
         _info('Importing hostgroups')
-        self.import_configuration('hostgroups')
+        with self._phase('import hostgroups'):
+            self.import_configuration('hostgroups')
         _info('Importing media types')
-        self.import_configuration('mediatypes')
+        with self._phase('import media types'):
+            self.import_configuration('mediatypes')
         _info('Importing templates')
-        self.import_configuration('templates')
+        with self._phase('import templates'):
+            self.import_configuration('templates')
         _info('Importing hosts')
-        self.import_configuration('hosts')
+        with self._phase('import hosts'):
+            self.import_configuration('hosts')
         _info('Importing services')
-        self.import_components('services')
+        with self._phase('import services'):
+            self.import_components('services')
         _info('Importing proxies')
-        self.import_components('proxies')
+        with self._phase('import proxies'):
+            self.import_components('proxies')
         _info('Importing actions')
-        self.import_actions()
+        with self._phase('import actions'):
+            self.import_actions()
@@ -3,14 +3,22 @@
 BACKUP=false
 RESTORE=false
 UPLOAD=false
+SNAPSHOT=false
+FROM_CLOUD=false
+MIGRATE=false
+VERIFY=false
 DELETE=false
-while getopts brud flag
+while getopts brudsfmv flag
 do
     case "${flag}" in
         b) BACKUP=true;;
         r) RESTORE=true;;
         u) UPLOAD=true;;
         d) DELETE=true;;
+        s) SNAPSHOT=true;;
+        f) FROM_CLOUD=true;;
+        m) MIGRATE=true;;
+        v) VERIFY=true;;
     esac
 done
 
@@ -18,6 +26,18 @@ DATE=$( date '+%Y%m%d%H%M' )
 export ZBX_CONFIG_DIR=${ZBX_CONFIG_DIR:-"/zbx-configs/$DATE"}
 
 
+if [ $BACKUP == true ] && [ $UPLOAD == true ]; then
+  # upload each file as soon as it is exported
+  echo "$( date -u '+%F %T') INFO: Backing up Zabbix configuration to $ZBX_CONFIG_DIR and uploading to cloud"
+  if python /concierge_scheduler/concierge_scheduler/concierge_scheduler.py event --upload backup_config; then
+    echo "$( date -u '+%F %T') INFO: Zabbix configuration backed up and uploaded to cloud."
+    BACKUP=false
+    UPLOAD=false
+  else
+    echo "$( date -u '+%F %T') ERROR: Failed to backup Zabbix configuration and upload to cloud"
+    exit 1
+  fi
+fi
 if [ $BACKUP == true ]; then
   echo "$( date -u '+%F %T') INFO: Backing up Zabbix configuration to $ZBX_CONFIG_DIR"
   if python /concierge_scheduler/concierge_scheduler/concierge_scheduler.py event backup_config; then
@@ -28,14 +48,27 @@ if [ $BACKUP == true ]; then
   fi
 fi
 if [ $RESTORE == true ]; then
+  RESTORE_ARGS=""
+  if [ $FROM_CLOUD == true ]; then
+    RESTORE_ARGS="--from-cloud"
+  fi
   echo "$( date -u '+%F %T') INFO: Restoring Zabbix configuration from $ZBX_CONFIG_DIR"
-  if python /concierge_scheduler/concierge_scheduler/concierge_scheduler.py event restore_config; then
+  if python /concierge_scheduler/concierge_scheduler/concierge_scheduler.py event $RESTORE_ARGS restore_config; then
     echo "$( date -u '+%F %T') INFO: Restored configuration to $ZBX_API_HOST"
   else
     echo "$( date -u '+%F %T') ERROR: Failed to restore zabbix configuration"
     exit 1
   fi
 fi
+if [ $VERIFY == true ]; then
+  echo "$( date -u '+%F %T') INFO: Verifying Zabbix configuration against $ZBX_CONFIG_DIR"
+  if python /concierge_scheduler/concierge_scheduler/concierge_scheduler.py event verify; then
+    echo "$( date -u '+%F %T') INFO: Configuration of $ZBX_API_HOST matches $ZBX_CONFIG_DIR"
+  else
+    echo "$( date -u '+%F %T') ERROR: Configuration of $ZBX_API_HOST differs from $ZBX_CONFIG_DIR"
+    exit 1
+  fi
+fi
 if [ $UPLOAD == true ]; then
   echo "$( date -u '+%F %T') INFO: Uploading $ZBX_CONFIG_DIR to cloud"
   if python /concierge_scheduler/concierge_scheduler/concierge_scheduler.py cloud upload; then
@@ -45,6 +78,24 @@ if [ $UPLOAD == true ]; then
     exit 1
   fi
 fi
+if [ $SNAPSHOT == true ]; then
+  echo "$( date -u '+%F %T') INFO: Storing snapshot of $ZBX_CONFIG_DIR in cloud"
+  if python /concierge_scheduler/concierge_scheduler/concierge_scheduler.py cloud snapshot; then
+    echo "$( date -u '+%F %T') INFO: Stored snapshot in cloud"
+  else
+    echo "$( date -u '+%F %T') ERROR: Failed to store snapshot in cloud"
+    exit 1
+  fi
+fi
+if [ $MIGRATE == true ]; then
+  echo "$( date -u '+%F %T') INFO: Migrating Zabbix configuration from $ZBX_SOURCE_API_HOST to $ZBX_API_HOST"
+  if python /concierge_scheduler/concierge_scheduler/concierge_scheduler.py event migrate; then
+    echo "$( date -u '+%F %T') INFO: Migrated configuration to $ZBX_API_HOST"
+  else
+    echo "$( date -u '+%F %T') ERROR: Failed to migrate zabbix configuration"
+    exit 1
+  fi
+fi
 if [ $DELETE == true ]; then
   echo "$( date -u '+%F %T') INFO: Deleting $ZBX_CONFIG_DIR"
   rm -r "$ZBX_CONFIG_DIR"
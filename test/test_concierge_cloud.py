@@ -0,0 +1,356 @@
+"""
+@author: Gareth Brown
+@contact: gareth@mesoform.com
+@date: 2017
+"""
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from unittest import TestLoader, TestCase, TextTestRunner
+import concierge_scheduler.concierge_cloud
+from concierge_scheduler.concierge_cloud import CloudBackupInterface, FileArrivals, UploadPipeline, file_chunks
+
+
+class MemoryBackup(CloudBackupInterface):
+    """
+    storage backend keeping objects in a dict
+    """
+    def __init__(self, config_dir):
+        self.config_dir = config_dir
+        self.storage_location = 'memory'
+        self.objects = {}
+        self.puts = []
+
+    def authenticate(self):
+        return None
+
+    def assemble_upload_list(self) -> set:
+        return {os.path.join(root, name) for root, dirs, files in os.walk(self.config_dir) for name in files}
+
+    def upload(self, upload_list: set):
+        raise NotImplementedError
+
+    def _put_object(self, name, data):
+        self.puts.append(name)
+        self.objects[name] = data
+
+    def _get_object(self, name):
+        return self.objects[name]
+
+    def _list_objects(self, prefix):
+        return {name for name in self.objects if name.startswith(prefix)}
+
+    def _copy_object(self, source, name):
+        self.objects[name] = self.objects[source]
+
+    def _local_checksums(self, filename):
+        with open(filename, 'rb') as f:
+            return {'md5': hashlib.md5(f.read()).hexdigest()}
+
+    def _remote_checksums(self, folder, directory=None):
+        prefix = os.path.join(folder, directory or os.path.basename(os.path.normpath(self.config_dir)), '')
+        return {name: {'md5': hashlib.md5(data).hexdigest()} for name, data in self.objects.items()
+                if name.startswith(prefix)}
+
+    def _unchanged(self, local, remote):
+        return local['md5'] == remote.get('md5')
+
+    def _upload_function(self):
+        def upload_file(filename, remote_path):
+            with open(filename, 'rb') as f:
+                self._put_object(remote_path, f.read())
+            return len(self.objects[remote_path])
+        return upload_file
+
+
+class FileChunks(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.content = random.Random(1).randbytes(1024 * 1024)
+
+    def _chunks(self, content):
+        filename = os.path.join(self.work_dir, 'export.json')
+        with open(filename, 'wb') as f:
+            f.write(content)
+        return list(file_chunks(filename))
+
+    def test_chunks_rebuild_file(self):
+        chunks = self._chunks(self.content)
+        self.assertEqual(b''.join(chunks), self.content)
+        self.assertTrue(all(concierge_scheduler.concierge_cloud.SNAPSHOT_MIN_CHUNK <= len(chunk) <=
+                            concierge_scheduler.concierge_cloud.SNAPSHOT_MAX_CHUNK for chunk in chunks[:-1]))
+
+    def test_insert_only_changes_nearby_chunks(self):
+        original = self._chunks(self.content)
+        edited = self._chunks(self.content[:500000] + b'{"host": "new"}' + self.content[500000:])
+        self.assertGreater(len(set(original) & set(edited)), len(original) - 3)
+
+    def test_cut_point_matches_fingerprint_of_window(self):
+        cloud = concierge_scheduler.concierge_cloud
+
+        def cut_point(data, min_size, max_size, mask):
+            # one byte at a time, as defined
+            for end in range(min_size, min(len(data), max_size)):
+                fingerprint = sum(cloud._BYTE_VALUES[data[end - distance]] << distance
+                                  for distance in range(min(cloud._CHUNK_WINDOW, end + 1)))
+                if not (fingerprint >> 32) & mask:
+                    return end + 1
+            return min(len(data), max_size)
+
+        cloud._SEARCH_BLOCK = 1000
+        self.addCleanup(setattr, cloud, '_SEARCH_BLOCK', 16 * 1024)
+        for seed in range(4):
+            data = random.Random(seed).randbytes(20000)
+            self.assertEqual(cloud._cut_point(data, 100, 15000, 0x3FF), cut_point(data, 100, 15000, 0x3FF))
+
+    def test_invalid_average_size(self):
+        with self.assertRaises(ValueError):
+            list(file_chunks(__file__, avg_size=3 * 1024))
+
+
+class SnapshotStore(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.content = random.Random(2).randbytes(512 * 1024)
+
+    def _backup(self, name, hosts):
+        config_dir = os.path.join(self.work_dir, name)
+        os.makedirs(config_dir)
+        with open(os.path.join(config_dir, 'templates.json'), 'wb') as f:
+            f.write(self.content)
+        with open(os.path.join(config_dir, 'hosts.json'), 'wb') as f:
+            f.write(hosts)
+        return config_dir
+
+    def test_snapshots_share_chunks(self):
+        store = MemoryBackup(self._backup('202001010000', b'{"hosts": []}'))
+        summary = store.upload_snapshot(store.assemble_upload_list(), 'folder')
+        self.assertEqual(summary['files'], 2)
+        self.assertEqual(summary['skipped'], 0)
+        self.assertListEqual(summary['failed'], [])
+
+        objects = store.objects
+        store = MemoryBackup(self._backup('202001020000', b'{"hosts": [1]}'))
+        store.objects = objects
+        store.puts = []
+        summary = store.upload_snapshot(store.assemble_upload_list(), 'folder')
+        # only the changed hosts file and the snapshot are uploaded
+        self.assertEqual(len(store.puts), 2)
+        self.assertEqual(summary['skipped'], summary['chunks'] - 1)
+
+        snapshot = json.loads(store.objects['folder/snapshots/202001020000.json'])
+        templates = b''.join(zlib.decompress(store.objects['folder/chunks/' + digest])
+                             for digest in snapshot['files']['templates.json']['chunks'])
+        self.assertEqual(templates, self.content)
+        self.assertIn('folder/snapshots/202001010000.json', store.objects)
+
+    def test_failed_chunk_skips_snapshot(self):
+        store = MemoryBackup(self._backup('202001010000', b'{"hosts": []}'))
+
+        def put_object(name, data):
+            if name.endswith('.json'):
+                MemoryBackup._put_object(store, name, data)
+            else:
+                raise OSError('unavailable')
+        store._put_object = put_object
+        summary = store.upload_snapshot(store.assemble_upload_list())
+        self.assertEqual(len(summary['failed']), 2)
+        self.assertEqual(summary['files'], 0)
+        self.assertDictEqual(store.objects, {})
+
+
+class SyncUpload(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+
+    def _backup(self, name, hosts):
+        config_dir = os.path.join(self.work_dir, name)
+        os.makedirs(config_dir)
+        with open(os.path.join(config_dir, 'templates.json'), 'wb') as f:
+            f.write(b'{"templates": []}')
+        with open(os.path.join(config_dir, 'hosts.json'), 'wb') as f:
+            f.write(hosts)
+        return config_dir
+
+    def test_dated_directory_compared_with_previous(self):
+        store = MemoryBackup(self._backup('202001010000', b'{"hosts": []}'))
+        store._upload_files(store._upload_function(), store.assemble_upload_list(), 'folder', sync=True)
+        objects = store.objects
+        objects['folder/snapshots/later.json'] = b'{}'
+        store = MemoryBackup(self._backup('202001020000', b'{"hosts": [1]}'))
+        store.objects = objects
+        summary = store._upload_files(store._upload_function(), store.assemble_upload_list(), 'folder', sync=True)
+        self.assertEqual(summary['files'], 1)
+        self.assertEqual(summary['copied'], 1)
+        self.assertEqual(summary['skipped'], 1)
+        # only the changed file is uploaded, and the new directory holds every file
+        self.assertListEqual(store.puts, ['folder/202001020000/hosts.json'])
+        self.assertEqual(store.objects['folder/202001020000/templates.json'], b'{"templates": []}')
+
+    def test_first_directory_uploaded(self):
+        store = MemoryBackup(self._backup('202001010000', b'{"hosts": []}'))
+        store.objects['folder/202001020000/hosts.json'] = b'{"hosts": []}'
+        summary = store._upload_files(store._upload_function(), store.assemble_upload_list(), 'folder', sync=True)
+        self.assertEqual(summary['files'], 2)
+        self.assertEqual(summary['copied'], 0)
+
+
+class Download(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.config_dir = os.path.join(self.work_dir, '202001010000')
+        os.makedirs(os.path.join(self.config_dir, 'server1'))
+        self.files = {'templates.json': random.Random(3).randbytes(300 * 1024),
+                      'hostgroups.json': b'{"groups": []}',
+                      os.path.join('server1', 'hosts.json'): b'{"hosts": []}'}
+        for name, content in self.files.items():
+            with open(os.path.join(self.config_dir, name), 'wb') as f:
+                f.write(content)
+        self.store = MemoryBackup(self.config_dir)
+        self.destination = os.path.join(self.work_dir, 'restore')
+
+    def _assert_downloaded(self, summary, written):
+        self.assertListEqual(summary['failed'], [])
+        self.assertEqual(summary['files'], 3)
+        for name, content in self.files.items():
+            with open(os.path.join(self.destination, name), 'rb') as f:
+                self.assertEqual(f.read(), content)
+        # files are written in the order asked for
+        self.assertListEqual(written[:2], [os.path.join(self.destination, 'hostgroups.json'),
+                                           os.path.join(self.destination, 'templates.json')])
+
+    def test_download_snapshot(self):
+        self.store.upload_snapshot(self.store.assemble_upload_list(), 'folder')
+        written = []
+        summary = self.store.download('folder', '202001010000', self.destination, on_file=written.append,
+                                      order=['hostgroups.json', 'templates.json'])
+        self._assert_downloaded(summary, written)
+
+    def test_download_uploaded_files(self):
+        for name, content in self.files.items():
+            self.store.objects[os.path.join('folder', '202001010000', name)] = content
+        written = []
+        summary = self.store.download('folder', '202001010000', self.destination, on_file=written.append,
+                                      order=['hostgroups.json', 'templates.json'])
+        self._assert_downloaded(summary, written)
+
+    def test_corrupt_chunk_fails_file(self):
+        self.store.upload_snapshot(self.store.assemble_upload_list(), 'folder')
+        snapshot = json.loads(self.store.objects['folder/snapshots/202001010000.json'])
+        digest = snapshot['files']['hostgroups.json']['chunks'][0]
+        self.store.objects['folder/chunks/' + digest] = zlib.compress(b'{"groups": [1]}')
+        summary = self.store.download('folder', '202001010000', self.destination)
+        self.assertListEqual(summary['failed'], ['hostgroups.json'])
+        self.assertFalse(os.path.exists(os.path.join(self.destination, 'hostgroups.json')))
+
+    def test_fetches_bounded_ahead(self):
+        for index in range(40):
+            self.store.objects['folder/202001010000/{:02}.json'.format(index)] = b'{}'
+        self.store.concurrency = 2
+        fetched = []
+        get_object = self.store._get_object
+        self.store._get_object = lambda name: fetched.append(name) or get_object(name)
+        fetched_when_written = []
+        summary = self.store.download('folder', '202001010000', self.destination,
+                                      on_file=lambda path: fetched_when_written.append(len(fetched)))
+        self.assertEqual(summary['files'], 40)
+        self.assertLessEqual(fetched_when_written[0], concierge_scheduler.concierge_cloud.DOWNLOAD_AHEAD * 2)
+
+    def test_file_arrivals(self):
+        arrivals = FileArrivals()
+        waiter = threading.Thread(target=lambda: self.assertTrue(arrivals.wait('hosts.json')))
+        waiter.start()
+        arrivals.arrived('hosts.json')
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        arrivals.finish()
+        self.assertFalse(arrivals.wait('missing.json'))
+
+
+class Pipeline(TestCase):
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.config_dir)
+        self.store = MemoryBackup(self.config_dir)
+        self.store.concurrency = 2
+
+    def _write(self, name):
+        filename = os.path.join(self.config_dir, name)
+        with open(filename, 'w') as f:
+            f.write(name)
+        return filename
+
+    def test_files_uploaded_as_written(self):
+        with UploadPipeline(self.store, 'folder') as pipeline:
+            for name in ('templates.json', 'hosts.json', 'reg_actions.json'):
+                pipeline.put(self._write(name))
+        directory = os.path.basename(self.config_dir)
+        self.assertEqual(pipeline.summary['files'], 3)
+        self.assertEqual(self.store.objects['folder/{}/hosts.json'.format(directory)], b'hosts.json')
+
+    def test_full_queue_blocks_producer(self):
+        release = threading.Event()
+        upload_file = self.store._upload_function()
+
+        def slow_upload(filename, remote_path):
+            release.wait(5)
+            return upload_file(filename, remote_path)
+        self.store._upload_function = lambda: slow_upload
+        pipeline = UploadPipeline(self.store, queue_size=1)
+        producer = threading.Thread(target=lambda: [pipeline.put(self._write('{}.json'.format(index)))
+                                                    for index in range(4)])
+        producer.start()
+        time.sleep(0.2)
+        # two files uploading and one queued
+        self.assertTrue(producer.is_alive())
+        release.set()
+        producer.join(5)
+        self.assertEqual(pipeline.close()['files'], 4)
+
+    def test_failed_upload_reported(self):
+        def fail(filename, remote_path):
+            raise OSError('unavailable')
+        self.store._upload_function = lambda: fail
+        with UploadPipeline(self.store) as pipeline:
+            pipeline.put(self._write('hosts.json'))
+        self.assertEqual(len(pipeline.summary['failed']), 1)
+
+    def test_unexpected_error_reported(self):
+        def fail(filename, remote_path):
+            if filename.endswith('0.json'):
+                raise RuntimeError('unexpected')
+            return upload_file(filename, remote_path)
+        upload_file = self.store._upload_function()
+        self.store._upload_function = lambda: fail
+        pipeline = UploadPipeline(self.store, queue_size=1)
+        producer = threading.Thread(target=lambda: [pipeline.put(self._write('{}.json'.format(index)))
+                                                    for index in range(12)])
+        producer.start()
+        producer.join(5)
+        self.assertFalse(producer.is_alive())
+        summary = pipeline.close()
+        self.assertEqual(summary['files'], 10)
+        self.assertListEqual(sorted(os.path.basename(name) for name in summary['failed']), ['0.json', '10.json'])
+
+
+def suite():
+    test_suite = TestLoader().loadTestsFromTestCase(FileChunks)
+    test_suite.addTests(TestLoader().loadTestsFromTestCase(SnapshotStore))
+    test_suite.addTests(TestLoader().loadTestsFromTestCase(SyncUpload))
+    test_suite.addTests(TestLoader().loadTestsFromTestCase(Download))
+    test_suite.addTests(TestLoader().loadTestsFromTestCase(Pipeline))
+    return test_suite
+
+
+if __name__ == '__main__':
+    TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,175 @@
+"""
+@author: Gareth Brown
+@contact: gareth@mesoform.com
+@date: 2017
+"""
+import subprocess
+from unittest import TestLoader, TestCase, TextTestRunner
+from unittest.mock import patch, MagicMock
+import concierge_scheduler.concierge_docker
+
+_TEST_DATA_CENTERS = ['tcp://eu-west-1.docker:2376',
+                      'tcp://us-east-1.docker:2376',
+                      'tcp://ap-south-1.docker:2376']
+
+
+def _fake_run(failing=None):
+    def run(cmd, **kwargs):
+        if failing and '--host={}'.format(failing) in cmd:
+            raise subprocess.CalledProcessError(1, cmd, stderr='no route')
+        return MagicMock(stdout='{}-abc\n{}-def\n'.format(cmd[1], cmd[1]))
+    return run
+
+
+class DockerAdminDataCenters(TestCase):
+    def setUp(self):
+        self.docker_admin = concierge_scheduler.concierge_docker.DockerAdmin(
+            object, _TEST_DATA_CENTERS, 'project', 'consul', 1, 1)
+
+    def test_single_data_center(self):
+        docker_admin = concierge_scheduler.concierge_docker.DockerAdmin(
+            object, _TEST_DATA_CENTERS[0], 'project', 'consul')
+        self.assertListEqual(docker_admin.data_centers, _TEST_DATA_CENTERS[:1])
+
+    @patch('concierge_scheduler.concierge_docker.subprocess.run')
+    def test_list_all_data_centers(self, mock_run):
+        mock_run.side_effect = _fake_run()
+        containers = self.docker_admin.list()
+        self.assertSetEqual(set(containers), set(_TEST_DATA_CENTERS))
+        self.assertEqual(mock_run.call_count, len(_TEST_DATA_CENTERS))
+
+    @patch('concierge_scheduler.concierge_docker.subprocess.run')
+    def test_partial_failure(self, mock_run):
+        mock_run.side_effect = _fake_run(failing=_TEST_DATA_CENTERS[1])
+        with self.assertRaises(SystemExit):
+            self.docker_admin.scale_up()
+        # the healthy data centers are still scaled
+        self.assertEqual(mock_run.call_count, len(_TEST_DATA_CENTERS))
+
+    @patch('concierge_scheduler.concierge_docker.subprocess.run')
+    def test_profiled_in_workers(self, mock_run):
+        mock_run.side_effect = _fake_run()
+        profiler = MagicMock()
+        docker_admin = concierge_scheduler.concierge_docker.DockerAdmin(
+            object, _TEST_DATA_CENTERS, 'project', 'consul', profiler=profiler)
+        docker_admin.list()
+        profiler.phase.assert_called_once_with('ps -q')
+        self.assertEqual(profiler.worker.call_count, len(_TEST_DATA_CENTERS))
+
+
+class DockerAdminVerticalScale(TestCase):
+    def test_parse_memory(self):
+        parse_memory = concierge_scheduler.concierge_docker.parse_memory
+        self.assertEqual(parse_memory('256m'), 256 * 1024 ** 2)
+        self.assertEqual(parse_memory('2G'), 2 * 1024 ** 3)
+        self.assertRaises(ValueError, parse_memory, '2 gigs')
+
+    def test_scaled_resources_capped(self):
+        docker_admin = concierge_scheduler.concierge_docker.DockerAdmin(
+            object, _TEST_DATA_CENTERS[0], 'project', 'consul', delta=3,
+            memory_step='512m', memory_limit='2g', cpu_step=0.5, cpu_limit=2)
+        resources = docker_admin._scaled_resources({
+            'Memory': 1024 ** 3, 'MemorySwap': 2 * 1024 ** 3,
+            'CpuQuota': 100000, 'CpuPeriod': 100000})
+        self.assertDictEqual(resources, {'Memory': 2 * 1024 ** 3,
+                                         'MemorySwap': 3 * 1024 ** 3,
+                                         'CpuQuota': 200000})
+
+    def test_scaled_resources_unlimited(self):
+        docker_admin = concierge_scheduler.concierge_docker.DockerAdmin(
+            object, _TEST_DATA_CENTERS[0], 'project', 'consul', delta=-1,
+            memory_step='256m')
+        self.assertDictEqual(docker_admin._scaled_resources({'Memory': 0}), {})
+
+
+class DockerAdminWarmPool(TestCase):
+    def setUp(self):
+        self.docker_admin = concierge_scheduler.concierge_docker.DockerAdmin(
+            object, _TEST_DATA_CENTERS[0], 'project', 'consul', 2, 1,
+            warm_pool=2)
+        self.engine = MagicMock()
+        self.engine.containers.return_value = [
+            {'Id': 'running1', 'State': 'running', 'Created': 1},
+            {'Id': 'pool1', 'State': 'exited', 'Created': 2},
+            {'Id': 'running2', 'State': 'running', 'Created': 3},
+            {'Id': 'pool2', 'State': 'created', 'Created': 4}]
+        self.engine.inspect.return_value = {'State': {'Running': True}}
+        self.docker_admin.engine = lambda data_center: self.engine
+
+    @patch('concierge_scheduler.concierge_docker.subprocess.Popen')
+    @patch('concierge_scheduler.concierge_docker.subprocess.run')
+    def test_scale_up_from_pool(self, mock_run, mock_popen):
+        mock_popen.return_value.wait.return_value = 0
+        self.docker_admin.scale_up()
+        self.engine.start.assert_called_once_with('pool1')
+        # only the refill goes through docker-compose, detached from the command
+        mock_run.assert_not_called()
+        self.assertIn('--no-start', mock_popen.call_args[0][0])
+        self.assertIn('consul=5', mock_popen.call_args[0][0])
+        self.assertTrue(mock_popen.call_args[1]['start_new_session'])
+        self.docker_admin.wait_for_refill()
+        mock_popen.return_value.wait.assert_called_once_with()
+
+    @patch('concierge_scheduler.concierge_docker.subprocess.Popen')
+    @patch('concierge_scheduler.concierge_docker.subprocess.run')
+    def test_scale_down_to_pool(self, mock_run, mock_popen):
+        mock_popen.return_value.wait.return_value = 0
+        self.docker_admin.scale_down_to_pool = True
+        self.docker_admin.scale_down()
+        self.docker_admin.wait_for_refill()
+        self.engine.stop.assert_called_once_with('running2', 30)
+        # the pool was already full so the stopped container is removed
+        self.engine.remove.assert_called_once_with('running2')
+
+
+class DockerAdminVictimSelection(TestCase):
+    def setUp(self):
+        self.zbx_client = MagicMock()
+        self.zbx_client.host.get.return_value = [{'hostid': '1'}, {'hostid': '2'}, {'hostid': '3'}]
+        self.zbx_client.item.get.return_value = [
+            {'lastvalue': '80.5', 'hosts': [{'host': 'project_consul_1'}]},
+            {'lastvalue': '2.0', 'hosts': [{'host': 'project_consul_2'}]},
+            {'lastvalue': '35', 'hosts': [{'host': 'project_consul_3'}]}]
+        self.running = [
+            {'Id': 'a' * 64, 'Names': ['/project_consul_1'], 'State': 'running'},
+            {'Id': 'b' * 64, 'Names': ['/project_consul_2'], 'State': 'running'},
+            {'Id': 'c' * 64, 'Names': ['/project_consul_3'], 'State': 'running'}]
+
+    def test_least_loaded_from_zabbix(self):
+        docker_admin = concierge_scheduler.concierge_docker.DockerAdmin(
+            self.zbx_client, _TEST_DATA_CENTERS[0], 'project', 'consul', 3, 2,
+            victim_selection='zabbix')
+        victims = docker_admin._select_victims(MagicMock(), self.running)
+        self.assertListEqual([v['Id'] for v in victims], ['b' * 64, 'c' * 64])
+        self.assertListEqual(self.zbx_client.host.get.call_args[1]['filter']['host'][:2],
+                             ['project_consul_1', 'a' * 12])
+        self.assertListEqual(self.zbx_client.item.get.call_args[1]['hostids'], ['1', '2', '3'])
+
+    def test_unknown_load_chosen_last(self):
+        self.zbx_client.item.get.return_value = self.zbx_client.item.get.return_value[:2]
+        docker_admin = concierge_scheduler.concierge_docker.DockerAdmin(
+            self.zbx_client, _TEST_DATA_CENTERS[0], 'project', 'consul', 3, 2,
+            victim_selection='zabbix')
+        victims = docker_admin._select_victims(MagicMock(), self.running)
+        self.assertListEqual([v['Id'] for v in victims], ['b' * 64, 'a' * 64])
+
+    def test_unhealthy_survivors_stop_scale_down(self):
+        docker_admin = concierge_scheduler.concierge_docker.DockerAdmin(
+            self.zbx_client, _TEST_DATA_CENTERS[0], 'project', 'consul', 3, 1,
+            victim_selection='zabbix', health_timeout=0)
+        engine = MagicMock()
+        engine.containers.return_value = self.running
+        engine.inspect.return_value = {
+            'State': {'Running': True, 'Health': {'Status': 'unhealthy'}}}
+        docker_admin.engine = lambda data_center: engine
+        with self.assertRaises(SystemExit):
+            docker_admin.scale_down()
+        engine.stop.assert_not_called()
+
+
+def suite():
+    return TestLoader().loadTestsFromTestCase(DockerAdminDataCenters)
+
+
+if __name__ == '__main__':
+    TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,173 @@
+"""
+@author: Gareth Brown
+@contact: gareth@mesoform.com
+@date: 2017
+"""
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+from unittest import TestLoader, TestCase, TextTestRunner
+from unittest.mock import patch, MagicMock
+import requests
+from google.api_core import exceptions as google_exceptions
+import concierge_scheduler.concierge_gcs
+
+
+class GCSBackupUpload(TestCase):
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.config_dir)
+        for name in ('hosts.json', 'templates.json', 'hostgroups.json'):
+            with open(os.path.join(self.config_dir, name), 'w') as f:
+                f.write('{"zabbix_export": {}}')
+        with patch.object(concierge_scheduler.concierge_gcs.GCSBackup, 'authenticate'):
+            self.gcs_backup = concierge_scheduler.concierge_gcs.GCSBackup(
+                'credentials.json', self.config_dir, 'bucket', concurrency=2, retries=1)
+        self.bucket = MagicMock()
+        self.gcs_backup._client.get_bucket.return_value = self.bucket
+
+    @patch('concierge_scheduler.concierge_gcs.time.sleep')
+    def test_upload_summary(self, mock_sleep):
+        blob = self.bucket.blob.return_value
+        blob.upload_from_filename.side_effect = [google_exceptions.ServiceUnavailable('busy'), None, None, None]
+        summary = self.gcs_backup.upload(self.gcs_backup.assemble_upload_list(), 'folder')
+        self.assertEqual(summary['files'], 3)
+        self.assertEqual(summary['bytes'], 3 * len('{"zabbix_export": {}}'))
+        self.assertListEqual(summary['failed'], [])
+        self.assertEqual(blob.upload_from_filename.call_count, 4)
+
+    @patch('concierge_scheduler.concierge_gcs.time.sleep')
+    def test_upload_failure_reported(self, mock_sleep):
+        self.bucket.blob.return_value.upload_from_filename.side_effect = \
+            google_exceptions.ServiceUnavailable('down')
+        summary = self.gcs_backup.upload(self.gcs_backup.assemble_upload_list())
+        self.assertEqual(summary['files'], 0)
+        self.assertEqual(len(summary['failed']), 3)
+
+
+class GCSBackupSync(TestCase):
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.config_dir)
+        self.manifest = os.path.join(tempfile.mkdtemp(), 'manifest.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.manifest))
+        for name, content in (('hosts.json', 'hosts'), ('templates.json', 'templates')):
+            with open(os.path.join(self.config_dir, name), 'w') as f:
+                f.write(content)
+        with patch.object(concierge_scheduler.concierge_gcs.GCSBackup, 'authenticate'):
+            self.gcs_backup = concierge_scheduler.concierge_gcs.GCSBackup(
+                'credentials.json', self.config_dir, 'bucket')
+        self.bucket = MagicMock()
+        self.gcs_backup._client.get_bucket.return_value = self.bucket
+        directory = os.path.basename(self.config_dir)
+        stored = MagicMock(md5_hash=concierge_scheduler.concierge_gcs.file_checksums(
+            os.path.join(self.config_dir, 'hosts.json'))['md5'])
+        stored.name = 'folder/{}/hosts.json'.format(directory)
+        self.bucket.list_blobs.return_value = [stored]
+
+    def test_sync_skips_unchanged(self):
+        summary = self.gcs_backup.upload(self.gcs_backup.assemble_upload_list(), 'folder', sync=True,
+                                         manifest=self.manifest)
+        self.assertEqual(summary['files'], 1)
+        self.assertEqual(summary['skipped'], 1)
+        self.bucket.blob.assert_called_once_with(
+            'folder/{}/templates.json'.format(os.path.basename(self.config_dir)))
+
+    def test_manifest_replaces_listing(self):
+        self.gcs_backup.upload(self.gcs_backup.assemble_upload_list(), 'folder', sync=True, manifest=self.manifest)
+        self.bucket.reset_mock()
+        summary = self.gcs_backup.upload(self.gcs_backup.assemble_upload_list(), 'folder', sync=True,
+                                         manifest=self.manifest)
+        self.bucket.list_blobs.assert_not_called()
+        self.assertEqual(summary['files'], 0)
+        self.assertEqual(summary['skipped'], 2)
+
+
+class GCSBackupArchive(TestCase):
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.config_dir)
+        for subdir in ('server1', 'server2'):
+            os.makedirs(os.path.join(self.config_dir, subdir))
+            with open(os.path.join(self.config_dir, subdir, 'hosts.json'), 'w') as f:
+                f.write(subdir)
+        with patch.object(concierge_scheduler.concierge_gcs.GCSBackup, 'authenticate'):
+            self.gcs_backup = concierge_scheduler.concierge_gcs.GCSBackup(
+                'credentials.json', self.config_dir, 'bucket')
+        self.bucket = MagicMock()
+        self.gcs_backup._client.get_bucket.return_value = self.bucket
+        self.directory = os.path.basename(self.config_dir)
+
+    def test_files_keep_relative_paths(self):
+        self.gcs_backup.upload(self.gcs_backup.assemble_upload_list(), 'folder')
+        remote_paths = {call[0][0] for call in self.bucket.blob.call_args_list}
+        self.assertSetEqual(remote_paths, {'folder/{}/server1/hosts.json'.format(self.directory),
+                                           'folder/{}/server2/hosts.json'.format(self.directory)})
+
+    def test_archive_streamed(self):
+        uploaded = io.BytesIO()
+        writer = MagicMock(write=uploaded.write)
+        self.bucket.blob.return_value.open.return_value.__enter__.return_value = writer
+        summary = self.gcs_backup.upload_archive(self.gcs_backup.assemble_upload_list(), 'folder')
+        self.bucket.blob.assert_called_once_with('folder/{}.tar.gz'.format(self.directory))
+        self.assertEqual(summary['bytes'], len(uploaded.getvalue()))
+        with tarfile.open(fileobj=io.BytesIO(uploaded.getvalue()), mode='r:gz') as archive:
+            self.assertSetEqual(set(archive.getnames()), {'{}/server1/hosts.json'.format(self.directory),
+                                                          '{}/server2/hosts.json'.format(self.directory)})
+
+
+class GCSBackupResumable(TestCase):
+    chunk = 256 * 1024
+
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.config_dir)
+        self.filename = os.path.join(self.config_dir, 'hosts.json')
+        with open(self.filename, 'wb') as f:
+            f.write(b'x' * (3 * self.chunk))
+        self.session_file = os.path.join(self.config_dir, 'sessions.json')
+        self.bucket = MagicMock()
+        self.blob = self.bucket.blob.return_value
+        self.blob.name = 'folder/hosts.json'
+        self.blob.create_resumable_upload_session.return_value = 'https://upload/session1'
+
+    def _gcs_backup(self):
+        with patch.object(concierge_scheduler.concierge_gcs.GCSBackup, 'authenticate'):
+            gcs_backup = concierge_scheduler.concierge_gcs.GCSBackup(
+                'credentials.json', self.config_dir, 'bucket', retries=0, chunk_size=self.chunk,
+                session_file=self.session_file)
+        return gcs_backup
+
+    def test_interrupted_upload_resumes(self):
+        gcs_backup = self._gcs_backup()
+        gcs_backup._client._http.put.side_effect = [
+            MagicMock(status_code=308, headers={'Range': 'bytes=0-{}'.format(self.chunk - 1)}),
+            requests.ConnectionError('connection reset')]
+        with self.assertRaises(requests.ConnectionError):
+            gcs_backup.upload_file(self.bucket, self.filename, 'folder/hosts.json')
+
+        gcs_backup = self._gcs_backup()
+        put = gcs_backup._client._http.put
+        put.side_effect = [
+            MagicMock(status_code=308, headers={'Range': 'bytes=0-{}'.format(self.chunk - 1)}),
+            MagicMock(status_code=308, headers={'Range': 'bytes=0-{}'.format(2 * self.chunk - 1)}),
+            MagicMock(status_code=200, headers={})]
+        self.assertEqual(gcs_backup.upload_file(self.bucket, self.filename, 'folder/hosts.json'), 3 * self.chunk)
+        self.blob.create_resumable_upload_session.assert_called_once()
+        self.assertEqual(put.call_args_list[1][1]['headers']['Content-Range'],
+                         'bytes {}-{}/{}'.format(self.chunk, 2 * self.chunk - 1, 3 * self.chunk))
+        # requests which hang are given up on, so that upload_file retries them
+        self.assertTrue(all(call[1]['timeout'] == concierge_scheduler.concierge_gcs.RESUMABLE_REQUEST_TIMEOUT
+                            for call in put.call_args_list))
+        with open(self.session_file) as f:
+            self.assertEqual(f.read(), '{}')
+
+
+def suite():
+    return TestLoader().loadTestsFromTestCase(GCSBackupUpload)
+
+
+if __name__ == '__main__':
+    TextTestRunner(verbosity=2).run(suite())
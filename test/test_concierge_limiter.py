@@ -0,0 +1,124 @@
+"""
+@author: Gareth Brown
+@contact: gareth@mesoform.com
+@date: 2017
+"""
+import threading
+from unittest import TestLoader, TestCase, TextTestRunner
+from unittest.mock import MagicMock
+import requests
+from concierge_scheduler.concierge_limiter import AdaptiveLimiter, LimitedClient, call_kind, parse_weights
+
+
+def _server_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(response=response)
+
+
+class Limiter(TestCase):
+    def setUp(self):
+        self.limiter = AdaptiveLimiter(floor=1, ceiling=8)
+
+    def call(self, method='host.get', latency=0.1, overloaded=False, kind=''):
+        weight = self.limiter.weight(method)
+        self.limiter.release(method, weight, latency, overloaded, self.limiter.acquire(weight), kind)
+
+    def test_window_widens_while_latency_flat(self):
+        for _ in range(20):
+            self.call()
+        self.assertGreater(self.limiter.window, 4)
+        for _ in range(100):
+            self.call()
+        self.assertEqual(self.limiter.window, 8)
+
+    def test_window_cut_when_latency_rises(self):
+        for _ in range(100):
+            self.call()
+        self.call(latency=0.5)
+        self.assertEqual(self.limiter.window, 4)
+        self.call(latency=0.5)
+        self.assertEqual(self.limiter.window, 2)
+        self.call(latency=0.5)
+        self.call(latency=0.5)
+        self.assertEqual(self.limiter.window, 1)
+
+    def test_cut_once_for_calls_started_together(self):
+        for _ in range(100):
+            self.call()
+        tokens = [self.limiter.acquire(1) for _ in range(4)]
+        for token in tokens:
+            self.limiter.release('host.get', 1, 0.1, True, token)
+        self.assertEqual(self.limiter.window, 4)
+        self.assertEqual(self.limiter.summary['cuts'], 1)
+
+    def test_server_errors_cut_window(self):
+        for _ in range(100):
+            self.call()
+        with self.assertRaises(requests.HTTPError):
+            with self.limiter.limit('host.get'):
+                raise _server_error(503)
+        self.assertEqual(self.limiter.window, 4)
+        with self.assertRaises(requests.HTTPError):
+            with self.limiter.limit('host.get'):
+                raise _server_error(404)
+        self.assertGreater(self.limiter.window, 4)
+
+    def test_latency_compared_within_kind(self):
+        for _ in range(100):
+            self.call('configuration.export', 0.1, kind='hostgroups')
+        # exporting every host takes far longer than exporting the host groups, without the server slowing down
+        for _ in range(5):
+            self.call('configuration.export', 2.0, kind='hosts')
+            self.call('configuration.export', 0.1, kind='hostgroups')
+        self.assertEqual(self.limiter.window, 8)
+        self.assertEqual(self.limiter.summary['cuts'], 0)
+        self.call('configuration.export', 5.0, kind='hosts')
+        self.assertEqual(self.limiter.summary['cuts'], 1)
+
+    def test_call_kind(self):
+        self.assertEqual(call_kind('configuration.export', (), {'options': {'hosts': ['1']}, 'format': 'json'}),
+                         'hosts')
+        self.assertEqual(call_kind('confimport', ('json', 'x' * 3000, {}), {}), 'up to 4 KiB')
+        self.assertEqual(call_kind('host.get', (), {'output': 'extend'}), '')
+
+    def test_heavy_calls_take_more_of_window(self):
+        self.limiter.window = 4
+        self.limiter.acquire(self.limiter.weight('configuration.export'))
+        acquired = threading.Event()
+        threading.Thread(target=lambda: acquired.set() if self.limiter.acquire(1) is not None else None,
+                         daemon=True).start()
+        self.assertFalse(acquired.wait(0.2))
+        self.limiter.release('configuration.export', 4, 0.1, False, 0)
+        self.assertTrue(acquired.wait(1))
+
+    def test_parse_weights(self):
+        self.assertDictEqual(parse_weights('host.get=2, confimport=8'), {'host.get': 2, 'confimport': 8})
+        for weights in ('host.get', 'host.get=0', '=2', 'host.get=many'):
+            with self.assertRaises(ValueError):
+                parse_weights(weights)
+
+
+class Client(TestCase):
+    def test_calls_made_through_limiter(self):
+        zbx_client = MagicMock()
+        zbx_client.host.get.return_value = [{'hostid': '1'}]
+        limiter = AdaptiveLimiter()
+        client = LimitedClient(zbx_client, limiter)
+        self.assertListEqual(client.host.get(output='extend'), [{'hostid': '1'}])
+        client.confimport('json', '{}', {})
+        zbx_client.host.get.assert_called_once_with(output='extend')
+        zbx_client.confimport.assert_called_once_with('json', '{}', {})
+        client.configuration.export(options={'hostgroups': ['1']}, format='json')
+        self.assertSetEqual(set(limiter._baselines), {'host.get', 'confimport:up to 1 KiB',
+                                                      'configuration.export:hostgroups'})
+
+
+def suite():
+    test_suite = TestLoader().loadTestsFromTestCase(Limiter)
+    test_suite.addTests(TestLoader().loadTestsFromTestCase(Client))
+    return test_suite
+
+
+if __name__ == '__main__':
+    TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,69 @@
+"""
+@author: Gareth Brown
+@contact: gareth@mesoform.com
+@date: 2017
+"""
+import json
+import os
+import pstats
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestLoader, TestCase, TextTestRunner
+from concierge_scheduler.concierge_profile import Profiler
+
+
+class ProfilerReport(TestCase):
+    def setUp(self):
+        self.output_dir = os.path.join(tempfile.mkdtemp(), '202001010000-profile')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.output_dir))
+
+    def test_nested_phases(self):
+        profiler = Profiler()
+        with profiler.phase('backup_config'):
+            with profiler.phase('export templates'):
+                exported = json.dumps([{'host': str(index)} for index in range(10000)])
+            with profiler.phase('export hosts'):
+                pass
+        profiler.write(self.output_dir)
+        self.assertTrue(exported)
+        self.assertListEqual(sorted(os.listdir(self.output_dir)),
+                             ['01-backup_config.pstats', '02-export_templates.pstats', '03-export_hosts.pstats',
+                              'report.txt'])
+        # time spent in nested phases isn't counted in the phase around them
+        functions = [function for _, _, function in pstats.Stats(
+            os.path.join(self.output_dir, '02-export_templates.pstats')).stats]
+        self.assertIn('dumps', functions)
+        self.assertNotIn('dumps', [function for _, _, function in pstats.Stats(
+            os.path.join(self.output_dir, '01-backup_config.pstats')).stats])
+        with open(os.path.join(self.output_dir, 'report.txt')) as f:
+            report = f.read()
+        self.assertIn('export templates', report)
+
+    def test_worker_threads_profiled(self):
+        profiler = Profiler()
+
+        def work(index):
+            with profiler.worker():
+                return json.dumps([{'host': str(index)} for index in range(1000)])
+        with profiler.phase('list'):
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                self.assertEqual(len(list(executor.map(work, range(4)))), 4)
+        profiler.write(self.output_dir)
+        functions = [function for _, _, function in pstats.Stats(
+            os.path.join(self.output_dir, '01-list.pstats')).stats]
+        self.assertIn('dumps', functions)
+
+    def test_unfinished_phase_written(self):
+        profiler = Profiler()
+        profiler.start('scale_up')
+        profiler.write(self.output_dir)
+        self.assertIn('01-scale_up.pstats', os.listdir(self.output_dir))
+
+
+def suite():
+    return TestLoader().loadTestsFromTestCase(ProfilerReport)
+
+
+if __name__ == '__main__':
+    TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,115 @@
+"""
+@author: Gareth Brown
+@contact: gareth@mesoform.com
+@date: 2017
+"""
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestLoader, TestCase, TextTestRunner
+from concierge_scheduler.concierge_records import RecordReader, RecordWriter, write_records, convert_backup, \
+    iter_json_array, RECORDS_SUFFIX, INDEX_SUFFIX
+
+
+def _export(templates):
+    return {'zabbix_export': {'version': '6.0', 'date': '2020-01-01T00:00:00Z',
+                              'groups': [{'uuid': 'g1', 'name': 'Templates'}],
+                              'templates': [{'uuid': 't{}'.format(index), 'template': 'Template {}'.format(index),
+                                             'items': [{'key': 'item{}'.format(item)} for item in range(20)]}
+                                            for index in range(templates)]}}
+
+
+class Records(TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        self.path = os.path.join(self.data_dir, 'templates')
+
+    def test_export_round_trip(self):
+        document = _export(200)
+        write_records(self.path, document, block_size=4096)
+        reader = RecordReader(self.path + INDEX_SUFFIX)
+        self.assertEqual(len(reader), 201)
+        self.assertGreater(len(reader.index['blocks']), 10)
+        self.assertEqual(reader.document(), document)
+        # blocks are gzip members, so the records can be read as JSON lines
+        with gzip.open(self.path + RECORDS_SUFFIX) as f:
+            self.assertEqual(len(f.readlines()), 201)
+
+    def test_get_reads_one_record(self):
+        write_records(self.path, _export(200), block_size=4096)
+        reader = RecordReader(self.path)
+        entry = reader.find('Template 150', 'templates')[0]
+        self.assertEqual(entry['id'], 't150')
+        self.assertEqual(reader.get('Template 150')['uuid'], 't150')
+        self.assertEqual(reader.get('Templates', 'groups'), {'uuid': 'g1', 'name': 'Templates'})
+        self.assertIsNone(reader.get('Templates', 'templates'))
+
+    def test_empty_component(self):
+        # components with no objects are exported as null
+        write_records(self.path, None)
+        reader = RecordReader(self.path)
+        self.assertEqual(len(reader), 0)
+        self.assertListEqual(reader.document(), [])
+
+    def test_no_index_for_failed_write(self):
+        write_records(self.path, _export(2))
+        with self.assertRaises(RuntimeError):
+            with RecordWriter(self.path) as writer:
+                writer.write({'uuid': 't1'})
+                raise RuntimeError('export failed')
+        self.assertTrue(os.path.exists(self.path + RECORDS_SUFFIX))
+        self.assertFalse(os.path.exists(self.path + INDEX_SUFFIX))
+
+    def test_convert_backup(self):
+        actions = [{'actionid': '3', 'name': 'Registration'}, {'actionid': '7', 'name': 'Trigger'}]
+        with open(os.path.join(self.data_dir, 'reg_actions.json'), 'w') as f:
+            json.dump(actions, f)
+        with open(os.path.join(self.data_dir, 'id_map_backup.json'), 'w') as f:
+            json.dump({'templates': [], 'hosts': []}, f)
+        converted = convert_backup(self.data_dir, 'records')
+        self.assertListEqual(converted, [os.path.join(self.data_dir, 'reg_actions')])
+        self.assertListEqual(list(RecordReader(converted[0])), actions)
+        os.remove(os.path.join(self.data_dir, 'reg_actions.json'))
+        convert_backup(self.data_dir, 'json')
+        with open(os.path.join(self.data_dir, 'reg_actions.json')) as f:
+            self.assertListEqual(json.load(f), actions)
+
+
+class JsonArrayStream(TestCase):
+    def test_elements_across_reads(self):
+        document = [{'name': 'service ]}}, [ {}'.format(index), 'children': [{'serviceid': index}]}
+                    for index in range(50)] + [12345, 'x' * 500, None, []]
+        for read_size in (1, 7, 4096):
+            for indent in (None, 2):
+                stream = io.StringIO(json.dumps(document, indent=indent))
+                self.assertListEqual(list(iter_json_array(stream, read_size)), document)
+
+    def test_numbers_across_reads(self):
+        # [12. is read first, which decodes as 12 unless the rest of the number is read before accepting it
+        self.assertListEqual(list(iter_json_array(io.StringIO('[12.5]'), 3)), [12.5])
+        self.assertListEqual(list(iter_json_array(io.StringIO('[12.5, 7]'), 3)), [12.5, 7])
+        for read_size in range(1, 12):
+            stream = io.StringIO('[1.5e3 , -2E-2,10]')
+            self.assertListEqual(list(iter_json_array(stream, read_size)), [1500.0, -0.02, 10])
+
+    def test_empty_array(self):
+        self.assertListEqual(list(iter_json_array(io.StringIO(' [ ] '))), [])
+
+    def test_invalid(self):
+        for text in ('{"name": "web"}', '[{"name": "web"}', '[1 2]', '[{"name": ]'):
+            with self.assertRaises(ValueError):
+                list(iter_json_array(io.StringIO(text), 4))
+
+
+def suite():
+    test_suite = TestLoader().loadTestsFromTestCase(Records)
+    test_suite.addTests(TestLoader().loadTestsFromTestCase(JsonArrayStream))
+    return test_suite
+
+
+if __name__ == '__main__':
+    TextTestRunner(verbosity=2).run(suite())
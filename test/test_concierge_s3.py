@@ -0,0 +1,103 @@
+"""
+@author: Gareth Brown
+@contact: gareth@mesoform.com
+@date: 2017
+"""
+import os
+import shutil
+import tempfile
+from unittest import TestLoader, TestCase, TextTestRunner, skipIf
+try:
+    import boto3
+    from moto.server import ThreadedMotoServer
+    import concierge_scheduler.concierge_s3
+except ImportError:
+    ThreadedMotoServer = None
+
+_TEST_PORT = 5123
+_TEST_BUCKET = 'zbx-backups'
+
+
+@skipIf(ThreadedMotoServer is None, 'boto3 and moto are needed for S3 tests')
+class S3BackupUpload(TestCase):
+    """
+    upload to a local moto server standing in for S3
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadedMotoServer(port=_TEST_PORT, verbose=False)
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.config_dir = os.path.join(self.work_dir, '202001010000')
+        os.makedirs(os.path.join(self.config_dir, 'server1'))
+        with open(os.path.join(self.config_dir, 'server1', 'hosts.json'), 'w') as f:
+            f.write('{"zabbix_export": {}}')
+        with open(os.path.join(self.config_dir, 'templates.json'), 'wb') as f:
+            f.write(os.urandom(11 * 1024 * 1024))
+        credentials = os.path.join(self.work_dir, 'credentials')
+        with open(credentials, 'w') as f:
+            f.write('[default]\naws_access_key_id = testing\naws_secret_access_key = testing\n')
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        self.s3_backup = concierge_scheduler.concierge_s3.S3Backup(
+            credentials, self.config_dir, _TEST_BUCKET, concurrency=4, chunk_size=5 * 1024 * 1024,
+            endpoint_url='http://127.0.0.1:{}'.format(_TEST_PORT))
+        self.s3_backup._client.create_bucket(Bucket=_TEST_BUCKET)
+
+    def test_multipart_upload_and_sync(self):
+        summary = self.s3_backup.upload(self.s3_backup.assemble_upload_list(), 'folder')
+        self.assertEqual(summary['files'], 2)
+        self.assertListEqual(summary['failed'], [])
+        stored = self.s3_backup._client.head_object(Bucket=_TEST_BUCKET, Key='folder/202001010000/templates.json')
+        # uploaded in 3 parts
+        self.assertTrue(stored['ETag'].strip('"').endswith('-3'))
+
+        with open(os.path.join(self.config_dir, 'server1', 'hosts.json'), 'w') as f:
+            f.write('{"zabbix_export": {"hosts": []}}')
+        summary = self.s3_backup.upload(self.s3_backup.assemble_upload_list(), 'folder', sync=True)
+        self.assertEqual(summary['files'], 1)
+        self.assertEqual(summary['skipped'], 1)
+
+    def test_sync_copies_from_previous_directory(self):
+        self.s3_backup.upload(self.s3_backup.assemble_upload_list(), 'folder')
+        config_dir = os.path.join(self.work_dir, '202001020000')
+        shutil.copytree(self.config_dir, config_dir)
+        with open(os.path.join(config_dir, 'server1', 'hosts.json'), 'w') as f:
+            f.write('{"zabbix_export": {"hosts": []}}')
+        self.s3_backup.config_dir = config_dir
+        summary = self.s3_backup.upload(self.s3_backup.assemble_upload_list(), 'folder', sync=True)
+        self.assertEqual(summary['files'], 1)
+        self.assertEqual(summary['copied'], 1)
+        self.assertLess(summary['bytes'], 1024)
+        etags = [self.s3_backup._client.head_object(Bucket=_TEST_BUCKET, Key=key)['ETag'] for key in
+                 ('folder/202001010000/templates.json', 'folder/202001020000/templates.json')]
+        self.assertEqual(etags[0], etags[1])
+
+    def test_snapshot_round_trip(self):
+        summary = self.s3_backup.upload_snapshot(self.s3_backup.assemble_upload_list(), 'store')
+        self.assertEqual(summary['files'], 2)
+        self.assertListEqual(summary['failed'], [])
+        self.assertIn('store/snapshots/202001010000.json', self.s3_backup._list_objects('store/snapshots/'))
+        summary = self.s3_backup.upload_snapshot(self.s3_backup.assemble_upload_list(), 'store', name='again')
+        self.assertEqual(summary['skipped'], summary['chunks'])
+        self.assertTrue(self.s3_backup._get_object('store/snapshots/again.json').startswith(b'{'))
+
+    def test_missing_bucket_reported(self):
+        self.s3_backup.storage_location = 'missing-bucket'
+        summary = self.s3_backup.upload(self.s3_backup.assemble_upload_list(), 'folder')
+        self.assertEqual(summary['files'], 0)
+        self.assertEqual(len(summary['failed']), 2)
+
+
+def suite():
+    return TestLoader().loadTestsFromTestCase(S3BackupUpload)
+
+
+if __name__ == '__main__':
+    TextTestRunner(verbosity=2).run(suite())
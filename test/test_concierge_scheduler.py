@@ -3,10 +3,16 @@
 @contact: gareth@mesoform.com
 @date: 2017
 """
+import argparse
+import json
+import os
+import shutil
+import tempfile
 from unittest import TestLoader, TestCase, TextTestRunner
+from pyzabbix import ZabbixAPIException
 from concierge_scheduler import concierge_scheduler
 from concierge_scheduler.concierge_scheduler import arg_parser
-from mock import patch
+from mock import patch, MagicMock
 
 
 class ConciergeSchedulerArgs(TestCase):
@@ -29,6 +35,81 @@ class ConciergeSchedulerArgs(TestCase):
         self.assertEqual(parsed.command, 'scale_up')
 
 
+class DataCenters(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.datacenter_config = os.path.join(self.work_dir, 'datacenters.json')
+        with open(self.datacenter_config, 'w') as f:
+            json.dump({'groups': {'eu': ['tcp://eu-1:2376', 'tcp://eu-2:2376'], 'us': []}}, f)
+
+    def _args(self, group):
+        return argparse.Namespace(datacenter_url=None, datacenter_config=self.datacenter_config,
+                                  datacenter_group=group)
+
+    def test_group(self):
+        self.assertListEqual(concierge_scheduler.get_data_centers(self._args('eu')),
+                             ['tcp://eu-1:2376', 'tcp://eu-2:2376'])
+
+    def test_empty_group(self):
+        with self.assertRaises(SystemExit) as exit_error:
+            concierge_scheduler.get_data_centers(self._args('us'))
+        self.assertNotEqual(exit_error.exception.code, 0)
+
+
+class BackupServers(TestCase):
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.config_dir)
+        servers_file = os.path.join(self.config_dir, 'servers.json')
+        with open(servers_file, 'w') as f:
+            json.dump({'servers': [{'name': 'eu', 'host': 'https://zabbix-eu/'},
+                                   {'name': 'us', 'host': 'https://zabbix-us/', 'user': 'backup',
+                                    'password': 'secret'}]}, f)
+        self.args = argparse.Namespace(servers_file=servers_file, config_dir=self.config_dir, workers=2,
+                                       upload=False, event_engine='zabbix', force_templates=False,
+                                       backup_format='json', api_min_concurrency=1, api_max_concurrency=8,
+                                       api_weights='')
+        self.event_admin = MagicMock()
+        patcher = patch.dict(concierge_scheduler.event_administrators, {'zabbix': self.event_admin})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('concierge_scheduler.concierge_scheduler.initiate_zabbix_client',
+                        side_effect=lambda host, user, password: host)
+        self.initiate_zabbix_client = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_each_server_in_own_directory(self):
+        concierge_scheduler.backup_servers(self.args)
+        self.initiate_zabbix_client.assert_any_call('https://zabbix-us/', 'backup', 'secret')
+        backups = sorted((call[0][0], call[0][1]) for call in self.event_admin.call_args_list)
+        self.assertListEqual(backups, [('https://zabbix-eu/', os.path.join(self.config_dir, 'eu')),
+                                       ('https://zabbix-us/', os.path.join(self.config_dir, 'us'))])
+
+    def test_failure_reported_after_all_servers(self):
+        def event_admin(client, *args, **kwargs):
+            if client == 'https://zabbix-eu/':
+                raise ZabbixAPIException('Login failed')
+            return MagicMock()
+        self.event_admin.side_effect = event_admin
+        with self.assertRaises(SystemExit):
+            concierge_scheduler.backup_servers(self.args)
+        self.assertEqual(self.event_admin.call_count, 2)
+
+    def test_any_error_is_a_server_failure(self):
+        def event_admin(client, *args, **kwargs):
+            admin = MagicMock()
+            if client == 'https://zabbix-eu/':
+                admin.run.side_effect = KeyError('templates')
+            else:
+                admin.run.side_effect = SystemExit(1)
+            return admin
+        self.event_admin.side_effect = event_admin
+        with patch('concierge_scheduler.concierge_scheduler.__warn') as warn, self.assertRaises(SystemExit):
+            concierge_scheduler.backup_servers(self.args)
+        self.assertListEqual(sorted(call[0][1] for call in warn.call_args_list), ['eu', 'us'])
+
+
 class FullTest(TestCase):
     """
     class that performs full suite of tests
@@ -36,7 +117,10 @@ class FullTest(TestCase):
 
 
 def suite():
-    return TestLoader().loadTestsFromTestCase(FullTest)
+    test_suite = TestLoader().loadTestsFromTestCase(FullTest)
+    test_suite.addTests(TestLoader().loadTestsFromTestCase(DataCenters))
+    test_suite.addTests(TestLoader().loadTestsFromTestCase(BackupServers))
+    return test_suite
 
 
 if __name__ == '__main__':
@@ -3,11 +3,16 @@
 @contact: gareth@mesoform.com
 @date: 2017
 """
+import hashlib
 import json
 import os
+import shutil
+import tempfile
+import threading
 from unittest import TestLoader, TestCase, TextTestRunner
 from ast import literal_eval
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
+from pyzabbix import ZabbixAPIException
 import concierge_scheduler.concierge_zabbix
 import concierge_scheduler.concierge_docker
 
@@ -86,8 +91,334 @@ class FullTest(TestCase):
         self.assertIsNotNone(results)
 
 
+class ZabbixAdminWaitForFile(TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        with open(os.path.join(self.data_dir, 'services.json'), 'w') as f:
+            json.dump([{'name': 'web'}], f)
+        self.waited = []
+        self.zbx_admin = concierge_scheduler.concierge_zabbix.ZabbixAdmin(
+            MagicMock(), self.data_dir, _TEST_FORCE_TEMPLATE,
+            wait_for_file=lambda path: self.waited.append(path) or True)
+
+    def test_import_waits_for_file(self):
+        self.zbx_admin.import_components('services')
+        self.assertListEqual(self.waited, [os.path.join(self.data_dir, 'services.json')])
+        self.zbx_admin.zbx_client.service.create.assert_called_once_with([{'name': 'web'}])
+
+    def test_missing_file_fails(self):
+        self.zbx_admin.wait_for_file = lambda path: False
+        with self.assertRaises(SystemExit) as exit_error:
+            self.zbx_admin.import_components('services')
+        self.assertNotEqual(exit_error.exception.code, 0)
+        self.zbx_admin.zbx_client.service.create.assert_not_called()
+
+    def test_records_format(self):
+        self.zbx_admin.backup_format = 'records'
+        self.zbx_admin.zbx_client.proxy.get.return_value = [{'proxyid': '1', 'host': 'proxy', 'lastaccess': '0'}]
+        self.zbx_admin.export_component('proxy', 'proxies')
+        self.assertListEqual(sorted(os.listdir(self.data_dir)),
+                             ['proxies.index.json', 'proxies.records.gz', 'services.json'])
+        self.zbx_admin.import_components('proxies')
+        self.assertListEqual(self.waited, [os.path.join(self.data_dir, 'proxies.records.gz'),
+                                           os.path.join(self.data_dir, 'proxies.index.json')])
+        self.assertListEqual(self.zbx_admin.zbx_client.proxy.create.call_args[0][0], [{'host': 'proxy'}])
+
+    def test_records_format_empty_component(self):
+        self.zbx_admin.backup_format = 'records'
+        self.zbx_admin.zbx_client.proxy.get.return_value = []
+        self.zbx_admin.export_component('proxy', 'proxies')
+        self.zbx_admin.import_components('proxies')
+        self.zbx_admin.zbx_client.proxy.create.assert_not_called()
+
+    def test_export_reports_written_file(self):
+        written = []
+        self.zbx_admin.on_file_written = written.append
+        self.zbx_admin.zbx_client.proxy.get.return_value = [{'proxyid': '1', 'host': 'proxy'}]
+        self.zbx_admin.export_component('proxy', 'proxies')
+        self.assertListEqual(written, [os.path.join(self.data_dir, 'proxies.json')])
+
+
+class ZabbixAdminStreamingImport(TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        with open(os.path.join(self.data_dir, 'proxies.json'), 'w') as f:
+            json.dump([{'proxyid': str(index), 'host': 'proxy-{}'.format(index), 'lastaccess': '0',
+                        'interface': {'proxyid': str(index), 'dns': 'proxy'}} for index in range(250)], f)
+        self.zbx_admin = concierge_scheduler.concierge_zabbix.ZabbixAdmin(MagicMock(), self.data_dir,
+                                                                          _TEST_FORCE_TEMPLATE)
+
+    def test_batches(self):
+        self.zbx_admin.import_components('proxies')
+        batches = [call[0][0] for call in self.zbx_admin.zbx_client.proxy.create.call_args_list]
+        self.assertListEqual([len(batch) for batch in batches], [100, 100, 50])
+        self.assertDictEqual(batches[2][-1], {'host': 'proxy-249', 'interface': {'dns': 'proxy'}})
+
+    def test_existing_objects_updated(self):
+        self.zbx_admin.import_batch_size = 2
+
+        def create(proxies):
+            if isinstance(proxies, list) or proxies['host'] == 'proxy-1':
+                raise ZabbixAPIException('already exists')
+        self.zbx_admin.zbx_client.proxy.create.side_effect = create
+        self.zbx_admin.zbx_client.proxy.get.return_value = [{'proxyid': '901'}]
+        self.zbx_admin.import_components('proxies', [{'host': 'proxy-0'}, {'host': 'proxy-1'}])
+        self.zbx_admin.zbx_client.proxy.get.assert_called_once_with(filter={'host': 'proxy-1'}, output=['proxyid'])
+        self.zbx_admin.zbx_client.proxy.update.assert_called_once_with({'host': 'proxy-1', 'proxyid': '901'})
+
+    def test_strip_keys_in_place(self):
+        data = {'actionid': '1', 'operations': [{'operationid': '2', 'opgroup': [{'groupid': '3'}]}]}
+        nested = data['operations'][0]
+        self.assertIs(self.zbx_admin._strip_keys(data, {'actionid', 'operationid'}), data)
+        self.assertDictEqual(data, {'operations': [{'opgroup': [{'groupid': '3'}]}]})
+        self.assertIs(data['operations'][0], nested)
+
+
+class ZabbixAdminMigrate(TestCase):
+    def setUp(self):
+        concierge_scheduler.concierge_zabbix._TRIGGER_ACTIONS_FILE = 'trigger_actions.json'
+        concierge_scheduler.concierge_zabbix._REG_ACTIONS_FILE = 'reg_actions.json'
+        self.addCleanup(setattr, concierge_scheduler.concierge_zabbix, '_REG_ACTIONS_FILE', _TEST_REG_ACT_FILE)
+        self.addCleanup(setattr, concierge_scheduler.concierge_zabbix, '_TRIGGER_ACTIONS_FILE', _TEST_TRIG_ACT_FILE)
+        self.source = MagicMock()
+        self.source.template.get.return_value = [{'templateid': '1', 'host': 'Template OS'}]
+        self.source.hostgroup.get.return_value = [{'groupid': '2', 'name': 'Web'}]
+        self.source.host.get.return_value = [{'hostid': '3', 'host': 'web-1'}]
+        self.source.mediatype.get.return_value = [{'mediatypeid': '4', 'name': 'Email'}]
+        self.source.service.get.return_value = [{'serviceid': '5', 'name': 'Shop'}]
+        self.source.proxy.get.return_value = [{'proxyid': '6', 'host': 'proxy-1', 'lastaccess': '0'}]
+        self.source.action.get.return_value = [{'actionid': '7', 'name': 'Notify', 'esc_period': '1h'}]
+        self.source.configuration.export.side_effect = lambda options, format: json.dumps(
+            {'zabbix_export': {'version': '6.0', 'exported': sorted(options)}})
+        self.target = MagicMock()
+        self.store = concierge_scheduler.concierge_zabbix.ExportStore()
+
+    def test_export_streams_into_import(self):
+        def export():
+            try:
+                concierge_scheduler.concierge_zabbix.ZabbixAdmin(
+                    self.source, 'unused', _TEST_FORCE_TEMPLATE, export_store=self.store).run('migrate_export')
+            finally:
+                self.store.finish()
+        exporter = threading.Thread(target=export)
+        exporter.start()
+        concierge_scheduler.concierge_zabbix.ZabbixAdmin(
+            self.target, 'unused', _TEST_FORCE_TEMPLATE, export_store=self.store).run('restore_config')
+        exporter.join()
+        imported = [json.loads(call[0][1])['zabbix_export']['exported'] for call in
+                    self.target.confimport.call_args_list]
+        self.assertListEqual(imported, [['groups'], ['mediaTypes'], ['templates'], ['hosts']])
+        self.target.service.create.assert_called_once_with([{'serviceid': '5', 'name': 'Shop'}])
+        self.target.proxy.create.assert_called_once_with([{'host': 'proxy-1'}])
+        self.target.action.create.assert_any_call([{'name': 'Notify', 'esc_period': '1h'}])
+        self.target.action.create.assert_any_call([{'name': 'Notify'}])
+
+    def test_missing_export(self):
+        self.store.put('templates.json', '[]')
+        self.store.finish()
+        self.assertEqual(self.store.get('templates.json'), '[]')
+        with self.assertRaises(FileNotFoundError):
+            self.store.get('hosts.json')
+
+    def test_file_released_once_read(self):
+        self.store.put('templates.json', '[]')
+        self.assertEqual(self.store.get('templates.json'), '[]')
+        self.assertDictEqual(self.store._files, {})
+        with self.assertRaises(FileNotFoundError):
+            self.store.get('templates.json')
+
+    def test_backup_exports_in_migrate_order(self):
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_dir)
+        concierge_scheduler.concierge_zabbix.ZabbixAdmin(self.source, data_dir, _TEST_FORCE_TEMPLATE).run(
+            'backup_config')
+        backup_calls = self.source.method_calls
+        self.source.reset_mock()
+        concierge_scheduler.concierge_zabbix.ZabbixAdmin(
+            self.source, 'unused', _TEST_FORCE_TEMPLATE, export_store=self.store).run('migrate_export')
+        exports = [call for call in backup_calls if call[0] == 'configuration.export']
+        self.assertListEqual([list(call[2]['options']) for call in exports],
+                             [['groups'], ['mediaTypes'], ['templates'], ['hosts']])
+        self.assertListEqual(exports, [call for call in self.source.method_calls
+                                       if call[0] == 'configuration.export'])
+        self.assertTrue(os.path.isfile(os.path.join(data_dir, 'reg_actions.json')))
+
+
+class ZabbixAdminVerify(TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        self.hosts = [{'hostid': str(index), 'host': 'host-{}'.format(index), 'status': '0', 'available': '1'}
+                      for index in range(1200)]
+        self.client = MagicMock()
+        self.client.host.get.side_effect = self.get_hosts
+        self.client.template.get.return_value = [{'templateid': '1', 'host': 'Template OS'}]
+        self.client.hostgroup.get.return_value = [{'groupid': '2', 'name': 'Web'}]
+        self.client.mediatype.get.return_value = []
+        self.zbx_admin = concierge_scheduler.concierge_zabbix.ZabbixAdmin(self.client, self.data_dir,
+                                                                          _TEST_FORCE_TEMPLATE)
+        self.zbx_admin.run('get_simple_id_map')
+
+    def get_hosts(self, output):
+        return [{field: host[field] for field in output if field in host} for host in self.hosts]
+
+    def test_unchanged(self):
+        self.client.host.get.reset_mock()
+        drift = self.zbx_admin.verify_config()
+        self.assertDictEqual(drift, {'missing': [], 'extra': [], 'differing': []})
+        self.assertEqual(self.client.host.get.call_count, 1)
+        self.assertNotIn('available', self.client.host.get.call_args[1]['output'])
+
+    def test_runtime_state_ignored(self):
+        self.hosts[5]['available'] = '2'
+        self.assertDictEqual(self.zbx_admin.verify_config(), {'missing': [], 'extra': [], 'differing': []})
+
+    def test_drift(self):
+        self.hosts[5]['status'] = '1'
+        del self.hosts[6]
+        self.hosts.append({'hostid': '9999', 'host': 'host-new', 'status': '0'})
+        with self.assertRaises(SystemExit) as exit_error:
+            self.zbx_admin.run('verify')
+        self.assertNotEqual(exit_error.exception.code, 0)
+        with patch('concierge_scheduler.concierge_zabbix._log_error_and_fail'):
+            drift = self.zbx_admin.verify_config()
+        self.assertDictEqual(drift, {'missing': ['hosts/host-6'], 'extra': ['hosts/host-new'],
+                                     'differing': ['hosts/host-5']})
+
+
+class ZabbixAdminLegacyIdFile(TestCase):
+    """
+    ID files written before hash_fields was stored hash every property of an object except its ID
+    """
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        self.hosts = [{'hostid': str(index), 'host': 'host-{}'.format(index), 'status': '0', 'proxy_hostid': '0'}
+                      for index in range(5)]
+        legacy_hashes = [{'host': host['host'], 'hostid': host['hostid'],
+                          'hash': hashlib.md5(json.dumps({key: value for key, value in host.items() if key != 'hostid'},
+                                                         sort_keys=True).encode("utf-8")).hexdigest()}
+                         for host in self.hosts]
+        with open(os.path.join(self.data_dir, 'id_map_backup.json'), 'w') as f:
+            json.dump({'templates': [], 'hostgroups': [], 'hosts': legacy_hashes, 'mediatypes': []}, f)
+        self.client = MagicMock()
+        self.client.host.get.side_effect = lambda output: [dict(host) for host in self.hosts]
+        self.client.template.get.return_value = []
+        self.client.hostgroup.get.return_value = []
+        self.client.mediatype.get.return_value = []
+        self.zbx_admin = concierge_scheduler.concierge_zabbix.ZabbixAdmin(self.client, self.data_dir,
+                                                                          _TEST_FORCE_TEMPLATE)
+
+    def test_restore_deletes_only_changed(self):
+        self.hosts[2]['status'] = '1'
+        self.client.confimport.side_effect = [ZabbixAPIException('import failed'), True]
+        self.zbx_admin.get_id_maps(['templates', 'hostgroups', 'hosts', 'mediatypes'])
+        self.assertEqual(self.client.host.get.call_args[1]['output'], 'extend')
+        self.zbx_admin.import_configuration('hosts', '{}')
+        self.client.host.delete.assert_called_once_with('2')
+
+    def test_verify(self):
+        self.assertDictEqual(self.zbx_admin.verify_config(), {'missing': [], 'extra': [], 'differing': []})
+
+
+class ZabbixAdminSelectiveRestore(TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        backup = {
+            'hostgroups': {'zabbix_export': {'version': '6.0', 'groups': [{'name': 'Web'}, {'name': 'Databases'},
+                                                                          {'name': 'Templates'}]}},
+            'mediatypes': {'zabbix_export': {'version': '6.0', 'media_types': [{'name': 'Email'}]}},
+            'templates': {'zabbix_export': {'version': '6.0', 'groups': [{'name': 'Templates'}], 'templates': [
+                {'template': 'Template OS', 'groups': [{'name': 'Templates'}]},
+                {'template': 'Template App Web', 'groups': [{'name': 'Templates'}],
+                 'templates': [{'name': 'Template OS'}]},
+                {'template': 'Template DB', 'groups': [{'name': 'Templates'}]}]}},
+            'hosts': {'zabbix_export': {'version': '6.0', 'groups': [{'name': 'Web'}, {'name': 'Databases'}],
+                                        'hosts': [{'host': 'web-1', 'groups': [{'name': 'Web'}],
+                                                   'templates': [{'name': 'Template App Web'}],
+                                                   'proxy': {'name': 'proxy-1'}},
+                                                  {'host': 'db-1', 'groups': [{'name': 'Databases'}],
+                                                   'templates': [{'name': 'Template DB'}]}],
+                                        'triggers': [{'name': 'web down', 'expression': 'last(/web-1/up)=0'},
+                                                     {'name': 'db down', 'expression': 'last(/db-1/up)=0'}]}},
+            'proxies': [{'proxyid': '5', 'host': 'proxy-1'}, {'proxyid': '6', 'host': 'proxy-2'}],
+            'services': [{'serviceid': '1', 'name': 'Shop'}],
+            'trigger_actions': [],
+            'reg_actions': [{'actionid': '7', 'name': 'Register web', 'esc_period': '0', 'operations': [
+                {'operationid': '1', 'optemplate': [{'templateid': '101'}], 'opgroup': [{'groupid': '11'}]}],
+                'filter': {'conditions': [{'conditiontype': '24', 'value': 'web'}]}},
+                {'actionid': '8', 'name': 'Register db', 'operations': []}],
+            'id_map_backup': {'templates': [{'host': 'Template OS', 'templateid': '100'},
+                                            {'host': 'Template App Web', 'templateid': '101'}],
+                              'hostgroups': [{'name': 'Web', 'groupid': '11'}], 'hosts': [], 'mediatypes': []}}
+        for name, content in backup.items():
+            with open(os.path.join(self.data_dir, '{}.json'.format(name)), 'w') as f:
+                json.dump(content, f)
+        concierge_scheduler.concierge_zabbix._TRIGGER_ACTIONS_FILE = 'trigger_actions.json'
+        concierge_scheduler.concierge_zabbix._REG_ACTIONS_FILE = 'reg_actions.json'
+        self.addCleanup(setattr, concierge_scheduler.concierge_zabbix, '_REG_ACTIONS_FILE', _TEST_REG_ACT_FILE)
+        self.addCleanup(setattr, concierge_scheduler.concierge_zabbix, '_TRIGGER_ACTIONS_FILE', _TEST_TRIG_ACT_FILE)
+        self.client = MagicMock()
+        self.client.template.get.return_value = [{'templateid': '201', 'host': 'Template App Web'},
+                                                 {'templateid': '200', 'host': 'Template OS'}]
+        self.client.hostgroup.get.return_value = [{'groupid': '21', 'name': 'Web'}]
+        self.client.host.get.return_value = []
+        self.client.mediatype.get.return_value = []
+
+    def test_selected_hosts_with_dependencies(self):
+        selectors = concierge_scheduler.concierge_zabbix.parse_selectors(['hosts:web-*'])
+        concierge_scheduler.concierge_zabbix.ZabbixAdmin(self.client, self.data_dir, False,
+                                                         selectors=selectors).run('restore_config')
+        imported = [json.loads(call[0][1])['zabbix_export'] for call in self.client.confimport.call_args_list]
+        groups, templates, hosts = imported
+        self.assertListEqual(groups['groups'], [{'name': 'Web'}, {'name': 'Templates'}])
+        self.assertListEqual([template['template'] for template in templates['templates']],
+                             ['Template OS', 'Template App Web'])
+        self.assertListEqual([host['host'] for host in hosts['hosts']], ['web-1'])
+        self.assertListEqual(hosts['groups'], [{'name': 'Web'}])
+        self.assertListEqual([trigger['name'] for trigger in hosts['triggers']], ['web down'])
+        self.client.proxy.create.assert_called_once_with([{'host': 'proxy-1'}])
+        self.client.service.create.assert_not_called()
+        self.client.action.create.assert_not_called()
+
+    def test_selected_action_ids_translated(self):
+        selectors = concierge_scheduler.concierge_zabbix.parse_selectors(['reg_actions:Register web'])
+        concierge_scheduler.concierge_zabbix.ZabbixAdmin(self.client, self.data_dir, False,
+                                                         selectors=selectors).run('restore_config')
+        self.client.action.create.assert_called_once_with(
+            {'name': 'Register web', 'operations': [{'optemplate': [{'templateid': '201'}],
+                                                     'opgroup': [{'groupid': '21'}]}],
+             'filter': {'conditions': [{'conditiontype': '24', 'value': 'web'}]}})
+        imported = [json.loads(call[0][1])['zabbix_export'] for call in self.client.confimport.call_args_list]
+        self.assertListEqual([template['template'] for template in imported[1]['templates']],
+                             ['Template OS', 'Template App Web'])
+
+    def test_action_with_missing_reference_skipped(self):
+        self.client.hostgroup.get.return_value = []
+        selectors = concierge_scheduler.concierge_zabbix.parse_selectors(['reg_actions:Register web'])
+        with self.assertRaises(SystemExit) as exit_error:
+            concierge_scheduler.concierge_zabbix.ZabbixAdmin(self.client, self.data_dir, False,
+                                                             selectors=selectors).run('restore_config')
+        self.assertNotEqual(exit_error.exception.code, 0)
+        self.client.action.create.assert_not_called()
+
+    def test_invalid_selector(self):
+        with self.assertRaises(ValueError):
+            concierge_scheduler.concierge_zabbix.parse_selectors(['widgets:*'])
+
+
 def suite():
-    return TestLoader().loadTestsFromTestCase(FullTest)
+    test_suite = TestLoader().loadTestsFromTestCase(FullTest)
+    test_suite.addTests(TestLoader().loadTestsFromTestCase(ZabbixAdminWaitForFile))
+    test_suite.addTests(TestLoader().loadTestsFromTestCase(ZabbixAdminStreamingImport))
+    test_suite.addTests(TestLoader().loadTestsFromTestCase(ZabbixAdminMigrate))
+    test_suite.addTests(TestLoader().loadTestsFromTestCase(ZabbixAdminVerify))
+    test_suite.addTests(TestLoader().loadTestsFromTestCase(ZabbixAdminLegacyIdFile))
+    test_suite.addTests(TestLoader().loadTestsFromTestCase(ZabbixAdminSelectiveRestore))
+    return test_suite
 
 
 if __name__ == '__main__':